@@ -0,0 +1,123 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Golden base images
+
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import VMBuilder.sparse as sparse
+
+def base_image_key(hypervisor):
+    """
+    Work out which base image a vm's disks can share.
+
+    vms built for the same suite and architecture, with the same disk
+    layout, the same set of packages and the same UUID seed come out
+    mostly the same, so they share a base image. Without the seed, the
+    filesystems would get different UUIDs, which ext4 mixes into the
+    checksums of all of its metadata.
+
+    @type  hypervisor: Hypervisor
+    @param hypervisor: The vm
+    @rtype:  string
+    @return: the key of the vm's base image
+    """
+    distro = hypervisor.distro
+    layout = [(disk.size, [(part.begin, part.end, part.type, part.mntpnt) for part in disk.partitions])
+              for disk in hypervisor.disks]
+    return hashlib.sha1(repr((distro.get_setting('suite'),
+                              distro.get_setting('arch'),
+                              layout,
+                              distro.applied_packages(),
+                              hypervisor.uuid_seed))).hexdigest()
+
+class BaseImageCache(object):
+    """
+    Directory of golden base images, raw and sparse.
+
+    The first vm built with a given key donates copies of its disks,
+    stripped of its identity, as the base images. Base images are never
+    changed afterwards, since the overlays of all later vms depend on
+    them.
+
+    @type  directory: string
+    @param directory: Where to keep the base images
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def path(self, key, index):
+        """
+        @rtype:  string
+        @return: the base image of disk number L{index} for L{key}
+        """
+        return os.path.join(self.directory, '%s-%d.raw' % (key, index))
+
+    def bases_for(self, key, filenames, strip=None):
+        """
+        Find the base images of the disks L{filenames} of a vm with
+        L{key}, making them copies of L{filenames} if there aren't any
+        yet. The copies are handed to L{strip} all together before they
+        are stored, to remove what must not be shared with other vms. If
+        several builds race to store them, the first one wins and the
+        others use its copies.
+
+        @type  strip: callable
+        @param strip: Called with the filenames of the copies
+        @rtype:  list
+        @return: the base image of each of L{filenames}
+        """
+        bases = [self.path(key, index) for index in range(len(filenames))]
+        if not [base for base in bases if not os.path.exists(base)]:
+            logging.info('Using base images %s' % ', '.join(bases))
+            return bases
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # The disks are copied even where there is a base image already,
+        # since L{strip} needs the whole system
+        tmps = ['%s.%d.new' % (base, os.getpid()) for base in bases]
+        try:
+            for (filename, tmp) in zip(filenames, tmps):
+                logging.info('Copying %s to %s' % (filename, tmp))
+                sparse.copy(filename, tmp)
+            if strip:
+                strip(tmps)
+            for (base, tmp) in zip(bases, tmps):
+                # Unlike rename, link never replaces a base image another
+                # build has published (and written its overlays against)
+                # in the meantime
+                try:
+                    os.link(tmp, base)
+                    logging.info('Stored base image %s' % base)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    logging.info('Another build stored base image %s first. Using that.' % base)
+        finally:
+            for tmp in tmps:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        return bases
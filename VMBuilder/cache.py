@@ -0,0 +1,400 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    On-disk caches shared between builds
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import os.path
+import time
+from   VMBuilder.util      import run_cmd, tmpdir, CAPTURE_TAIL
+
+class Cache(object):
+    """
+    Size-bounded, content-addressed on-disk cache.
+
+    Every entry is a directory below L{root} named after its key. An
+    index file keeps track of the size and last use of each entry, so
+    that the least recently used entries can be evicted once the cache
+    grows beyond L{max_size}. Concurrent builds are serialised on a
+    lock file next to the index.
+
+    @type  root: string
+    @param root: Directory holding the cache. Created if it doesn't exist.
+    @type  max_size: number
+    @param max_size: Maximum total size of the cache (in megabytes). 0
+        means that the cache is never pruned.
+    """
+
+    def __init__(self, root, max_size=0):
+        self.root = root
+        "The directory holding the cache entries and the index."
+
+        self.max_size = max_size
+        "Maximum size of the cache in megabytes (0 for unbounded)."
+
+    def path(self, key):
+        """
+        @rtype:  string
+        @return: the directory holding the entry for L{key}
+        """
+        return os.path.join(self.root, key)
+
+    def lookup(self, key):
+        """
+        Look up an entry and mark it as recently used.
+
+        @rtype:  string
+        @return: the directory holding the entry or None if there is no
+                 such entry.
+        """
+        lock = self.lock()
+        try:
+            index = self.read_index()
+            if key not in index:
+                return None
+            if not os.path.isdir(self.path(key)):
+                logging.debug('Dropping stale cache entry %s from %s' % (key, self.root))
+                del index[key]
+                self.write_index(index)
+                return None
+            index[key]['last_used'] = time.time()
+            self.write_index(index)
+            return self.path(key)
+        finally:
+            lock.close()
+
+    def store(self, key, populate):
+        """
+        Add an entry to the cache.
+
+        The entry is populated in a scratch directory which is moved
+        into place once L{populate} returns, so a failed or concurrent
+        build never leaves a half-written entry behind.
+
+        @type  key: string
+        @param key: The key of the new entry
+        @type  populate: callable
+        @param populate: Called with the (empty) directory to fill
+        @rtype:  string
+        @return: the directory holding the new entry
+        """
+        scratch = '%s.%d.new' % (self.path(key), os.getpid())
+        os.makedirs(scratch)
+        try:
+            populate(scratch)
+            size = dir_size(scratch)
+        except:
+            run_cmd('rm', '-rf', '--one-file-system', scratch, ignore_fail=True)
+            raise
+
+        lock = self.lock()
+        try:
+            index = self.read_index()
+            if os.path.isdir(self.path(key)):
+                # Someone else beat us to it.
+                run_cmd('rm', '-rf', '--one-file-system', scratch)
+            else:
+                os.rename(scratch, self.path(key))
+            index[key] = { 'size' : size, 'last_used' : time.time() }
+            self.evict(index, keep=key)
+            self.write_index(index)
+        finally:
+            lock.close()
+        return self.path(key)
+
+    def evict(self, index, keep=None):
+        """
+        Remove least recently used entries until the cache fits in
+        L{max_size}. Must be called with the lock held.
+        """
+        if not self.max_size:
+            return
+        total = sum([entry['size'] for entry in index.values()])
+        for key in sorted(index.keys(), key=lambda k: index[k]['last_used']):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            pin = self._claim(key)
+            if pin is False:
+                continue
+            try:
+                logging.info('Evicting %s from %s (%dMB)' % (key, self.root, index[key]['size']))
+                if os.path.isdir(self.path(key)):
+                    run_cmd('rm', '-rf', '--one-file-system', self.path(key))
+                total -= index[key]['size']
+                del index[key]
+                if pin:
+                    os.unlink(pin.name)
+            finally:
+                if pin:
+                    pin.close()
+
+    def pin(self, key):
+        """
+        Protect an entry from eviction while it is in use.
+
+        @rtype:  file
+        @return: the pin. Close it to allow eviction again.
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        path = '%s.pin' % self.path(key)
+        while True:
+            fp = open(path, 'a')
+            fcntl.flock(fp.fileno(), fcntl.LOCK_SH)
+            # evict() may have unlinked the file before we got the lock
+            try:
+                if os.stat(path).st_ino == os.fstat(fp.fileno()).st_ino:
+                    return fp
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    fp.close()
+                    raise
+            fp.close()
+
+    def is_pinned(self, key):
+        pin = self._claim(key)
+        if pin:
+            pin.close()
+        return pin is False
+
+    def _claim(self, key):
+        """
+        Take the pin file of an entry exclusively, without waiting.
+
+        @return: the locked pin file, None if the entry has no pin file
+                 or False if the entry is pinned
+        """
+        try:
+            fp = open('%s.pin' % self.path(key), 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fp.close()
+            return False
+        return fp
+
+    def lock(self):
+        """
+        Take the cache lock.
+
+        @rtype:  file
+        @return: the lock file. Close it to release the lock.
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        fp = open(os.path.join(self.root, 'lock'), 'a')
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        return fp
+
+    def read_index(self):
+        try:
+            fp = open(os.path.join(self.root, 'index'), 'r')
+        except IOError:
+            return {}
+        try:
+            try:
+                return json.load(fp)
+            except ValueError:
+                logging.warning('Ignoring corrupt cache index in %s' % self.root)
+                return {}
+        finally:
+            fp.close()
+
+    def write_index(self, index):
+        filename = os.path.join(self.root, 'index')
+        fp = open('%s.new' % filename, 'w')
+        json.dump(index, fp, indent=1, sort_keys=True)
+        fp.close()
+        os.rename('%s.new' % filename, filename)
+
+class ChrootCache(Cache):
+    """
+    Cache of freshly bootstrapped chroots.
+
+    Entries are keyed by L{Distro.chroot_cache_key<VMBuilder.distro.Distro.chroot_cache_key>},
+    i.e. by everything that shapes the result of the bootstrap hook.
+    """
+
+    def restore(self, key, chroot_dir):
+        """
+        Copy the cached chroot for L{key} into L{chroot_dir}.
+
+        @rtype:  boolean
+        @return: True if the chroot was restored, False on a cache miss
+        """
+        pin = self.pin(key)
+        try:
+            path = self.lookup(key)
+            if not path:
+                return False
+            logging.info('Restoring bootstrapped chroot from %s' % path)
+            run_cmd('rsync', '-aHA', '%s/' % path, chroot_dir, capture=CAPTURE_TAIL)
+            return True
+        finally:
+            pin.close()
+
+    def save(self, key, chroot_dir):
+        """Add the bootstrapped chroot in L{chroot_dir} to the cache."""
+        logging.info('Adding bootstrapped chroot to cache %s' % self.root)
+        return self.store(key, lambda dest: run_cmd('rsync', '-aHA', '%s/' % chroot_dir, dest, capture=CAPTURE_TAIL))
+
+class PackageCache(Cache):
+    """
+    Host side apt archive shared between builds.
+
+    The archive directory below L{root} is bind-mounted over the guest's
+    /var/cache/apt/archives while packages are being installed, so each
+    .deb is only downloaded once. apt's own lock file lives in that
+    directory, so builds sharing the cache must serialise their apt-get
+    runs with L{lock}.
+    """
+
+    def __init__(self, root, max_size=0):
+        super(PackageCache, self).__init__(root, max_size)
+        self.archives = os.path.join(root, 'archives')
+        "The directory holding the cached packages"
+
+        self.mntpnt = None
+        "Where the archive is currently bind-mounted, if anywhere"
+
+    def mount(self, chroot_dir):
+        """Bind-mount the archive over /var/cache/apt/archives in L{chroot_dir}."""
+        if not os.path.isdir(os.path.join(self.archives, 'partial')):
+            os.makedirs(os.path.join(self.archives, 'partial'))
+        self.mntpnt = '%s/var/cache/apt/archives' % chroot_dir
+        if not os.path.isdir(self.mntpnt):
+            os.makedirs(self.mntpnt)
+        logging.debug('Mounting package cache %s on %s' % (self.archives, self.mntpnt))
+        run_cmd('mount', '--bind', self.archives, self.mntpnt)
+
+    def unmount(self):
+        """Unmount the archive and prune the cache."""
+        if not self.mntpnt:
+            return
+        run_cmd('umount', self.mntpnt)
+        self.mntpnt = None
+        lock = self.lock()
+        try:
+            self.prune()
+        finally:
+            lock.close()
+
+    def prune(self):
+        """
+        Remove the least recently used packages until the cache fits in
+        L{max_size}. Must be called with the lock held.
+        """
+        if not self.max_size:
+            return
+        debs = []
+        total = 0
+        for name in os.listdir(self.archives):
+            if not name.endswith('.deb'):
+                continue
+            path = os.path.join(self.archives, name)
+            st = os.stat(path)
+            debs.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+            total += st.st_size
+        debs.sort()
+        for (last_used, size, path) in debs:
+            if total <= self.max_size * 1024 * 1024:
+                break
+            logging.debug('Evicting %s from package cache' % os.path.basename(path))
+            os.unlink(path)
+            total -= size
+
+class Overlay(object):
+    """
+    Writable overlayfs mount on top of a read-only cache entry.
+
+    Everything written below L{mntpnt} ends up in a per-build upper
+    layer, so the cache entry itself is never copied or modified.
+
+    @type  cache: Cache
+    @param cache: The cache holding the lower layer
+    @type  key: string
+    @param key: The key of the lower layer's cache entry
+    @type  mntpnt: string
+    @param mntpnt: Where to mount the merged tree
+    @type  tmp_root: string
+    @param tmp_root: Where to create the upper layer
+    """
+
+    def __init__(self, cache, key, mntpnt, tmp_root=None):
+        self.cache = cache
+        self.key = key
+        self.mntpnt = mntpnt
+        self.tmp_root = tmp_root
+        self.scratch = None
+        "Directory holding the upper and work directories"
+        self.mounted = False
+        self._pin = None
+
+    def mount(self, populate):
+        """
+        Mount the overlay, populating the lower layer first if it isn't
+        in the cache yet.
+
+        @type  populate: callable
+        @param populate: Passed to L{Cache.store} on a cache miss
+        """
+        self._pin = self.cache.pin(self.key)
+        lower = self.cache.lookup(self.key)
+        if not lower:
+            lower = self.cache.store(self.key, populate)
+        else:
+            logging.info('Using cached chroot %s as base layer' % lower)
+
+        self.scratch = tmpdir('overlay', self.tmp_root)
+        upper = os.path.join(self.scratch, 'upper')
+        work = os.path.join(self.scratch, 'work')
+        os.mkdir(upper)
+        os.mkdir(work)
+        run_cmd('mount', '-t', 'overlay', 'overlay',
+                '-o', 'lowerdir=%s,upperdir=%s,workdir=%s' % (lower, upper, work),
+                self.mntpnt)
+        self.mounted = True
+
+    def unmount(self):
+        """Unmount the overlay and throw away the upper layer."""
+        if self.mounted:
+            run_cmd('umount', self.mntpnt)
+            self.mounted = False
+        if self.scratch:
+            run_cmd('rm', '-rf', '--one-file-system', self.scratch)
+            self.scratch = None
+        if self._pin:
+            self._pin.close()
+            self._pin = None
+
+def dir_size(path):
+    """
+    @rtype:  number
+    @return: disk usage of L{path} in megabytes (rounded up)
+    """
+    return int(run_cmd('du', '-s', '-m', '--one-file-system', path).split()[0])
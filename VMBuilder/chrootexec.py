@@ -0,0 +1,213 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Persistent executor for commands run in a chroot
+
+import cPickle
+import errno
+import fcntl
+import logging
+import os
+import resource
+import select
+import struct
+import subprocess
+import threading
+from   VMBuilder           import trace
+from   VMBuilder.exception import VMBuilderException, VMBuilderUserError
+from   VMBuilder.util      import (CAPTURE_ALL, CAPTURE_TAIL, READ_SIZE,
+                                   OutputBuffer, command_env, check_status)
+
+class ChrootExecutor(object):
+    """
+    Long-lived helper process that runs commands inside a chroot.
+
+    Running a command with C{chroot DIR COMMAND} costs a fork of the
+    orchestrator and an exec of chroot(8) before the command itself even
+    starts. The helper is forked once, small and early, and from then on
+    runs each command it is sent by forking itself and calling chroot(2)
+    on the way to exec'ing the command. The command's output is streamed
+    back over a pipe, so L{run} logs and returns it just like
+    L{run_cmd<VMBuilder.util.run_cmd>} does.
+
+    The helper itself stays outside the chroot, so it never keeps
+    anything mounted below the chroot busy, and the chroot is given with
+    each command, so it can change between commands.
+    """
+
+    def __init__(self):
+        self.pid = None
+        "The helper's process id, while it is running"
+        self._requests = None
+        self._replies = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Fork the helper."""
+        (request_r, request_w) = os.pipe()
+        (reply_r, reply_w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                # Hold on to nothing of ours, loop devices in particular
+                for fd in os.listdir('/proc/self/fd'):
+                    if int(fd) > 2 and int(fd) not in (request_r, reply_w):
+                        try:
+                            os.close(int(fd))
+                        except OSError:
+                            pass
+                serve(request_r, reply_w)
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(request_r)
+        os.close(reply_w)
+        for fd in (request_w, reply_r):
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        (self.pid, self._requests, self._replies) = (pid, request_w, reply_r)
+        logging.debug('Started chroot executor (pid %d)' % pid)
+
+    def stop(self):
+        """Let the helper finish and wait for it."""
+        if self.pid is None:
+            return
+        os.close(self._requests)
+        os.waitpid(self.pid, 0)
+        os.close(self._replies)
+        logging.debug('Stopped chroot executor (pid %d)' % self.pid)
+        (self.pid, self._requests, self._replies) = (None, None, None)
+
+    def run(self, chroot_dir, *argv, **kwargs):
+        """
+        Run a command in L{chroot_dir}, starting the helper if need be.
+
+        Takes the same keyword arguments as
+        L{run_cmd<VMBuilder.util.run_cmd>} and returns and raises the
+        same things.
+        """
+        env = kwargs.get('env', {})
+        stdin = kwargs.get('stdin', None)
+        ignore_fail = kwargs.get('ignore_fail', False)
+        capture = kwargs.get('capture', CAPTURE_ALL)
+        args = [str(arg) for arg in argv]
+        logging.debug((['chroot', chroot_dir] + args).__repr__())
+        if stdin:
+            logging.debug('stdin was set and it was a string: %s' % (stdin,))
+
+        mystdout = OutputBuffer(logfunc=logging.debug, capture=capture)
+        mystderr = OutputBuffer(logfunc=(ignore_fail and logging.debug or logging.info), capture=CAPTURE_TAIL)
+        streams = { 'out' : mystdout, 'err' : mystderr }
+        with trace.span('%s (chroot)' % args[0], 'cmd', argv=args) as span:
+            self._lock.acquire()
+            try:
+                if self.pid is None:
+                    self.start()
+                send(self._requests, (chroot_dir, args, command_env(env), stdin))
+                while True:
+                    reply = receive(self._replies)
+                    if reply is None:
+                        self.pid = None
+                        raise VMBuilderException('The chroot executor died while running %r' % (args,))
+                    if reply[0] in streams:
+                        streams[reply[0]].feed(reply[1])
+                    elif reply[0] == 'error':
+                        if reply[1] == errno.ENOENT:
+                            raise VMBuilderUserError, "Couldn't find the program '%s' in %s" % (args[0], chroot_dir)
+                        raise VMBuilderUserError, "Couldn't launch the program '%s': %s" % (args[0], reply[2])
+                    else:
+                        # The helper's children don't count as ours
+                        # until the helper is gone
+                        (status, span.children_cpu) = reply[1:]
+                        break
+            finally:
+                self._lock.release()
+            mystdout.feed('')
+            mystderr.feed('')
+            check_status(['chroot', chroot_dir] + args, status, mystdout, mystderr, ignore_fail)
+            return mystdout.buf
+
+def serve(requests, replies):
+    """
+    The helper's main loop: run the commands read from L{requests},
+    writing their output and exit status to L{replies}, until
+    L{requests} is closed.
+    """
+    while True:
+        request = receive(requests)
+        if request is None:
+            return
+        (chroot_dir, args, env, stdin) = request
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        def enter():
+            os.chroot(chroot_dir)
+            os.chdir('/')
+
+        try:
+            proc = subprocess.Popen(args, stdin=stdin and subprocess.PIPE or open('/dev/null', 'r'),
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=env, close_fds=True, preexec_fn=enter)
+        except OSError, e:
+            send(replies, ('error', e.errno, e.strerror))
+            continue
+        if stdin:
+            proc.stdin.write(stdin)
+            proc.stdin.close()
+
+        pipes = { proc.stdout.fileno() : 'out', proc.stderr.fileno() : 'err' }
+        while pipes:
+            for fd in select.select(pipes.keys(), [], [])[0]:
+                data = os.read(fd, READ_SIZE)
+                if data:
+                    send(replies, (pipes[fd], data))
+                else:
+                    del pipes[fd]
+        proc.stdout.close()
+        proc.stderr.close()
+        status = proc.wait()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        send(replies, ('exit', status,
+                       after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime))
+
+def send(fd, message):
+    data = cPickle.dumps(message, 2)
+    data = struct.pack('>I', len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+def receive(fd):
+    """
+    @rtype:  object
+    @return: the next message on L{fd}, or None if it was closed
+    """
+    header = _read(fd, 4)
+    if len(header) < 4:
+        return None
+    data = _read(fd, struct.unpack('>I', header)[0])
+    return cPickle.loads(data)
+
+def _read(fd, length):
+    chunks = []
+    while length:
+        chunk = os.read(fd, length)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
@@ -17,6 +17,7 @@
 #
 #    CLI plugin
 import logging
+import multiprocessing
 import optparse
 import os
 import pwd
@@ -24,8 +25,13 @@ import shutil
 import sys
 import tempfile
 import VMBuilder
+import VMBuilder.sparse as sparse
+import VMBuilder.trace as trace
 import VMBuilder.util as util
+from   VMBuilder.cache import ChrootCache, PackageCache
 from   VMBuilder.disk import parse_size
+from   VMBuilder.journal import Journal, get_settings, set_settings
+from   VMBuilder.stamp import InstalledSystem
 import VMBuilder.hypervisor
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
 
@@ -33,7 +39,12 @@ class CLI(object):
     arg = 'cli'
 
     def main(self):
+        if sys.argv[1:2] == ['stamp']:
+            return self.stamp(sys.argv[2:])
+
         tmpfs_mount_point = None
+        distro = None
+        trace_file = None
         try:
             optparser = optparse.OptionParser()
 
@@ -82,6 +93,92 @@ class CLI(object):
                              help="Build the chroot in directory.")
             group.add_option('--existing-chroot',
                              help="Use existing chroot.")
+            group.add_option('--chroot-cache',
+                             metavar='DIR',
+                             default='/var/cache/vmbuilder/chroots',
+                             help=('Keep bootstrapped chroots in DIR and reuse '
+                                   'them for builds with the same suite, '
+                                   'arch, variant, mirror and components '
+                                   '[default: %default]'))
+            group.add_option('--chroot-cache-size',
+                             metavar='SIZE',
+                             default='4G',
+                             help=('Evict the least recently used chroots '
+                                   'once the chroot cache grows beyond SIZE. '
+                                   '0 means unbounded [default: %default]'))
+            group.add_option('--no-chroot-cache',
+                             action='store_true',
+                             help="Always bootstrap the chroot from scratch.")
+            group.add_option('--chroot-overlay',
+                             action='store_true',
+                             help=('Mount the cached chroot read-only with a '
+                                   'per-build overlayfs layer on top instead '
+                                   'of copying it.'))
+            group.add_option('--trace',
+                             metavar='FILE',
+                             help=('Record how long each hook, plugin and '
+                                   'command takes, write it to FILE in '
+                                   'Chrome trace-event format and log a '
+                                   'summary at the end of the build.'))
+            group.add_option('--chroot-executor',
+                             action='store_true',
+                             help=('Run commands in the chroot through a '
+                                   'single long-lived helper process instead '
+                                   'of starting chroot for each of them.'))
+            group.add_option('--package-cache',
+                             metavar='DIR',
+                             default='/var/cache/vmbuilder/packages',
+                             help=('Share downloaded packages between builds '
+                                   'through DIR [default: %default]'))
+            group.add_option('--package-cache-size',
+                             metavar='SIZE',
+                             default='2G',
+                             help=('Evict the least recently used packages '
+                                   'once the package cache grows beyond SIZE. '
+                                   '0 means unbounded [default: %default]'))
+            group.add_option('--no-package-cache',
+                             action='store_true',
+                             help="Download all packages afresh for every build.")
+            group.add_option('--journal',
+                             metavar='FILE',
+                             help=('Record each completed build stage in FILE, '
+                                   'so that a failed build can be picked up '
+                                   'again with --resume. Removed once the build '
+                                   'succeeds [default: DESTDIR.journal]'))
+            group.add_option('--resume',
+                             metavar='FILE',
+                             help=('Resume the failed build recorded in journal '
+                                   'FILE, skipping the stages it completed. '
+                                   'Pass the same options as to the failed '
+                                   'build.'))
+            group.add_option('--convert-jobs',
+                             metavar='N',
+                             type='int',
+                             default=multiprocessing.cpu_count(),
+                             help=('Convert up to N disk images at the same '
+                                   'time [default: %default]'))
+            group.add_option('--mkfs-jobs',
+                             metavar='N',
+                             type='int',
+                             default=multiprocessing.cpu_count(),
+                             help=('Create up to N filesystems at the same '
+                                   'time [default: %default]'))
+            group.add_option('--image-allocation',
+                             type='choice',
+                             choices=[VMBuilder.disk.ALLOC_SPARSE,
+                                      VMBuilder.disk.ALLOC_FULL],
+                             default=VMBuilder.disk.ALLOC_SPARSE,
+                             help=('Create raw images sparse, or with all '
+                                   'their space allocated up front (full), '
+                                   'which keeps them from fragmenting '
+                                   '[default: %default]'))
+            group.add_option('--uuid-seed',
+                             metavar='SEED',
+                             help=('Derive the filesystem UUIDs and the '
+                                   'disk and partition IDs from SEED '
+                                   'instead of making up random ones, so '
+                                   'that rebuilding with the same SEED gives '
+                                   'the same IDs.'))
             group.add_option('--tmp',
                              '-t',
                              metavar='DIR',
@@ -160,8 +257,6 @@ class CLI(object):
 
             hypervisor.register_hook('fix_ownership', self.fix_ownership)
 
-            config_files = ['/etc/vmbuilder.cfg',
-                            os.path.expanduser('~/.vmbuilder.cfg')]
             (self.options, args) = optparser.parse_args(sys.argv[2:])
 
             if os.geteuid() != 0:
@@ -172,7 +267,15 @@ class CLI(object):
 
             logging.debug("Launch directory: {}".format(os.getcwd()))
 
+            if self.options.trace:
+                trace_file = self.options.trace
+                trace.enable()
             distro.overwrite = hypervisor.overwrite = self.options.overwrite
+            distro.use_chroot_executor = self.options.chroot_executor
+            hypervisor.convert_jobs = self.options.convert_jobs
+            hypervisor.mkfs_jobs = self.options.mkfs_jobs
+            hypervisor.image_allocation = self.options.image_allocation
+            hypervisor.uuid_seed = self.options.uuid_seed
             destdir = self.options.destdir or ('%s-%s' % (distro.arg,
                                                           hypervisor.arg))
             logging.debug("Output destdir: {}".format(destdir))
@@ -180,7 +283,18 @@ class CLI(object):
             if self.options.tmpfs and self.options.chroot_dir:
                 raise VMBuilderUserError('--chroot-dir and --tmpfs can not be used together.')
 
-            if os.path.exists(destdir):
+            if self.options.chroot_overlay:
+                if self.options.no_chroot_cache:
+                    raise VMBuilderUserError('--chroot-overlay needs the chroot cache. It can not be used together with --no-chroot-cache.')
+                if self.options.only_chroot:
+                    raise VMBuilderUserError('--chroot-overlay and --only-chroot can not be used together.')
+
+            journal = Journal(self.options.resume or self.options.journal or
+                              '%s.journal' % destdir)
+            if self.options.resume:
+                journal.load()
+
+            if os.path.exists(destdir) and not journal.done('install_os'):
                 if os.path.realpath(destdir) == os.getcwd():
                     raise VMBuilderUserError('Current working directory cannot be used as a destination directory')
                 if self.options.overwrite:
@@ -190,36 +304,34 @@ class CLI(object):
                 else:
                     raise VMBuilderUserError('%s already exists' % destdir)
 
-            if self.options.config:
-                config_files.append(self.options.config)
-            util.apply_config_files_to_context(config_files, distro)
-            util.apply_config_files_to_context(config_files, hypervisor)
-
-            if self.options.templates:
-                distro.template_dirs.insert(0, '%s/%%s'
-                                                   % self.options.templates)
-                hypervisor.template_dirs.insert(0, '%s/%%s'
-                                                   % self.options.templates)
-
-            for option in dir(self.options):
-                if option.startswith('_') or option in ['ensure_value',
-                                                        'read_module',
-                                                        'read_file']:
-                    continue
-                val = getattr(self.options, option)
-                option = option.replace('_', '-')
-                if val:
-                    if (distro.has_setting(option) and
-                        distro.get_setting_default(option) != val):
-                        distro.set_setting_fuzzy(option, val)
-                    elif (hypervisor.has_setting(option) and
-                          hypervisor.get_setting_default(option) != val):
-                        hypervisor.set_setting_fuzzy(option, val)
+            self.apply_settings(distro, hypervisor)
+
+            if self.options.resume:
+                set_settings(distro, journal.state['settings']['distro'])
+                set_settings(hypervisor, journal.state['settings']['hypervisor'])
+
+            if not self.options.no_package_cache:
+                distro.package_cache = PackageCache(
+                    self.options.package_cache,
+                    parse_size(self.options.package_cache_size))
 
             chroot_dir = None
-            if self.options.existing_chroot:
+            resume_chroot = journal.state.get('chroot_dir')
+            if journal.done('install_os'):
+                # The chroot has served its purpose already
+                distro.resume()
+                chroot_dir = resume_chroot
+            elif self.options.existing_chroot:
                 distro.set_chroot_dir(self.options.existing_chroot)
                 distro.call_hooks('preflight_check')
+                resume_chroot = None
+            elif (journal.done('configure_os') and resume_chroot and
+                  os.path.isdir(resume_chroot)):
+                logging.info('Reusing configured chroot %s' % resume_chroot)
+                distro.set_chroot_dir(resume_chroot)
+                distro.resume()
+                distro.mark_packages_applied(journal.state['applied_packages'])
+                chroot_dir = resume_chroot
             else:
                 if self.options.tmpfs is not None:
                     if str(self.options.tmpfs) == '-':
@@ -235,18 +347,56 @@ class CLI(object):
                 else:
                     chroot_dir = util.tmpdir(tmp_root=self.options.tmp_root)
                 distro.set_chroot_dir(chroot_dir)
+                if not self.options.no_chroot_cache:
+                    distro.chroot_cache = ChrootCache(
+                        self.options.chroot_cache,
+                        parse_size(self.options.chroot_cache_size))
+                    distro.use_chroot_overlay = self.options.chroot_overlay
                 distro.build_chroot()
+                hypervisor.owns_chroot = True
+                if (tmpfs_mount_point is None and
+                    not self.options.chroot_overlay):
+                    # Only a plain directory outlives a failed build
+                    resume_chroot = chroot_dir
+                else:
+                    resume_chroot = None
 
             if self.options.only_chroot:
                 print 'Chroot can be found in %s' % distro.chroot_dir
                 sys.exit(0)
 
-            self.set_disk_layout(optparser, hypervisor)
-            hypervisor.install_os()
+            if not journal.done('install_os'):
+                journal.record('configure_os',
+                               chroot_dir=resume_chroot,
+                               applied_packages=distro.applied_packages(),
+                               settings={ 'distro' : get_settings(distro),
+                                          'hypervisor' : get_settings(hypervisor) })
+                logging.info('Build journal written to %s. If the build '
+                             'fails, it can be resumed with --resume %s'
+                             % (journal.filename, journal.filename))
 
-            os.mkdir(destdir)
-            self.fix_ownership(destdir)
-            hypervisor.finalise(destdir)
+            self.set_disk_layout(optparser, hypervisor)
+            if journal.done('install_os'):
+                hypervisor.set_image_state(journal.state['images'])
+                hypervisor.call_hooks('preflight_check')
+            else:
+                if hypervisor.can_populate_filesystems():
+                    # install_os is about to finish the chroot in place,
+                    # so a resumed build can't start over from it
+                    journal.record('configure_os', chroot_dir=None)
+                hypervisor.install_os()
+                distro.release_chroot()
+                journal.record('install_os', images=hypervisor.get_image_state())
+
+            if not journal.done('convert'):
+                # A failed conversion may have left destdir behind
+                if not os.path.isdir(destdir):
+                    os.mkdir(destdir)
+                self.fix_ownership(destdir)
+                hypervisor.convert_images(destdir)
+                journal.record('convert', images=hypervisor.get_image_state())
+            hypervisor.call_hooks('deploy', destdir)
+            journal.remove()
             # If chroot_dir is not None, it means we created it,
             # and if we reach here, it means the user didn't pass
             # --only-chroot. Hence, we need to remove it to clean
@@ -257,9 +407,183 @@ class CLI(object):
             logging.error(e)
             raise
         finally:
+            if distro is not None:
+                distro.release_chroot()
             if tmpfs_mount_point is not None:
                 util.clean_up_tmpfs(tmpfs_mount_point)
                 util.run_cmd('rmdir', tmpfs_mount_point)
+            if trace_file:
+                trace.finish(trace_file)
+
+    def stamp(self, argv):
+        """
+        Give prebuilt raw disk images the identity of a new vm, without
+        building it: only the hooks that set the host name, network
+        configuration, initial user, ssh keys and first boot scripts
+        are run, against a copy of the images.
+        """
+        distro = None
+        system = None
+        mntdir = None
+        copies = []
+        try:
+            optparser = optparse.OptionParser()
+            optparser.set_usage('%prog stamp hypervisor distro image... [options]')
+
+            group = optparse.OptionGroup(optparser, 'Stamp options')
+            group.add_option('--debug',
+                             action='callback',
+                             callback=self.set_verbosity,
+                             help='Show debug information')
+            group.add_option('--verbose',
+                             '-v',
+                             action='callback',
+                             callback=self.set_verbosity,
+                             help='Show progress information')
+            group.add_option('--quiet',
+                             '-q',
+                             action='callback',
+                             callback=self.set_verbosity,
+                             help='Silent operation')
+            group.add_option('--overwrite',
+                             '-o',
+                             action='store_true',
+                             help='Remove destination directory before starting')
+            group.add_option('--config',
+                             '-c',
+                             type='str',
+                             help='Configuration file')
+            group.add_option('--templates',
+                             metavar='DIR',
+                             help='Prepend DIR to template search path.')
+            group.add_option('--destdir',
+                             '-d',
+                             type='str',
+                             help='Destination directory')
+            group.add_option('--overlay',
+                             action='store_true',
+                             help=('Write the disks as qcow2 overlays of the '
+                                   'images rather than as full copies. The '
+                                   'images must then be kept where they are.'))
+            group.add_option('--tmp',
+                             '-t',
+                             metavar='DIR',
+                             dest='tmp_root',
+                             default=tempfile.gettempdir(),
+                             help=('Use TMP as temporary working space '
+                                   '[default: %default]'))
+            optparser.add_option_group(group)
+
+            optparser.disable_interspersed_args()
+            (dummy, args) = optparser.parse_args(argv)
+            optparser.enable_interspersed_args()
+
+            hypervisor, distro = self.handle_args(optparser, args)
+
+            self.add_settings_from_context(optparser, distro)
+            self.add_settings_from_context(optparser, hypervisor)
+
+            hypervisor.register_hook('fix_ownership', self.fix_ownership)
+
+            (self.options, images) = optparser.parse_args(argv[2:])
+            if not images:
+                optparser.error('You need to specify the disk images to stamp')
+
+            if os.geteuid() != 0:
+                raise VMBuilderUserError('Must run as root')
+
+            if hypervisor.preferred_storage != VMBuilder.hypervisor.STORAGE_DISK_IMAGE:
+                raise VMBuilderUserError('Only hypervisors using disk images can be stamped.')
+            if self.options.overlay and getattr(hypervisor, 'filetype', None) != 'qcow2':
+                raise VMBuilderUserError('--overlay needs a hypervisor with qcow2 disks.')
+
+            distro.overwrite = hypervisor.overwrite = self.options.overwrite
+            destdir = self.options.destdir or ('%s-%s' % (distro.arg,
+                                                          hypervisor.arg))
+            if os.path.exists(destdir):
+                if self.options.overwrite:
+                    shutil.rmtree(destdir)
+                else:
+                    raise VMBuilderUserError('%s already exists' % destdir)
+
+            self.apply_settings(distro, hypervisor)
+            distro.call_hooks('preflight_check')
+            hypervisor.call_hooks('preflight_check')
+
+            for image in images:
+                fp = open(image, 'rb')
+                magic = fp.read(4)
+                fp.close()
+                if magic == 'QFI\xfb':
+                    raise VMBuilderUserError('%s is a qcow2 image. Only raw images, such as the base images kept by --base-image-cache, can be stamped.' % image)
+                copy = util.tmp_filename(tmp_root=self.options.tmp_root)
+                logging.info('Copying %s to %s' % (image, copy))
+                sparse.copy(image, copy)
+                copies.append(copy)
+                disk = hypervisor.add_disk(filename=copy)
+                # Unlike a disk the user handed us, the copy is ours to convert
+                disk.preallocated = False
+                if self.options.overlay:
+                    disk.backing_file = os.path.abspath(image)
+
+            mntdir = util.tmpdir(tmp_root=self.options.tmp_root)
+            system = InstalledSystem(copies)
+            system.mount(mntdir)
+            distro.set_chroot_dir(mntdir)
+            hypervisor.stamp()
+            system.umount()
+            system = None
+
+            os.mkdir(destdir)
+            self.fix_ownership(destdir)
+            hypervisor.convert_images(destdir)
+            hypervisor.call_hooks('deploy', destdir)
+        except VMBuilderException, e:
+            logging.error(e)
+            raise
+        finally:
+            if distro is not None:
+                distro.cleanup()
+            if system is not None:
+                system.umount()
+            if mntdir is not None:
+                os.rmdir(mntdir)
+            for copy in copies:
+                if os.path.exists(copy):
+                    os.unlink(copy)
+
+    def apply_settings(self, distro, hypervisor):
+        """
+        Apply the config files, the template directory and the settings
+        given on the command line to L{distro} and L{hypervisor}.
+        """
+        config_files = ['/etc/vmbuilder.cfg',
+                        os.path.expanduser('~/.vmbuilder.cfg')]
+        if self.options.config:
+            config_files.append(self.options.config)
+        util.apply_config_files_to_context(config_files, distro)
+        util.apply_config_files_to_context(config_files, hypervisor)
+
+        if self.options.templates:
+            distro.template_dirs.insert(0, '%s/%%s'
+                                               % self.options.templates)
+            hypervisor.template_dirs.insert(0, '%s/%%s'
+                                               % self.options.templates)
+
+        for option in dir(self.options):
+            if option.startswith('_') or option in ['ensure_value',
+                                                    'read_module',
+                                                    'read_file']:
+                continue
+            val = getattr(self.options, option)
+            option = option.replace('_', '-')
+            if val:
+                if (distro.has_setting(option) and
+                    distro.get_setting_default(option) != val):
+                    distro.set_setting_fuzzy(option, val)
+                elif (hypervisor.has_setting(option) and
+                      hypervisor.get_setting_default(option) != val):
+                    hypervisor.set_setting_fuzzy(option, val)
 
     def fix_ownership(self, filename):
         """
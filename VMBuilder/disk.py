@@ -18,6 +18,9 @@
 #
 #    Virtual disk management
 
+import ctypes
+import ctypes.util
+import errno
 import fcntl
 import logging
 import os
@@ -25,10 +28,15 @@ import os.path
 import re
 import stat
 import string
-import time
-from   VMBuilder.util      import run_cmd
+import subprocess
+import uuid
+import VMBuilder.parttable as parttable
+import VMBuilder.qcow2 as qcow2
+import VMBuilder.vmdk as vmdk
+from   VMBuilder.loop      import LoopDevice
+from   VMBuilder.util      import run_cmd, run_parallel, umount
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
-from   struct              import unpack
+from   struct              import pack, unpack
 
 TYPE_EXT2 = 0
 TYPE_EXT3 = 1
@@ -36,6 +44,19 @@ TYPE_XFS = 2
 TYPE_SWAP = 3
 TYPE_EXT4 = 4
 
+# From <linux/fs.h>: _IOWR('X', 121, struct fstrim_range)
+FITRIM = 0xc0185879
+# From <linux/fs.h>: _IO(0x12, 119)
+BLKDISCARD = 0x1277
+
+ALLOC_SPARSE = 'sparse'
+"Image allocation policy: leave the whole image a hole"
+ALLOC_FULL = 'full'
+"Image allocation policy: reserve all of the image's blocks up front"
+
+UUID_NAMESPACE = uuid.UUID('5f0d5d5e-7c1b-5a37-9a3c-1f7c3c6b2f4e')
+"Namespace of the filesystem UUIDs derived from a seed, see L{new_uuid}"
+
 class Disk(object):
     """
     Virtual disk.
@@ -67,6 +88,9 @@ class Disk(object):
         self.size = 0
         "The size of the disk. For preallocated disks, this is detected."
 
+        self.backing_file = None
+        "Raw base image to write the disk as a qcow2 overlay of when converting it."
+
         if not os.path.exists(self.filename):
             if not size:
                 raise VMBuilderUserError('%s does not exist, but no size was given.' % (self.filename))
@@ -80,6 +104,9 @@ class Disk(object):
         self.format_type = None
         "The format type of the disks. Only used for converted disks."
 
+        self.label = 'msdos'
+        "The type of partition table to write: msdos or gpt."
+
     def devletters(self):
         """
         @rtype: string
@@ -99,7 +126,12 @@ class Disk(object):
         """
         if not os.path.exists(self.filename):
             logging.info('Creating disk image: "%s" of size: %dMB' % (self.filename, self.size))
-            run_cmd(qemu_img_path(), 'create', '-f', 'raw', self.filename, '%dM' % self.size)
+            allocate(self.filename, self.size * 1024 * 1024, self.vm.image_allocation)
+        elif stat.S_ISBLK(os.stat(self.filename).st_mode):
+            # Whatever is on it is about to be overwritten. Tell thin
+            # provisioned storage and SSDs that they can let go of it.
+            if discard_device(self.filename):
+                logging.info('Discarded the contents of %s' % self.filename)
 
     def partition(self):
         """
@@ -109,46 +141,46 @@ class Disk(object):
         Should only be called once and only after you've added all partitions.
         """
 
-        logging.info('Adding partition table to disk image: %s' % self.filename)
-        run_cmd('parted', '--script', self.filename, 'mklabel', 'msdos')
-
-        # Partition the disk
-        for part in self.partitions:
-            part.create(self)
+        logging.info('Adding %s partition table to disk image: %s' % (self.label, self.filename))
+        reserved = self.label == 'gpt' and parttable.GPT_BACKUP_SIZE or 0
+        offsets = parttable.layout([(part.begin, part.end) for part in self.partitions],
+                                   self.size * 1024 * 1024, reserved)
+        for (part, (offset, length)) in zip(self.partitions, offsets):
+            part.offset = offset
+            part.length = length
+
+        def new_id(name):
+            return new_uuid(self.vm.uuid_seed, 'disk-%s/%s' % (self.devletters(), name))
+        if self.label == 'gpt':
+            parttable.write_gpt(self.filename, [(part.offset, part.length, part.gpt_type())
+                                                for part in self.partitions], new_id)
+        else:
+            parttable.write_msdos(self.filename, [(part.offset, part.length, part.msdos_type())
+                                                  for part in self.partitions], new_id)
 
     def map_partitions(self):
         """
         Create loop devices corresponding to the partitions.
 
-        Once this has returned succesfully, each partition's map device
+        Once this has returned succesfully, each partition's loop device
         is set as its L{filename<Disk.Partition.filename>} attribute.
 
         Call this after L{partition}.
         """
         logging.info('Creating loop devices corresponding to the created partitions')
         self.vm.add_clean_cb(lambda : self.unmap(ignore_fail=True))
-        kpartx_output = run_cmd('kpartx', '-asv', self.filename)
-        parts = []
-        for line in kpartx_output.split('\n'):
-            if line == "" or line.startswith("gpt:") or line.startswith("dos:"):
-                continue
-            if line.startswith("add"):
-                parts.append(line)
-                continue
-            logging.error('Skipping unknown line in kpartx output (%s)' % line)
-        mapdevs = []
-        for line in parts:
-            mapdevs.append(line.split(' ')[2])
-        for (part, mapdev) in zip(self.partitions, mapdevs):
-            part.set_filename('/dev/mapper/%s' % mapdev)
+        for part in self.partitions:
+            part.loop = LoopDevice(self.filename, part.offset, part.length)
+            part.set_filename(part.loop.attach())
 
     def mkfs(self):
         """
-        Creates the partitions' filesystems
+        Creates the partitions' filesystems, up to the vm's
+        L{mkfs_jobs<VMBuilder.hypervisor.Hypervisor.mkfs_jobs>} at a time.
+        Call this after L{map_partitions}.
         """
         logging.info("Creating file systems")
-        for part in self.partitions:
-            part.mkfs()
+        run_parallel(lambda part: part.mkfs(), self.partitions, self.vm.mkfs_jobs, collect=True)
 
     def get_grub_id(self):
         """
@@ -170,33 +202,10 @@ class Disk(object):
 
         Unsets L{Partition}s' and L{Filesystem}s' filename attribute
         """
-        # first sleep to give the loopback devices a chance to settle down
-        time.sleep(3)
-
-        tries = 0
-        max_tries = 3
-        while tries < max_tries:
-            try:
-                run_cmd('kpartx', '-d', self.filename, ignore_fail=False)
-                break
-            except:
-                pass
-            tries += 1
-            time.sleep(3)
-
-            if tries >= max_tries:
-                # try it one last time
-                logging.info("Could not unmap '%s' after '%d' attempts. Final attempt" % (self.filename, tries))
-        run_cmd('kpartx', '-d', self.filename, ignore_fail=ignore_fail)
-
         for part in self.partitions:
-            logging.debug("Removing partition %s" % part.filename)
-            parted_oldmap=part.filename[len("/dev/mapper/"):-1]+"p"+part.filename[-1]
-            dmsetup_output = run_cmd('dmsetup', 'info', parted_oldmap, ignore_fail=True)
-            for line in dmsetup_output.split('\n'):
-                if line.startswith("State:") and line.endswith("ACTIVE"):
-                    logging.debug("Removing parted old map with  'dmsetup remove %s'" % parted_oldmap)
-                    dmsetup_output=run_cmd('dmsetup', 'remove', parted_oldmap, ignore_fail=ignore_fail)
+            if part.loop:
+                part.loop.detach(ignore_fail=ignore_fail)
+                part.loop = None
             part.set_filename(None)
 
     def add_part(self, begin, length, type, mntpnt):
@@ -224,10 +233,10 @@ class Disk(object):
         part = self.Partition(disk=self, begin=begin, end=end, type=str_to_type(type), mntpnt=mntpnt)
         self.partitions.append(part)
 
-        # We always keep the partitions in order, so that the output from kpartx matches our understanding
+        # We always keep the partitions in order, so that they are numbered the way the guest sees them
         self.partitions.sort(cmp=lambda x,y: x.begin - y.begin)
 
-    def convert(self, destdir, format):
+    def convert(self, destdir, format, compress_level=None, compress_jobs=1):
         """
         Convert the disk image
 
@@ -235,6 +244,12 @@ class Disk(object):
         @param destdir: Target location of converted disk image
         @type  format: string
         @param format: The target format (as understood by qemu-img or vdi)
+        @type  compress_level: number
+        @param compress_level: zlib compression level (1-9) to write a
+            compressed qcow2 or streamOptimized vmdk image with, or None
+            to write an uncompressed one
+        @type  compress_jobs: number
+        @param compress_jobs: Number of processes to compress in
         @rtype:  string
         @return: the name of the converted image
         """
@@ -247,9 +262,24 @@ class Disk(object):
             filename = filename[:filename.rindex('.')]
         destfile = '%s/%s.%s' % (destdir, filename, format)
 
+        if self.backing_file and format != 'qcow2':
+            raise VMBuilderUserError('Only qcow2 images can be written as overlays of a base image')
+        if compress_level is not None:
+            if format not in ['qcow2', 'vmdk']:
+                raise VMBuilderUserError('Compressed output is not supported for %s images' % format)
+            if not 1 <= compress_level <= 9:
+                raise VMBuilderUserError('Compression level must be between 1 and 9, not %d' % compress_level)
+
         logging.info('Converting %s to %s, format %s' % (self.filename, format, destfile))
         if format == 'vdi':
             run_cmd(vbox_manager_path(), 'convertfromraw', '-format', 'VDI', self.filename, destfile)
+        elif format == 'qcow2' and self.backing_file:
+            qcow2.write_overlay(self.filename, self.backing_file, destfile,
+                                compress_level=compress_level, jobs=compress_jobs)
+        elif format == 'qcow2':
+            qcow2.convert(self.filename, destfile, compress_level=compress_level, jobs=compress_jobs)
+        elif format == 'vmdk' and compress_level is not None:
+            vmdk.convert(self.filename, destfile, compress_level, compress_jobs)
         else:
             run_cmd(qemu_img_path(), 'convert', '-O', format, self.filename, destfile)
         os.unlink(self.filename)
@@ -277,32 +307,42 @@ class Disk(object):
             self.filename = None
             "The filename of this partition (the map device)"
 
+            self.offset = None
+            "Where the partition starts on the disk, in bytes. Set by L{Disk.partition}."
+
+            self.length = None
+            "The size of the partition in bytes. Set by L{Disk.partition}."
+
+            self.loop = None
+            "The L{LoopDevice} mapping the partition, while it is mapped"
+
             self.fs = Filesystem(vm=self.disk.vm, type=self.type, mntpnt=self.mntpnt)
             "The enclosed filesystem"
 
+        def __repr__(self):
+            return '<Partition %s of %s>' % (self.mntpnt or self.get_index() + 1, self.disk.filename)
+
         def set_filename(self, filename):
             self.filename = filename
             self.fs.filename = filename
 
-        def parted_fstype(self):
+        def msdos_type(self):
             """
-            @rtype: string
-            @return: the filesystem type of the partition suitable for passing to parted
+            @rtype: number
+            @return: the partition's system id in an msdos partition table
             """
-            return { TYPE_EXT2: 'ext2', TYPE_EXT3: 'ext2', TYPE_EXT4: 'ext2', TYPE_XFS: 'ext2', TYPE_SWAP: 'linux-swap(new)' }[self.type]
+            return self.type == TYPE_SWAP and parttable.MSDOS_SWAP or parttable.MSDOS_LINUX
 
-        def create(self, disk):
-            """Adds partition to the disk image (does not mkfs or anything like that)"""
-            logging.info('Adding type %d partition to disk image: %s' % (self.type, disk.filename))
-            if self.begin == 0:
-                logging.info('Partition at beginning of disk - reserving first cylinder')
-                partition_start = "63s"
-            else:
-                partition_start = self.begin
-            run_cmd('parted', '--script', '--', disk.filename, 'mkpart', 'primary', self.parted_fstype(), partition_start, self.end)
+        def gpt_type(self):
+            """
+            @rtype: UUID
+            @return: the partition's type in a gpt partition table
+            """
+            return self.type == TYPE_SWAP and parttable.GPT_SWAP or parttable.GPT_LINUX
 
         def mkfs(self):
             """Adds Filesystem object"""
+            self.fs.set_uuid('disk%d/part%d' % (self.disk.get_index(), self.get_index()))
             self.fs.mkfs()
 
         def get_grub_id(self):
@@ -361,7 +401,19 @@ class Filesystem(object):
         self.preallocated = False
         "Whether the file existed already (True if it did, False if we had to create it)."
 
-    def create(self):
+        self.uuid = None
+        "The filesystem's UUID, handed to mkfs. Made up by L{set_uuid}."
+
+    def __repr__(self):
+        return '<Filesystem %s>' % (self.mntpnt or self.filename)
+
+    def create(self, populate=None, mkfs=True):
+        """
+        @type  populate: string
+        @param populate: Directory to copy into the new filesystem. See L{mkfs}.
+        @type  mkfs: boolean
+        @param mkfs: Whether to create the filesystem, too, or just the image
+        """
         logging.info('Creating filesystem: %s, size: %d, dummy: %s' % (self.mntpnt, self.size, repr(self.dummy)))
         if not os.path.exists(self.filename):
             logging.info('Not preallocated, so we create it.')
@@ -381,21 +433,44 @@ class Filesystem(object):
                     self.filename += '_'
                 self.filename += '.img'
                 logging.info('A name wasn\'t specified either, so we make one up: %s' % self.filename)
-            run_cmd(qemu_img_path(), 'create', '-f', 'raw', self.filename, '%dM' % self.size)
-        self.mkfs()
+            allocate(self.filename, self.size * 1024 * 1024, self.vm.image_allocation)
+        if mkfs:
+            self.mkfs(populate)
 
-    def mkfs(self):
+    def mkfs(self, populate=None):
+        """
+        @type  populate: string
+        @param populate: Directory to copy into the new filesystem while
+                         it is being created (ext filesystems only, see
+                         L{mke2fs_can_populate}).
+        """
         if not self.filename:
             raise VMBuilderException('We can\'t mkfs if filename is not set. Did you forget to call .create()?')
         if not self.dummy:
-            cmd = self.mkfs_fstype() + [self.filename]
-            run_cmd(*cmd)
-            # Let udev have a chance to extract the UUID for us
-            run_cmd('udevadm', 'settle')
-            if os.path.exists("/sbin/vol_id"):
-                self.uuid = run_cmd('vol_id', '--uuid', self.filename).rstrip()
-            elif os.path.exists("/sbin/blkid"):
-                self.uuid = run_cmd('blkid', '-c', '/dev/null', '-sUUID', '-ovalue', self.filename).rstrip()
+            self.set_uuid()
+            cmd = self.mkfs_fstype()
+            if self.type == TYPE_XFS:
+                cmd += ['-m', 'uuid=%s' % self.uuid]
+            else:
+                cmd += ['-U', self.uuid]
+            if populate:
+                if self.type not in (TYPE_EXT2, TYPE_EXT3, TYPE_EXT4):
+                    raise VMBuilderException('Only ext filesystems can be populated while they are being created')
+                logging.info('Populating %s from %s' % (self.filename, populate))
+                cmd += ['-d', populate]
+            run_cmd(*(cmd + [self.filename]))
+
+    def set_uuid(self, name=None):
+        """
+        Make up the filesystem's UUID, unless it has one already.
+
+        @type  name: string
+        @param name: Identifies the filesystem within the vm when
+            deriving the UUID from the vm's seed (see L{new_uuid}).
+            Defaults to its place among the vm's filesystem images.
+        """
+        if not self.uuid:
+            self.uuid = new_uuid(self.vm.uuid_seed, name or 'fs%d' % self.get_index())
 
     def mkfs_fstype(self):
         map = { TYPE_EXT2: ['mkfs.ext2', '-F'], TYPE_EXT3: ['mkfs.ext3', '-F'], TYPE_EXT4: ['mkfs.ext4', '-F'], TYPE_XFS: ['mkfs.xfs'], TYPE_SWAP: ['mkswap'] }
@@ -424,7 +499,19 @@ class Filesystem(object):
         self.vm.cancel_cleanup(self.umount)
         if (self.type != TYPE_SWAP) and not self.dummy:
             logging.debug('Unmounting %s', self.mntpath)
-            run_cmd('umount', self.mntpath)
+            umount(self.mntpath)
+
+    def trim(self):
+        """
+        Discard the blocks the mounted filesystem doesn't use. See
+        L{discard_unused}.
+        """
+        if (self.type != TYPE_SWAP) and not self.dummy:
+            trimmed = discard_unused(self.mntpath)
+            if trimmed is None:
+                logging.debug('%s does not support discarding unused blocks' % self.mntpnt)
+            else:
+                logging.debug('Discarded %dMB of unused blocks on %s' % (trimmed / 1024 / 1024, self.mntpnt))
 
     def get_suffix(self):
         """Returns 'a4' for a device that would be called /dev/sda4 in the guest..
@@ -455,6 +542,114 @@ class Filesystem(object):
         except ValueError:
             self.type = str_to_type(type)
 
+_mke2fs_can_populate = None
+
+def mke2fs_can_populate():
+    """
+    @rtype:  boolean
+    @return: whether mke2fs supports -d (e2fsprogs 1.43 and later)
+    """
+    global _mke2fs_can_populate
+    if _mke2fs_can_populate is None:
+        try:
+            proc = subprocess.Popen(['mke2fs'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            usage = proc.communicate()[1]
+            _mke2fs_can_populate = '-d root-directory' in usage
+        except OSError:
+            _mke2fs_can_populate = False
+    return _mke2fs_can_populate
+
+def new_uuid(seed=None, name=None):
+    """
+    @type  seed: string
+    @param seed: Seed of the build, or None
+    @type  name: string
+    @param name: What the UUID is for, unique within the build
+    @rtype:  string
+    @return: a random UUID, or with a L{seed}, one derived from L{seed}
+             and L{name}, so that builds with the same seed get the
+             same UUIDs
+    """
+    if seed is None:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(UUID_NAMESPACE, '%s/%s' % (seed, name)))
+
+def allocate(filename, size, policy=ALLOC_SPARSE):
+    """
+    Create a raw image.
+
+    @type  filename: string
+    @param filename: The image to create
+    @type  size: number
+    @param size: Size of the image in bytes
+    @type  policy: string
+    @param policy: L{ALLOC_SPARSE} to leave the image a hole that fills
+        up as it is written to, or L{ALLOC_FULL} to reserve all of its
+        blocks right away, contiguously where the filesystem can, so the
+        image doesn't fragment while it is being filled
+    """
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    try:
+        os.ftruncate(fd, size)
+        if policy == ALLOC_FULL:
+            # Returns the error rather than setting errno
+            err = _libc().posix_fallocate64(fd, ctypes.c_longlong(0), ctypes.c_longlong(size))
+            if err:
+                raise VMBuilderException('Could not allocate %s: %s' % (filename, os.strerror(err)))
+    finally:
+        os.close(fd)
+
+def discard_device(filename):
+    """
+    Discard all blocks of a block device.
+
+    @rtype:  boolean
+    @return: whether the device supports discarding
+    """
+    size = detect_size(filename)
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        try:
+            fcntl.ioctl(fd, BLKDISCARD, pack('QQ', 0, size))
+        except IOError, e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                return False
+            raise
+        return True
+    finally:
+        os.close(fd)
+
+_libc_handle = None
+
+def _libc():
+    global _libc_handle
+    if _libc_handle is None:
+        _libc_handle = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc_handle
+
+def discard_unused(path):
+    """
+    Discard the unused blocks of the filesystem mounted at L{path}, like
+    fstrim does. On a loop device this punches holes into the image
+    behind it, so the blocks of deleted files read back as zeros and
+    take no space.
+
+    @rtype:  number
+    @return: the number of bytes discarded, or None if the filesystem
+             or the device underneath doesn't support discarding
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            result = fcntl.ioctl(fd, FITRIM, pack('QQQ', 0, 0xffffffffffffffff, 0))
+        except IOError, e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                return None
+            raise
+        return unpack('QQQ', result)[1]
+    finally:
+        os.close(fd)
+
 def parse_size(size_str):
     """Takes a size like qemu-img would accept it and returns the size in MB"""
     try:
@@ -555,13 +750,19 @@ def detect_size(filename):
 
     raise VMBuilderException('No idea how to find the size of %s' % filename)
 
+_qemu_img_path = None
+
 def qemu_img_path():
-    exes = ['kvm-img', 'qemu-img']
-    for dir in os.environ['PATH'].split(os.path.pathsep):
-        for exe in exes:
-            path = '%s%s%s' % (dir, os.path.sep, exe)
-            if os.access(path, os.X_OK):
-                return path
+    global _qemu_img_path
+    if _qemu_img_path is None:
+        exes = ['kvm-img', 'qemu-img']
+        for dir in os.environ['PATH'].split(os.path.pathsep):
+            for exe in exes:
+                path = '%s%s%s' % (dir, os.path.sep, exe)
+                if os.access(path, os.X_OK):
+                    _qemu_img_path = path
+                    return path
+    return _qemu_img_path
 
 def vbox_manager_path():
     exe = 'VBoxManage'
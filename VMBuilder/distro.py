@@ -18,9 +18,12 @@
 #
 #    Distro super class
 
+import hashlib
 import logging
 import os
 
+from   VMBuilder.cache   import Overlay
+from   VMBuilder.chrootexec import ChrootExecutor
 from   VMBuilder.util    import run_cmd, call_hooks
 import VMBuilder.plugins
 
@@ -32,6 +35,7 @@ class Context(VMBuilder.plugins.Plugin):
         self.plugins.sort(key=lambda x:x.priority)
         self._cleanup_cbs = []
         self.hooks = {}
+        self._hook_tables = {}
         self.skipped_hooks = []
         self.template_dirs = [os.path.expanduser('~/.vmbuilder/%s'),
                               os.path.dirname(__file__) + '/plugins/%s/templates',
@@ -62,6 +66,7 @@ class Context(VMBuilder.plugins.Plugin):
     # Hooks
     def register_hook(self, hook_name, func):
         self.hooks[hook_name] = self.hooks.get(hook_name, []) + [func]
+        self._hook_tables = {}
 
     def call_hooks(self, name, *args, **kwargs):
         try:
@@ -72,22 +77,161 @@ class Context(VMBuilder.plugins.Plugin):
 
     def set_skipped_hooks(self, hooks):
         self.skipped_hooks = hooks
+        self._hook_tables = {}
 
 class Distro(Context):
+    # Settings that shape the outcome of the bootstrap hook. Used to key
+    # the chroot cache.
+    chroot_cache_settings = ['suite', 'arch', 'variant', 'components',
+                             'mirror', 'install-mirror', 'iso',
+                             'debootstrap-tarball']
+
     def __init__(self):
         self.plugin_classes = VMBuilder._distro_plugins
         super(Distro, self).__init__()
+        self.chroot_cache = None
+        self.use_chroot_overlay = False
+        self.chroot_overlay = None
+        self.use_chroot_executor = False
+        self.chroot_executor = None
+        self.package_cache = None
+        self._package_intents = {}
+        self._applied_packages = set()
 
     def set_chroot_dir(self, chroot_dir):
         self.chroot_dir = chroot_dir
 
+    def run_in_target(self, *args, **kwargs):
+        """
+        Run a command in the chroot. With L{use_chroot_executor}, it is
+        handed to a L{ChrootExecutor} instead of being started through
+        chroot(8).
+        """
+        if not self.use_chroot_executor:
+            return super(Distro, self).run_in_target(*args, **kwargs)
+        if not self.chroot_executor:
+            self.chroot_executor = ChrootExecutor()
+            self.add_clean_cb(self.stop_chroot_executor)
+        return self.chroot_executor.run(self.chroot_dir, *args, **kwargs)
+
+    def stop_chroot_executor(self):
+        self.cancel_cleanup(self.stop_chroot_executor)
+        if self.chroot_executor:
+            self.chroot_executor.stop()
+            self.chroot_executor = None
+
     def build_chroot(self):
         self.call_hooks('preflight_check')
         self.call_hooks('set_defaults')
-        self.call_hooks('bootstrap')
+        self.bootstrap_chroot()
         self.call_hooks('configure_os')
         self.cleanup()
 
+    def resume(self):
+        """
+        Get ready to carry on with a chroot built by an earlier run:
+        fill in the defaults L{build_chroot} would have (the journal
+        only records settings that were set explicitly) and run the
+        checks.
+        """
+        self.call_hooks('set_defaults')
+        self.call_hooks('preflight_check')
+
+    def bootstrap_chroot(self):
+        """
+        Run the bootstrap hook, or restore its result from the chroot
+        cache if an identical chroot has been bootstrapped before.
+        """
+        if not self.chroot_cache or 'bootstrap' in self.skipped_hooks:
+            self.call_hooks('bootstrap')
+            return
+
+        key = self.chroot_cache_key()
+        try:
+            if self.use_chroot_overlay:
+                self.chroot_overlay = Overlay(self.chroot_cache, key, self.chroot_dir,
+                                              tmp_root=os.path.dirname(self.chroot_dir))
+                self.chroot_overlay.mount(self.bootstrap_into)
+                return
+            if self.chroot_cache.restore(key, self.chroot_dir):
+                return
+            self.call_hooks('bootstrap')
+            self.chroot_cache.save(key, self.chroot_dir)
+        except Exception:
+            self.cleanup()
+            raise
+
+    def bootstrap_into(self, chroot_dir):
+        """Run the bootstrap hook against L{chroot_dir} instead of our chroot_dir."""
+        orig_chroot_dir = self.chroot_dir
+        self.set_chroot_dir(chroot_dir)
+        try:
+            self.call_hooks('bootstrap')
+        finally:
+            self.set_chroot_dir(orig_chroot_dir)
+
+    def release_chroot(self):
+        """Tear down the chroot overlay, if any."""
+        if self.chroot_overlay:
+            self.chroot_overlay.unmount()
+            self.chroot_overlay = None
+
+    def chroot_cache_key(self):
+        """
+        @rtype:  string
+        @return: a hash of everything that shapes the bootstrapped chroot
+        """
+        inputs = [self.arg]
+        for name in self.chroot_cache_settings:
+            if self.has_setting(name):
+                inputs.append((name, self.get_setting(name)))
+        for name in ['debootstrap-tarball', 'iso']:
+            if self.has_setting(name) and self.get_setting(name):
+                st = os.stat(self.get_setting(name))
+                inputs.append((name, st.st_size, st.st_mtime))
+        return hashlib.sha1(repr(inputs)).hexdigest()
+
+    # Package intents
+    def add_packages(self, *packages):
+        """
+        Ask for packages to be installed in the guest.
+
+        Plugins should call this from preflight_check or set_defaults.
+        The distro installs all requested packages in a single
+        transaction while configuring the OS.
+        """
+        for pkg in packages:
+            self._package_intents[pkg] = True
+
+    def remove_packages(self, *packages):
+        """Ask for packages to be removed from the guest. See L{add_packages}."""
+        for pkg in packages:
+            self._package_intents[pkg] = False
+
+    def pending_packages(self):
+        """
+        @rtype:  tuple
+        @return: the sorted lists of packages still to be installed and
+                 removed, respectively
+        """
+        pending = [pkg for pkg in self._package_intents if pkg not in self._applied_packages]
+        install = sorted([pkg for pkg in pending if self._package_intents[pkg]])
+        remove = sorted([pkg for pkg in pending if not self._package_intents[pkg]])
+        return (install, remove)
+
+    def is_package_pending(self, pkg):
+        return pkg in self._package_intents and pkg not in self._applied_packages
+
+    def mark_packages_applied(self, packages):
+        self._applied_packages.update(packages)
+
+    def applied_packages(self):
+        """
+        @rtype:  list
+        @return: the sorted list of packages whose intents have been applied
+        """
+        return sorted(self._applied_packages)
+
     def has_xen_support(self):
         """Install the distro into destdir"""
         raise NotImplemented('Distro subclasses need to implement the has_xen_support method')
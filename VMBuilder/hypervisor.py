@@ -22,22 +22,36 @@ import logging
 import os
 import VMBuilder.distro
 import VMBuilder.disk
-from   VMBuilder.util    import run_cmd, tmpdir
+from   VMBuilder.exception import VMBuilderUserError
+from   VMBuilder.util    import run_cmd, run_parallel, tmpdir, CAPTURE_TAIL
 
 STORAGE_DISK_IMAGE = 0
 STORAGE_FS_IMAGE = 1
 
 class Hypervisor(VMBuilder.distro.Context):
     preferred_storage = STORAGE_DISK_IMAGE
+    resume_attrs = []
+    "Attributes set by the convert hook that the deploy hook relies on"
 
     def __init__(self, distro):
         self.plugin_classes = VMBuilder._hypervisor_plugins
         super(Hypervisor, self).__init__()
         self.plugins += [distro]
+        self._hook_tables = {}
         self.distro = distro
         self.filesystems = []
         self.disks = []
         self.nics = []
+        self.convert_jobs = 1
+        "How many disks to convert at once"
+        self.mkfs_jobs = 1
+        "How many filesystems to create at once"
+        self.image_allocation = VMBuilder.disk.ALLOC_SPARSE
+        "How to allocate the raw images, see L{VMBuilder.disk.allocate}"
+        self.uuid_seed = None
+        "Seed to derive filesystem UUIDs from, see L{VMBuilder.disk.new_uuid}"
+        self.owns_chroot = False
+        "Whether the distro's chroot was built by this run, so that it may be finished in place"
 
     def add_filesystem(self, *args, **kwargs):
         """Adds a filesystem to the virtual machine"""
@@ -67,36 +81,130 @@ class Hypervisor(VMBuilder.distro.Context):
         self.nics = [self.NIC()]
         self.call_hooks('preflight_check')
         self.call_hooks('configure_networking', self.nics)
+        if self.can_populate_filesystems():
+            self.populate_filesystems()
+            return
         self.call_hooks('create_partitions')
         self.call_hooks('configure_mounting', self.disks, self.filesystems)
 
         self.chroot_dir = tmpdir()
         self.call_hooks('mount_partitions', self.chroot_dir)
-        run_cmd('rsync', '-aHA', '%s/' % self.distro.chroot_dir, self.chroot_dir)
+        run_cmd('rsync', '-aHA', '%s/' % self.distro.chroot_dir, self.chroot_dir, capture=CAPTURE_TAIL)
         self.distro.set_chroot_dir(self.chroot_dir)
         if self.needs_bootloader:
             self.call_hooks('install_bootloader', self.chroot_dir, self.disks)
         self.call_hooks('install_kernel', self.chroot_dir)
         self.distro.call_hooks('post_install')
+        self.call_hooks('trim_partitions')
         self.call_hooks('unmount_partitions')
         os.rmdir(self.chroot_dir)
 
+    def can_populate_filesystems(self):
+        """
+        Whether the filesystem images can be written straight from the
+        distro's chroot. This needs a single ext filesystem holding the
+        whole tree (swap aside) and a mke2fs that supports -d. As the
+        chroot is finished in place, it also needs to be one this run
+        built (see L{owns_chroot}), not one it was handed or reused.
+        """
+        if self.preferred_storage != STORAGE_FS_IMAGE or not self.owns_chroot:
+            return False
+        trees = [fs for fs in self.filesystems if fs.type != VMBuilder.disk.TYPE_SWAP and not fs.dummy]
+        if len(trees) != 1 or trees[0].mntpnt != '/':
+            return False
+        if trees[0].type not in (VMBuilder.disk.TYPE_EXT2, VMBuilder.disk.TYPE_EXT3, VMBuilder.disk.TYPE_EXT4):
+            return False
+        return VMBuilder.disk.mke2fs_can_populate()
+
+    def populate_filesystems(self):
+        """
+        Finish the system in the distro's chroot and have mke2fs copy it
+        into the root filesystem image in one sequential pass, rather
+        than loop mounting the image and rsyncing the tree into it.
+        """
+        trees = [fs for fs in self.filesystems if fs.type != VMBuilder.disk.TYPE_SWAP and not fs.dummy]
+        # The root filesystem is created last, but fstab may refer to it
+        trees[0].set_uuid()
+        self.call_hooks('configure_mounting', self.disks, self.filesystems)
+        self.call_hooks('install_kernel', self.distro.chroot_dir)
+        self.distro.call_hooks('post_install')
+        for fs in self.filesystems:
+            if fs in trees:
+                fs.create(populate=self.distro.chroot_dir)
+            else:
+                fs.create()
+
+    def stamp(self):
+        """
+        Give an installed system, mounted at the distro's chroot, the
+        identity of this vm: host and domain name, network
+        configuration, initial user, ssh keys and first boot scripts.
+        Nothing else about the system changes.
+        """
+        self.nics = [self.NIC()]
+        self.call_hooks('configure_networking', self.nics)
+        self.distro.call_hooks('stamp')
+
     def finalise(self, destdir):
+        self.convert_images(destdir)
+        self.call_hooks('deploy', destdir)
+
+    def convert_images(self, destdir):
         self.call_hooks('convert',
                         self.preferred_storage == STORAGE_DISK_IMAGE and self.disks or self.filesystems,
                         destdir)
-        self.call_hooks('deploy', destdir)
+
+    def get_image_state(self):
+        """
+        @rtype:  dict
+        @return: where the vm's images currently are, for the build journal
+        """
+        return { 'disks' : [(disk.filename, disk.format_type, disk.backing_file) for disk in self.disks],
+                 'filesystems' : [fs.filename for fs in self.filesystems],
+                 'attrs' : dict([(attr, getattr(self, attr)) for attr in self.resume_attrs
+                                                             if hasattr(self, attr)]) }
+
+    def set_image_state(self, state):
+        """
+        Point the vm's disks and filesystems at the images recorded by
+        L{get_image_state}. The disk layout must have been set up the
+        same way as in the recorded build.
+        """
+        if (len(state['disks']) != len(self.disks) or
+            len(state['filesystems']) != len(self.filesystems)):
+            raise VMBuilderUserError('The disk layout does not match the one of the build being resumed')
+        for (disk, (filename, format_type, backing_file)) in zip(self.disks, state['disks']):
+            disk.filename = filename
+            disk.format_type = format_type
+            disk.backing_file = backing_file
+        for (fs, filename) in zip(self.filesystems, state['filesystems']):
+            fs.filename = filename
+        for image in [disk.filename for disk in self.disks] + [fs.filename for fs in self.filesystems]:
+            if image and not os.path.exists(image):
+                raise VMBuilderUserError('Can not resume build: %s is gone' % image)
+        for (attr, value) in state['attrs'].iteritems():
+            setattr(self, attr, value)
 
     def create_partitions(self):
-        """Creates all the vms partitions and formats them """
+        """
+        Creates all the vms partitions and formats them.
+
+        The images, partition tables and loop devices are set up one
+        after the other. The filesystems on them are independent of each
+        other, so they are then created up to L{mkfs_jobs} at a time,
+        across all disks.
+        """
         for fs in self.filesystems:
-            fs.create()
-            fs.mkfs()
+            fs.create(mkfs=False)
         for disk in self.disks:
             disk.create()
             disk.partition()
             disk.map_partitions()
-            disk.mkfs()
+        logging.info('Creating file systems')
+        targets = list(self.filesystems)
+        for disk in self.disks:
+            targets += disk.partitions
+        run_parallel(lambda target: target.mkfs(), targets, self.mkfs_jobs, collect=True)
 
     def mount_partitions(self, mntdir):
         """Mounts all the vm's partitions and filesystems below .rootmnt"""
@@ -106,6 +214,18 @@ class Hypervisor(VMBuilder.distro.Context):
             fs.mount(mntdir)
             self.distro.post_mount(fs)
 
+    def trim_partitions(self):
+        """
+        Discard the blocks the vm's filesystems don't use, such as those
+        of files deleted during the installation, so that they end up as
+        holes in the images rather than as garbage in the converted ones.
+        """
+        logging.info('Trimming target filesystems')
+        # Blocks are only free to discard once the deletions are committed
+        run_cmd('sync')
+        for fs in VMBuilder.disk.get_ordered_filesystems(self):
+            fs.trim()
+
     def unmount_partitions(self):
         """Unmounts all the vm's partitions and filesystems"""
         logging.info('Unmounting target filesystem')
@@ -117,8 +237,30 @@ class Hypervisor(VMBuilder.distro.Context):
             disk.unmap()
 
     def convert_disks(self, disks, destdir):
-        for disk in disks:
-            disk.convert(destdir, self.filetype)
+        self.convert_disk_images(disks, destdir, self.filetype)
+
+    def convert_disk_images(self, disks, destdir, format, compress_level=None, compress_jobs=1):
+        """
+        Convert L{disks} to L{format}, up to L{convert_jobs} at a time.
+        See L{Disk.convert<VMBuilder.disk.Disk.convert>} for compression.
+        Compressing conversions already spread over L{compress_jobs}
+        processes each, so they run one disk at a time.
+
+        @rtype:  list
+        @return: the converted images, in the order of L{disks}
+        """
+        done = []
+        def convert(disk):
+            img_path = disk.convert(destdir, format, compress_level, compress_jobs)
+            done.append(img_path)
+            logging.info('Converted %s (%d of %d)' % (img_path, len(done), len(disks)))
+            return img_path
+        jobs = self.convert_jobs
+        if compress_level is not None and compress_jobs > 1:
+            # Every conversion would fork its own pool of compress_jobs
+            # workers from a threaded process
+            jobs = 1
+        return run_parallel(convert, disks, jobs)
 
     class NIC(object):
         def __init__(self, type='dhcp', ip=None, network=None, netmask=None,
@@ -0,0 +1,112 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Build checkpoints
+
+import json
+import logging
+import os
+from   VMBuilder.exception import VMBuilderUserError
+
+class Journal(object):
+    """
+    Checkpoint journal of a build.
+
+    After each completed stage the frontend records the stage's name
+    together with whatever state is needed to pick up from there. A
+    failed build can then be resumed from the last completed stage
+    instead of starting over from debootstrap.
+
+    @type  filename: string
+    @param filename: Where to keep the journal
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        "The file holding the journal."
+
+        self.stages = []
+        "Names of the completed stages, in order."
+
+        self.state = {}
+        "State recorded by the completed stages."
+
+    def load(self):
+        """Read the journal of an earlier, failed build."""
+        try:
+            fp = open(self.filename, 'r')
+        except IOError, e:
+            raise VMBuilderUserError('Could not open journal %s: %s' % (self.filename, e.strerror))
+        try:
+            try:
+                journal = _to_str(json.load(fp))
+            except ValueError:
+                raise VMBuilderUserError('%s is not a vmbuilder journal' % self.filename)
+        finally:
+            fp.close()
+        self.stages = journal['stages']
+        self.state = journal['state']
+        logging.info('Resuming build. Completed stages: %s' % ', '.join(self.stages))
+
+    def done(self, stage):
+        """
+        @rtype:  boolean
+        @return: whether L{stage} was completed by an earlier run
+        """
+        return stage in self.stages
+
+    def record(self, stage, **state):
+        """
+        Mark L{stage} as completed and remember L{state} along with it.
+        """
+        logging.debug('Recording checkpoint: %s' % stage)
+        if stage not in self.stages:
+            self.stages.append(stage)
+        self.state.update(state)
+        fp = open('%s.new' % self.filename, 'w')
+        json.dump({ 'stages' : self.stages, 'state' : self.state }, fp, indent=1, sort_keys=True)
+        fp.close()
+        os.rename('%s.new' % self.filename, self.filename)
+
+    def remove(self):
+        """Remove the journal once the build has succeeded."""
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+def get_settings(context):
+    """
+    @rtype:  dict
+    @return: the values of all of L{context}'s explicitly set settings
+    """
+    return dict([(name, setting.get_value()) for (name, setting) in context._config.iteritems()
+                                             if setting.value_set])
+
+def set_settings(context, settings):
+    for (name, value) in settings.iteritems():
+        if context.has_setting(name):
+            context.set_setting(name, value)
+
+def _to_str(obj):
+    # json gives us unicode strings, but StringSettings insist on str
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_to_str(x) for x in obj]
+    if isinstance(obj, dict):
+        return dict([(_to_str(k), _to_str(v)) for (k, v) in obj.iteritems()])
+    return obj
@@ -0,0 +1,123 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Loop devices
+
+import errno
+import fcntl
+import logging
+import os
+import struct
+from   VMBuilder.exception import VMBuilderException
+from   VMBuilder.util      import run_cmd
+
+# From <linux/loop.h>
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_AUTOCLEAR = 4
+LOOP_INFO64 = '<QQQQQIIII64s64s32sQQ'
+
+class LoopDevice(object):
+    """
+    Loop device exposing part of a file.
+
+    The device is set up with LO_FLAGS_AUTOCLEAR, so the kernel releases
+    it as soon as the last user is gone. We hold it open ourselves until
+    L{detach} is called, which makes teardown a matter of unmounting
+    whatever uses it and closing our descriptor: no polling, no retries.
+
+    @type  filename: string
+    @param filename: The file (or block device) to attach
+    @type  offset: number
+    @param offset: Where the device starts in L{filename}, in bytes
+    @type  sizelimit: number
+    @param sizelimit: The size of the device in bytes (0 for up to the end of L{filename})
+    """
+
+    def __init__(self, filename, offset=0, sizelimit=0):
+        self.filename = filename
+        self.offset = offset
+        self.sizelimit = sizelimit
+        self.device = None
+        "The loop device, once attached"
+        self._fd = None
+
+    def attach(self):
+        """
+        @rtype:  string
+        @return: the loop device
+        """
+        if not os.path.exists('/dev/loop-control'):
+            # Kernels older than 3.1 can't hand out free devices
+            self.device = run_cmd('losetup', '--find', '--show',
+                                  '--offset', self.offset,
+                                  '--sizelimit', self.sizelimit,
+                                  self.filename).strip()
+            return self.device
+
+        backing = os.open(self.filename, os.O_RDWR)
+        try:
+            while True:
+                ctl = os.open('/dev/loop-control', os.O_RDWR)
+                try:
+                    number = fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+                finally:
+                    os.close(ctl)
+                device = '/dev/loop%d' % number
+                fd = os.open(device, os.O_RDWR)
+                try:
+                    fcntl.ioctl(fd, LOOP_SET_FD, backing)
+                except IOError, e:
+                    os.close(fd)
+                    if e.errno == errno.EBUSY:
+                        # Someone else grabbed it in the meantime
+                        continue
+                    raise
+                break
+        finally:
+            os.close(backing)
+
+        info = struct.pack(LOOP_INFO64, 0, 0, 0, self.offset, self.sizelimit,
+                           0, 0, 0, LO_FLAGS_AUTOCLEAR,
+                           self.filename[:63], '', '', 0, 0)
+        try:
+            fcntl.ioctl(fd, LOOP_SET_STATUS64, info)
+        except IOError, e:
+            fcntl.ioctl(fd, LOOP_CLR_FD)
+            os.close(fd)
+            raise VMBuilderException('Could not set up %s for %s: %s' % (device, self.filename, e))
+        logging.debug('Attached %s at offset %d to %s' % (self.filename, self.offset, device))
+        self._fd = fd
+        self.device = device
+        return device
+
+    def detach(self, ignore_fail=False):
+        """
+        Let go of the loop device. Unmount everything on it first.
+        """
+        if not self.device:
+            return
+        logging.debug('Detaching %s' % self.device)
+        if self._fd is None:
+            run_cmd('losetup', '-d', self.device, ignore_fail=ignore_fail)
+        else:
+            os.close(self._fd)
+            self._fd = None
+        self.device = None
@@ -0,0 +1,140 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Mirror selection
+
+import hashlib
+import httplib
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+import urllib2
+from   VMBuilder.exception import VMBuilderUserError
+
+DEFAULT_CACHE = '/var/cache/vmbuilder/mirrors.json'
+PROBE_TIMEOUT = 10
+
+# Mirrors are ranked by the estimated time to fetch this many bytes, so
+# that both the round trip time and the throughput count.
+REFERENCE_SIZE = 1024 * 1024
+
+def probe(mirror, suite, proxy=None):
+    """
+    Time the download of L{suite}'s Release file from L{mirror}.
+
+    @rtype:  tuple
+    @return: the latency (in seconds) and throughput (in bytes per
+             second) of the download, or None if it failed
+    """
+    url = '%s/dists/%s/Release' % (mirror.rstrip('/'), suite)
+    if proxy:
+        opener = urllib2.build_opener(urllib2.ProxyHandler({'http': proxy}))
+    else:
+        opener = urllib2.build_opener()
+    start = time.time()
+    try:
+        fp = opener.open(url, timeout=PROBE_TIMEOUT)
+        try:
+            latency = time.time() - start
+            size = len(fp.read())
+        finally:
+            fp.close()
+    except (IOError, httplib.HTTPException), e:
+        logging.debug('Probing %s failed: %s' % (url, e))
+        return None
+    elapsed = max(time.time() - start, 0.001)
+    logging.debug('Probed %s: %.3fs latency, %d bytes in %.3fs' % (url, latency, size, elapsed))
+    return (latency, size / elapsed)
+
+def rank_mirrors(candidates, suite, proxy=None, cache_file=DEFAULT_CACHE, ttl=86400):
+    """
+    Rank L{candidates} by how fast they serve L{suite}.
+
+    All candidates are probed at the same time. The ranking is kept in
+    L{cache_file} and reused for L{ttl} seconds, so consecutive builds
+    don't go to the network for it.
+
+    @rtype:  list
+    @return: the reachable candidates, fastest first
+    """
+    key = hashlib.sha1(repr((sorted(candidates), suite, proxy))).hexdigest()
+    cache = read_cache(cache_file)
+    if key in cache and time.time() - cache[key]['time'] < ttl:
+        logging.debug('Using cached mirror ranking from %s' % cache_file)
+        return cache[key]['ranking']
+
+    logging.info('Probing mirrors: %s' % ' '.join(candidates))
+    results = {}
+    def run_probe(mirror):
+        results[mirror] = probe(mirror, suite, proxy)
+    threads = [threading.Thread(target=run_probe, args=(mirror,)) for mirror in candidates]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    def score(mirror):
+        (latency, throughput) = results[mirror]
+        return latency + REFERENCE_SIZE / max(throughput, 1)
+    ranking = sorted([mirror for mirror in candidates if results.get(mirror)], key=score)
+
+    # Don't remember a network outage
+    if ranking:
+        cache = dict([(k, v) for (k, v) in cache.iteritems() if time.time() - v['time'] < ttl])
+        cache[key] = { 'time' : time.time(), 'ranking' : ranking }
+        try:
+            write_cache(cache_file, cache)
+        except (IOError, OSError), e:
+            logging.warning('Could not write mirror ranking to %s: %s' % (cache_file, e))
+    return ranking
+
+def fastest_mirror(candidates, suite, proxy=None, cache_file=DEFAULT_CACHE, ttl=86400):
+    """
+    @rtype:  string
+    @return: the fastest of L{candidates}. See L{rank_mirrors}.
+    """
+    ranking = rank_mirrors(candidates, suite, proxy, cache_file, ttl)
+    if not ranking:
+        raise VMBuilderUserError('None of the mirrors %s could be reached. Please check your connectivity and try again.' % ' '.join(candidates))
+    logging.info('Installing from %s' % ranking[0])
+    return ranking[0]
+
+def read_cache(cache_file):
+    try:
+        fp = open(cache_file, 'r')
+    except IOError:
+        return {}
+    try:
+        try:
+            return json.load(fp)
+        except ValueError:
+            logging.warning('Ignoring corrupt mirror ranking in %s' % cache_file)
+            return {}
+    finally:
+        fp.close()
+
+def write_cache(cache_file, cache):
+    if not os.path.isdir(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    fp = open('%s.%d.new' % (cache_file, os.getpid()), 'w')
+    json.dump(cache, fp, indent=1, sort_keys=True)
+    fp.close()
+    os.rename('%s.%d.new' % (cache_file, os.getpid()), cache_file)
@@ -0,0 +1,231 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Partition table writer
+
+import os
+import struct
+import uuid
+import zlib
+from   VMBuilder.exception import VMBuilderUserError
+
+SECTOR_SIZE = 512
+ALIGNMENT = 1024 * 1024
+"Partitions start on 1MB boundaries."
+
+MSDOS_LINUX = 0x83
+MSDOS_SWAP = 0x82
+MSDOS_GPT_PROTECTIVE = 0xee
+MSDOS_EXTENDED = (0x05, 0x0f, 0x85)
+
+GPT_LINUX = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4')
+GPT_SWAP = uuid.UUID('0657fd6d-a4ab-43c4-84e5-0933c84b4f4f')
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_BACKUP_SIZE = SECTOR_SIZE + GPT_ENTRIES * GPT_ENTRY_SIZE
+"The backup GPT at the end of the disk."
+
+def layout(extents, size=None, reserved=0):
+    """
+    Work out where partitions go on the disk.
+
+    @type  extents: list
+    @param extents: (begin, end) pairs, in megabytes, with both ends
+        inclusive like L{Disk.Partition<VMBuilder.disk.Disk.Partition>}
+    @type  size: number
+    @param size: Size of the disk in bytes, to check that the partitions
+        fit on it
+    @type  reserved: number
+    @param reserved: Bytes at the end of the disk that the partition
+        table needs for itself, such as L{GPT_BACKUP_SIZE}
+    @rtype:  list
+    @return: the (offset, length) pairs, in bytes. A partition starting
+        at 0 is moved up to the first aligned sector, leaving room for
+        the partition table.
+    """
+    offsets = []
+    for (begin, end) in extents:
+        offset = max(begin * 1024 * 1024, ALIGNMENT)
+        length = (end + 1) * 1024 * 1024 - offset
+        if length <= 0:
+            raise VMBuilderUserError('Partition at %dMB is too small to hold anything' % begin)
+        if size is not None and offset + length > size - reserved:
+            raise VMBuilderUserError('Partition is out of bounds. start=%d, end=%d, disksize=%d bytes (%d of which the partition table needs)' %
+                                     (offset, offset + length, size, reserved))
+        offsets.append((offset, length))
+    return offsets
+
+def write_msdos(filename, partitions, new_id=None):
+    """
+    Write an MBR partition table.
+
+    @type  filename: string
+    @param filename: The disk image (or block device)
+    @type  partitions: list
+    @param partitions: (offset, length, type) for each partition, with
+        offset and length in bytes and type one of the MSDOS_* ids
+    @type  new_id: callable
+    @param new_id: Makes up the UUID, as a string, to derive the disk
+        signature from when called with 'disk'. Random by default.
+    """
+    if len(partitions) > 4:
+        raise VMBuilderUserError('An msdos partition table can hold at most 4 partitions')
+    mbr = mbr_sector([(offset / SECTOR_SIZE, length / SECTOR_SIZE, type)
+                      for (offset, length, type) in partitions],
+                     _new_uuid(new_id, 'disk').bytes[:4])
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        _write_at(fd, 0, mbr)
+    finally:
+        os.close(fd)
+
+def write_gpt(filename, partitions, new_id=None):
+    """
+    Write a GPT partition table, its backup at the end of the disk and
+    a protective MBR.
+
+    @type  filename: string
+    @param filename: The disk image (or block device)
+    @type  partitions: list
+    @param partitions: (offset, length, type) for each partition, with
+        offset and length in bytes and type one of the GPT_* UUIDs
+    @type  new_id: callable
+    @param new_id: Makes up the UUIDs, as strings, of the disk (when
+        called with 'disk') and of each partition ('part1', 'part2',
+        ...). Random by default.
+    """
+    if len(partitions) > GPT_ENTRIES:
+        raise VMBuilderUserError('A gpt partition table can hold at most %d partitions' % GPT_ENTRIES)
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        sectors = os.lseek(fd, 0, os.SEEK_END) / SECTOR_SIZE
+        entries = ''
+        for (index, (offset, length, type)) in enumerate(partitions):
+            entries += struct.pack('<16s16sQQQ72s',
+                                   type.bytes_le,
+                                   _new_uuid(new_id, 'part%d' % (index + 1)).bytes_le,
+                                   offset / SECTOR_SIZE,
+                                   (offset + length) / SECTOR_SIZE - 1,
+                                   0,
+                                   '')
+        entries = entries.ljust(GPT_ENTRIES * GPT_ENTRY_SIZE, '\0')
+        entry_sectors = len(entries) / SECTOR_SIZE
+        disk_guid = _new_uuid(new_id, 'disk')
+
+        def header(current, backup, entries_lba):
+            hdr = struct.pack('<8sIIIIQQQQ16sQIII',
+                              'EFI PART', 0x10000, 92, 0, 0,
+                              current, backup,
+                              2 + entry_sectors, sectors - 2 - entry_sectors,
+                              disk_guid.bytes_le, entries_lba,
+                              GPT_ENTRIES, GPT_ENTRY_SIZE,
+                              zlib.crc32(entries) & 0xffffffff)
+            crc = zlib.crc32(hdr) & 0xffffffff
+            hdr = hdr[:16] + struct.pack('<I', crc) + hdr[20:]
+            return hdr.ljust(SECTOR_SIZE, '\0')
+
+        mbr = mbr_sector([(1, min(sectors - 1, 0xffffffff), MSDOS_GPT_PROTECTIVE)],
+                         disk_guid.bytes[:4])
+        _write_at(fd, 0, mbr + header(1, sectors - 1, 2) + entries)
+        _write_at(fd, (sectors - 1 - entry_sectors) * SECTOR_SIZE,
+                  entries + header(sectors - 1, 1, sectors - 1 - entry_sectors))
+    finally:
+        os.close(fd)
+
+def read(filename):
+    """
+    Read the partition table of a disk image.
+
+    @type  filename: string
+    @param filename: The disk image (or block device)
+    @rtype:  list
+    @return: (offset, length, type) for each partition, with offset and
+        length in bytes and type an msdos id or a GPT UUID. Empty if the
+        image has no partition table.
+    """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        mbr = _read_at(fd, 0, SECTOR_SIZE)
+        if mbr[510:] != '\x55\xaa':
+            return []
+        entries = [struct.unpack('<B3sB3sII', mbr[446 + i * 16:462 + i * 16]) for i in range(4)]
+        if MSDOS_GPT_PROTECTIVE not in [type for (_, _, type, _, _, _) in entries]:
+            return [(start * SECTOR_SIZE, count * SECTOR_SIZE, type)
+                    for (_, _, type, _, start, count) in entries
+                    if type and type not in MSDOS_EXTENDED]
+
+        hdr = struct.unpack('<8sIIIIQQQQ16sQIII', _read_at(fd, SECTOR_SIZE, 92))
+        (signature, entries_lba, count, size) = (hdr[0], hdr[10], hdr[11], hdr[12])
+        if signature != 'EFI PART':
+            raise VMBuilderUserError('%s has a protective MBR but no GPT' % filename)
+        data = _read_at(fd, entries_lba * SECTOR_SIZE, count * size)
+        partitions = []
+        for i in range(count):
+            (type, _, first, last, _, _) = struct.unpack('<16s16sQQQ72s', data[i * size:i * size + GPT_ENTRY_SIZE])
+            if type != '\0' * 16:
+                partitions.append((first * SECTOR_SIZE, (last + 1 - first) * SECTOR_SIZE,
+                                   uuid.UUID(bytes_le=type)))
+        return partitions
+    finally:
+        os.close(fd)
+
+def mbr_sector(partitions, signature=None):
+    """
+    @type  partitions: list
+    @param partitions: (start, count, type) for each partition, in sectors
+    @type  signature: string
+    @param signature: The 4 byte disk signature. Random by default.
+    @rtype:  string
+    @return: a master boot record holding L{partitions}
+    """
+    table = ''
+    for (start, count, type) in partitions:
+        table += struct.pack('<B3sB3sII', 0, _chs(start), type,
+                             _chs(start + count - 1), start, count)
+    return ('\0' * 440 + (signature or os.urandom(4)) + '\0\0' +
+            table.ljust(64, '\0') + '\x55\xaa')
+
+def _new_uuid(new_id, name):
+    if new_id is None:
+        return uuid.uuid4()
+    return uuid.UUID(new_id(name))
+
+def _chs(lba):
+    # Cylinder/head/sector address as BIOSes used to see it
+    # (255 heads, 63 sectors per track), or the usual "too big" marker.
+    cylinder = lba / (255 * 63)
+    if cylinder > 1023:
+        return '\xfe\xff\xff'
+    head = (lba / 63) % 255
+    sector = lba % 63 + 1
+    return struct.pack('<BBB', head, ((cylinder >> 2) & 0xc0) | sector, cylinder & 0xff)
+
+def _write_at(fd, offset, data):
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        data = data[os.write(fd, data):]
+
+def _read_at(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    data = ''
+    while len(data) < length:
+        chunk = os.read(fd, length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
@@ -65,6 +65,12 @@ class Plugin(object):
         """
         pass
 
+    def stamp(self):
+        """
+        This is called when a prebuilt image is given the identity of a new vm (see vmbuilder stamp).
+        """
+        pass
+
     def install_file(self, path, contents=None, source=None, mode=None):
         fullpath = '%s%s' % (self.context.chroot_dir, path)
         if not os.path.isdir(os.path.dirname(fullpath)):
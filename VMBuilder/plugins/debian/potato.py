@@ -23,7 +23,8 @@ import suite
 import shutil
 import tempfile
 import VMBuilder.disk as disk
-from   VMBuilder.util import run_cmd
+from   VMBuilder.mirrors import fastest_mirror
+from   VMBuilder.util import run_cmd, umount, CAPTURE_TAIL
 from   VMBuilder.exception import VMBuilderException
 
 class Potato(suite.Suite):
@@ -37,6 +38,9 @@ class Potato(suite.Suite):
     virtio_net = False
     chpasswd_cmd = [ 'chpasswd', '--md5' ]
     preferred_filesystem = 'ext3'
+    dpkg_unsafe_io = False
+    unsafe_io_conf = '/etc/dpkg/dpkg.cfg.d/vmbuilder-unsafe-io'
+    _fastest_mirror = None
 
     def pre_install(self):
         pass
@@ -72,13 +76,14 @@ class Potato(suite.Suite):
             self.call_hook('fix_ownership', manifest)
 
     def update(self):
-        self.run_in_target('apt-get', '-y', '--force-yes', 'dist-upgrade',
-                           env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
+        self.apt_get('-y', '--force-yes', 'dist-upgrade',
+                     env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
 
     def install_authorized_keys(self):
         ssh_key = self.context.get_setting('ssh-key')
         if ssh_key:
-            os.mkdir('%s/root/.ssh' % self.context.chroot_dir, 0700)
+            if not os.path.isdir('%s/root/.ssh' % self.context.chroot_dir):
+                os.makedirs('%s/root/.ssh' % self.context.chroot_dir, 0700)
             shutil.copy(ssh_key, '%s/root/.ssh/authorized_keys' % self.context.chroot_dir)
             os.chmod('%s/root/.ssh/authorized_keys' % self.context.chroot_dir, 0644)
 
@@ -86,15 +91,61 @@ class Potato(suite.Suite):
         if user:
             ssh_user_key = self.context.get_setting('ssh-user-key')
             if ssh_user_key:
-                os.mkdir('%s/home/%s/.ssh' % (self.context.chroot_dir, user), 0700)
+                if not os.path.isdir('%s/home/%s/.ssh' % (self.context.chroot_dir, user)):
+                    os.makedirs('%s/home/%s/.ssh' % (self.context.chroot_dir, user), 0700)
                 shutil.copy(ssh_user_key, '%s/home/%s/.ssh/authorized_keys' % (self.context.chroot_dir, user))
                 os.chmod('%s/home/%s/.ssh/authorized_keys' % (self.context.chroot_dir, user), 0644)
                 self.run_in_target('chown', '-R', '%s:%s' % ((user,)*2), '/home/%s/.ssh/' % (user))
 
-        if (user and ssh_user_key) or ssh_key:
-            addpkg = self.context.get_setting('addpkg')
-            addpkg += ['openssh-server']
-            self.context.set_setting('addpkg', addpkg)
+    def user_exists(self, user):
+        return bool(self.run_in_target('getent', 'passwd', user, ignore_fail=True).strip())
+
+    def reset_identity(self):
+        """
+        Strip a prebuilt system of the identity of the vm it was built
+        for, before it is stamped with a new one, and give it new ssh
+        host keys. See L{strip_identity}.
+        """
+        if (self.strip_identity(keep=self.context.get_setting('user')) and
+            os.path.exists('%s/usr/sbin/sshd' % self.context.chroot_dir)):
+            logging.info('Generating new ssh host keys')
+            self.run_in_target('dpkg-reconfigure', 'openssh-server',
+                               env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
+
+    def strip_identity(self, keep=None):
+        """
+        Remove what identifies the vm a system was built for: the ssh
+        host keys, the root password, the login accounts other than
+        L{keep} and everybody's authorized ssh keys. Needs /dev and
+        /proc mounted in the chroot.
+
+        @rtype:  boolean
+        @return: whether there were ssh host keys to remove
+        """
+        chroot_dir = self.context.chroot_dir
+
+        fp = open('%s/etc/passwd' % chroot_dir, 'r')
+        try:
+            accounts = [line.strip().split(':') for line in fp if line.count(':') >= 6]
+        finally:
+            fp.close()
+        for (name, _, uid, _, _, home, _) in accounts:
+            if 1000 <= int(uid) < 60000 and name != keep:
+                logging.info('Removing account %s of the prebuilt system' % name)
+                self.run_in_target('deluser', name)
+                if home.startswith('/home/') and os.path.isdir('%s%s' % (chroot_dir, home)):
+                    shutil.rmtree('%s%s' % (chroot_dir, home))
+
+        for home in ['/root'] + [home for (name, _, _, _, _, home, _) in accounts if name == keep]:
+            keys = '%s%s/.ssh/authorized_keys' % (chroot_dir, home)
+            if os.path.exists(keys):
+                os.unlink(keys)
+        self.run_in_target('usermod', '-p', '*', 'root')
+
+        host_keys = glob.glob('%s/etc/ssh/ssh_host_*' % chroot_dir)
+        for key in host_keys:
+            os.unlink(key)
+        return bool(host_keys)
 
     def mount_dev_proc(self):
         run_cmd('mount', '--bind', '/dev', '%s/dev' % self.context.chroot_dir)
@@ -106,17 +157,43 @@ class Potato(suite.Suite):
         self.run_in_target('mount', '-t', 'proc', 'proc', '/proc')
         self.context.add_clean_cb(self.unmount_proc)
 
+    def mount_package_cache(self, chroot_dir=None):
+        package_cache = self.context.package_cache
+        if package_cache:
+            package_cache.mount(chroot_dir or self.context.chroot_dir)
+            self.context.add_clean_cb(self.unmount_package_cache)
+
+    def unmount_package_cache(self):
+        self.context.cancel_cleanup(self.unmount_package_cache)
+        if self.context.package_cache:
+            self.context.package_cache.unmount()
+
+    def apt_get(self, *args, **kwargs):
+        """
+        Run apt-get in the target. Serialised against other builds
+        sharing the package cache, since they share apt's archive lock.
+        Its output is logged, but only the end of it is kept.
+        """
+        kwargs.setdefault('capture', CAPTURE_TAIL)
+        package_cache = self.context.package_cache
+        lock = package_cache and package_cache.mntpnt and package_cache.lock()
+        try:
+            return self.run_in_target('apt-get', *args, **kwargs)
+        finally:
+            if lock:
+                lock.close()
+
     def unmount_proc(self):
         self.context.cancel_cleanup(self.unmount_proc)
-        run_cmd('umount', '%s/proc' % self.context.chroot_dir)
+        umount('%s/proc' % self.context.chroot_dir)
 
     def unmount_dev_pts(self):
         self.context.cancel_cleanup(self.unmount_dev_pts)
-        run_cmd('umount', '%s/dev/pts' % self.context.chroot_dir)
+        umount('%s/dev/pts' % self.context.chroot_dir)
 
     def unmount_dev(self):
         self.context.cancel_cleanup(self.unmount_dev)
-        run_cmd('umount', '%s/dev' % self.context.chroot_dir)
+        umount('%s/dev' % self.context.chroot_dir)
 
     def update_passwords(self):
         # Set the user password, using md5
@@ -144,12 +221,16 @@ class Potato(suite.Suite):
         user = self.context.get_setting('user')
 
         if user:
-            if uid:
+            if self.user_exists(user):
+                # A prebuilt system may have it already
+                self.run_in_target('usermod', '-c', name, *((uid and ['-u', uid] or []) + [user]))
+            elif uid:
                 self.run_in_target('adduser', '--disabled-password', '--uid', uid, '--gecos', name, user)
             else:
                 self.run_in_target('adduser', '--disabled-password', '--gecos', name, user)
 
-            self.run_in_target('addgroup', '--system', 'admin')
+            if not self.run_in_target('getent', 'group', 'admin', ignore_fail=True).strip():
+                self.run_in_target('addgroup', '--system', 'admin')
             self.run_in_target('adduser', user, 'admin')
 
             self.install_from_template('/etc/sudoers', 'sudoers')
@@ -158,6 +239,19 @@ class Potato(suite.Suite):
 
         self.update_passwords()
 
+    def add_package_intents(self):
+        """Register the packages this suite wants installed or removed"""
+        self.context.add_packages(*(self.context.get_setting('addpkg') or []))
+        self.context.remove_packages(*(self.context.get_setting('removepkg') or []))
+        # The kernel stays out of the batch: its postinst needs the
+        # kernel-img.conf and fstab written later, see install_kernel
+
+        user = self.context.get_setting('user')
+        ssh_key = self.context.get_setting('ssh-key')
+        ssh_user_key = self.context.get_setting('ssh-user-key')
+        if (user and ssh_user_key) or ssh_key:
+            self.context.add_packages('openssh-server')
+
     def kernel_name(self):
         flavour = self.context.get_setting('flavour')
         arch = self.context.get_setting('arch')
@@ -185,6 +279,23 @@ class Potato(suite.Suite):
     def prevent_daemons_starting(self):
         os.chmod(self.install_from_template('/usr/sbin/policy-rc.d', 'nostart-policy-rc.d'), 0755)
 
+    def enable_unsafe_io(self):
+        if not self.context.get_setting('unsafe-io'):
+            return
+        if not self.dpkg_unsafe_io:
+            logging.info('dpkg in this suite does not support unsafe I/O. Ignoring --unsafe-io.')
+            return
+        self.context.install_file(self.unsafe_io_conf, '# Added by vmbuilder. Removed again once the installation is done.\nforce-unsafe-io\n')
+        self.context.add_clean_cb(self.disable_unsafe_io)
+
+    def disable_unsafe_io(self):
+        self.context.cancel_cleanup(self.disable_unsafe_io)
+        path = '%s%s' % (self.context.chroot_dir, self.unsafe_io_conf)
+        if os.path.exists(path):
+            os.unlink(path)
+            # dpkg skipped all the fsyncs, so flush everything once
+            run_cmd('sync')
+
     def seed(self, seedfile):
         """Seed debconf with the contents of a seedfile"""
         logging.info('Seeding with "%s"' % seedfile)
@@ -196,21 +307,22 @@ class Potato(suite.Suite):
         if seedfile:
             self.seed(seedfile)
 
-        addpkg = self.context.get_setting('addpkg')
-        removepkg = self.context.get_setting('removepkg')
-        if not addpkg and not removepkg:
+        # Everything anyone asked for goes in in one transaction, so
+        # dependencies are resolved and triggers run only once.
+        (install, remove) = self.context.pending_packages()
+        if not install and not remove:
             return
 
-        cmd = ['apt-get', 'install', '-y', '--force-yes']
-        cmd += addpkg or []
-        cmd += ['%s-' % pkg for pkg in removepkg or []]
-        self.run_in_target(env={ 'DEBIAN_FRONTEND' : 'noninteractive' }, *cmd)
+        cmd = ['install', '-y', '--force-yes']
+        cmd += install
+        cmd += ['%s-' % pkg for pkg in remove]
+        self.apt_get(env={ 'DEBIAN_FRONTEND' : 'noninteractive' }, *cmd)
+        self.context.mark_packages_applied(install + remove)
 
     def unmount_volatile(self):
         for mntpnt in glob.glob('%s/lib/modules/*/volatile' % self.context.chroot_dir):
             logging.debug("Unmounting %s" % mntpnt)
-            run_cmd('sleep', '10')
-            run_cmd('umount', mntpnt)
+            umount(mntpnt)
 
     def install_menu_lst(self, disks):
         self.run_in_target(self.updategrub, '-y')
@@ -270,7 +382,8 @@ class Potato(suite.Suite):
 
         suite = self.context.get_setting('suite')
         cmd += [suite, self.context.chroot_dir, self.debootstrap_mirror()]
-        kwargs = { 'env' : { 'DEBIAN_FRONTEND' : 'noninteractive' } }
+        kwargs = { 'env' : { 'DEBIAN_FRONTEND' : 'noninteractive' },
+                   'capture' : CAPTURE_TAIL }
 
         proxy = self.context.get_setting('proxy')
         if proxy:
@@ -295,6 +408,8 @@ class Potato(suite.Suite):
         install_mirror = self.context.get_setting('install-mirror')
         if install_mirror:
             mirror = install_mirror
+        elif self.context.get_setting('mirror-candidates'):
+            mirror = self.fastest_mirror()
         else:
             mirror = self.context.get_setting('mirror')
 
@@ -308,8 +423,19 @@ class Potato(suite.Suite):
 
         return (mirror, updates_mirror, security_mirror)
 
+    def fastest_mirror(self):
+        # install_mirrors is called several times per build
+        if not self._fastest_mirror:
+            self._fastest_mirror = fastest_mirror(self.context.get_setting('mirror-candidates'),
+                                                  self.context.get_setting('suite'),
+                                                  proxy=self.context.get_setting('proxy'),
+                                                  ttl=self.context.get_setting('mirror-probe-ttl'))
+        return self._fastest_mirror
+
     def install_kernel(self, destdir):
-        run_cmd('chroot', destdir, 'apt-get', '--force-yes', '-y', 'install', self.kernel_name(), env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
+        self.mount_package_cache(destdir)
+        self.apt_get('--force-yes', '-y', 'install', self.kernel_name(), env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
+        self.unmount_package_cache()
 
     def install_grub(self, chroot_dir):
         self.install_from_template('/etc/kernel-img.conf', 'kernelimg', { 'updategrub' : self.updategrub })
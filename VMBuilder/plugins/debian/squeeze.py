@@ -20,4 +20,4 @@ import time
 from VMBuilder.plugins.debian.lenny import Lenny
 
 class Squeeze(Lenny):
-    pass
+    dpkg_unsafe_io = True
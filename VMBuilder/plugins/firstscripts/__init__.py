@@ -62,4 +62,7 @@ class Firstscripts(Plugin):
 
         return True
 
+    def stamp(self):
+        return self.post_install()
+
 register_distro_plugin(Firstscripts)
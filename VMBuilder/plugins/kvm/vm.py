@@ -17,7 +17,12 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from   VMBuilder import register_hypervisor, Hypervisor
+from   VMBuilder.baseimage import BaseImageCache, base_image_key
+from   VMBuilder.exception import VMBuilderUserError
+from   VMBuilder.stamp     import InstalledSystem
+from   VMBuilder.util      import tmpdir
 import VMBuilder
+import multiprocessing
 import os
 import stat
 
@@ -27,24 +32,63 @@ class KVM(Hypervisor):
     filetype = 'qcow2'
     preferred_storage = VMBuilder.hypervisor.STORAGE_DISK_IMAGE
     needs_bootloader = True
+    resume_attrs = ['imgs', 'cmdline']
 
     def register_options(self):
         group = self.setting_group('VM settings')
         group.add_setting('mem', extra_args=['-m'], type='int', default=128, help='Assign MEM megabytes of memory to the guest vm. [default: %default]')
         group.add_setting('cpus', type='int', default=1, help='Assign NUM cpus to the guest vm. [default: %default]')
+        group.add_setting('compress', type='bool', default=False, help='Write a compressed qcow2 image. [default: %default]')
+        group.add_setting('compress-level', type='int', default=6, metavar='LEVEL', help='zlib compression LEVEL (1-9) for --compress. [default: %default]')
+        group.add_setting('compress-jobs', type='int', default=multiprocessing.cpu_count(), metavar='N', help='Compress in N processes. The image comes out the same however many are used. [default: %default]')
+        group.add_setting('base-image-cache', metavar='DIR', help='Keep golden base images in DIR, one per suite, architecture, disk layout, package set and --uuid-seed (which is required), and write the disks as qcow2 overlays of them. Base images are never removed: clean out DIR when none of the vms built with it are needed anymore.')
+
+    def preflight_check(self):
+        if self.context.get_setting('base-image-cache') and not self.context.uuid_seed:
+            raise VMBuilderUserError('--base-image-cache needs --uuid-seed. Without it, every vm gets its own filesystem UUIDs and shares little with the base images.')
 
     def convert(self, disks, destdir):
         self.imgs = []
         self.cmdline = ['kvm', '-m', str(self.context.get_setting('mem'))]
         self.cmdline += ['-smp', str(self.context.get_setting('cpus'))]
-        for disk in disks:
-            img_path = disk.convert(destdir, self.filetype)
+        if self.context.get_setting('base-image-cache'):
+            cache = BaseImageCache(self.context.get_setting('base-image-cache'))
+            key = base_image_key(self.context)
+            bases = cache.bases_for(key, [disk.filename for disk in disks], self.strip_base_images)
+            for (disk, base) in zip(disks, bases):
+                if not disk.preallocated:
+                    disk.backing_file = base
+        compress_level = None
+        if self.context.get_setting('compress'):
+            compress_level = self.context.get_setting('compress-level')
+        for img_path in self.context.convert_disk_images(disks, destdir, self.filetype,
+                                                         compress_level,
+                                                         self.context.get_setting('compress-jobs')):
             self.imgs.append(img_path)
             self.call_hooks('fix_ownership', img_path)
             self.cmdline += ['-drive', 'file=%s' % os.path.basename(img_path)]
 
         self.cmdline += ['"$@"']
 
+    def strip_base_images(self, filenames):
+        """
+        Strip copies of this vm's disks of its identity: host keys,
+        passwords, accounts and such must not end up in the base images
+        every later vm can read through its backing files.
+        """
+        distro = self.context.distro
+        chroot_dir = distro.chroot_dir
+        mntdir = tmpdir()
+        system = InstalledSystem(filenames)
+        try:
+            system.mount(mntdir)
+            distro.set_chroot_dir(mntdir)
+            distro.strip_identity()
+        finally:
+            distro.set_chroot_dir(chroot_dir)
+            system.umount()
+            os.rmdir(mntdir)
+
     def deploy(self, destdir):
         # No need create run script if vm is registered with libvirt
         if self.context.get_setting('libvirt'):
@@ -42,15 +42,22 @@ class Salt(Plugin):
         group.add_setting('salt-minion-id', metavar='NAME', help='designed minion id')
         group.add_setting('salt-master', metavar='master', type='list', help='salt master addresses')
 
+    def preflight_check(self):
+        if self.context.get_setting('salt-minion-install'):
+            self.context.add_packages('salt-minion')
+
     def post_install(self):
         if not self.context.get_setting('salt-minion-install'):
             return
 
-        # install salt-minion
-        logging.info('Installing salt-minion')
-        self.context.suite.prevent_daemons_starting()
-        self.context.suite.run_in_target('apt-get', '--force-yes', '-y', 'install', 'salt-minion')
-        self.context.suite.unprevent_daemons_starting()
+        # salt-minion is normally installed along with all other packages
+        # while configuring the OS. Not so if we were handed an existing chroot.
+        if self.context.is_package_pending('salt-minion'):
+            logging.info('Installing salt-minion')
+            self.context.suite.prevent_daemons_starting()
+            self.context.suite.run_in_target('apt-get', '--force-yes', '-y', 'install', 'salt-minion')
+            self.context.suite.unprevent_daemons_starting()
+            self.context.mark_packages_applied(['salt-minion'])
 
         # configure salt-minion
         logging.info('Configuring salt-minion')
@@ -61,6 +61,8 @@ class Ubuntu(Distro):
         group.add_setting('mirror', metavar='URL', help='Use Ubuntu mirror at URL instead of the default, which is http://archive.ubuntu.com/ubuntu for official arches and http://ports.ubuntu.com/ubuntu-ports otherwise')
         group.add_setting('proxy', metavar='URL', help='Use proxy at URL for cached packages')
         group.add_setting('install-mirror', metavar='URL', help='Use Ubuntu mirror at URL for the installation only. Apt\'s sources.list will still use default or URL set by --mirror')
+        group.add_setting('mirror-candidates', type='list', metavar='URLS', help='Install from whichever of these mirrors serves the suite fastest. Like --install-mirror, this does not affect apt\'s sources.list.')
+        group.add_setting('mirror-probe-ttl', type='int', metavar='SECONDS', default=86400, help='Reuse the ranking of --mirror-candidates for SECONDS before probing them again [default: %default]')
         group.add_setting('security-mirror', metavar='URL', help='Use Ubuntu security mirror at URL instead of the default, which is http://security.ubuntu.com/ubuntu for official arches and http://ports.ubuntu.com/ubuntu-ports otherwise.')
         group.add_setting('install-security-mirror', metavar='URL', help='Use the security mirror at URL for installation only. Apt\'s sources.list will still use default or URL set by --security-mirror')
         group.add_setting('components', type='list', metavar='COMPS', help='A comma seperated list of distro components to include (e.g. main,universe).')
@@ -69,6 +71,7 @@ class Ubuntu(Distro):
         group.add_setting('extra-aptkeys', metavar='FILE', help='Local (host) files that should be import into the apt keyring')
         group.add_setting('lang', metavar='LANG', default=get_locale(), help='Set the locale to LANG [default: %default]')
         group.add_setting('timezone', metavar='TZ', default='UTC', help='Set the timezone to TZ in the vm. [default: %default]')
+        group.add_setting('unsafe-io', type='bool', default=False, help='Let dpkg skip fsync while installing packages into the chroot, and sync once at the end instead. Only safe because the chroot is thrown away if the build fails. [default: %default]')
 
         group = self.setting_group('Settings for the initial user')
         group.add_setting('user', default=None, help='Username of initial user [default: %default]')
@@ -130,6 +133,8 @@ class Ubuntu(Distro):
         if seedfile and not os.path.exists(seedfile):
             raise VMBuilderUserError("Seedfile '%s' does not exist" % seedfile)
 
+        self.suite.add_package_intents()
+
         lang = self.get_setting('lang')
 
 # FIXME
@@ -147,7 +152,9 @@ class Ubuntu(Distro):
         self.suite.install_sources_list()
         self.suite.create_devices()
         self.suite.prevent_daemons_starting()
+        self.suite.enable_unsafe_io()
         self.suite.mount_dev_proc()
+        self.suite.mount_package_cache()
         self.suite.install_extras()
         self.suite.create_initial_user()
         self.suite.install_authorized_keys()
@@ -155,14 +162,45 @@ class Ubuntu(Distro):
         self.suite.set_locale()
         self.suite.update()
         self.suite.install_sources_list(final=True)
+        self.suite.unmount_package_cache()
         self.suite.run_in_target('apt-get', 'clean');
         self.suite.unmount_volatile()
         self.suite.unmount_proc()
         self.suite.unmount_dev_pts()
         self.suite.unmount_dev()
         self.suite.unprevent_daemons_starting()
+        self.suite.disable_unsafe_io()
         self.suite.create_manifest()
 
+    def stamp(self):
+        self.suite.mount_dev_proc()
+        self.suite.reset_identity()
+        self.suite.create_initial_user()
+        self.suite.install_authorized_keys()
+        self.suite.unmount_proc()
+        self.suite.unmount_dev_pts()
+        self.suite.unmount_dev()
+
+    def strip_identity(self):
+        """
+        Strip an installed system, mounted at the chroot, of everything
+        that identifies the vm it was built for, host name included, so
+        that it can be shared with other vms.
+        """
+        self.suite.mount_dev_proc()
+        self.suite.strip_identity()
+        self.suite.unmount_proc()
+        self.suite.unmount_dev_pts()
+        self.suite.unmount_dev()
+
+        self.install_file('/etc/hostname', 'localhost\n')
+        hosts = '%s/etc/hosts' % self.chroot_dir
+        if os.path.exists(hosts):
+            fp = open(hosts, 'r')
+            lines = [line for line in fp if not line.startswith('127.0.1.1')]
+            fp.close()
+            self.install_file('/etc/hosts', ''.join(lines))
+
     def configure_networking(self, nics):
         self.suite.config_host_and_domainname()
         self.suite.config_interfaces(nics)
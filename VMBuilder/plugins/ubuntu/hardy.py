@@ -16,7 +16,6 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import time
 from VMBuilder.plugins.ubuntu.gutsy import Gutsy
 
 class Hardy(Gutsy):
@@ -24,13 +23,18 @@ class Hardy(Gutsy):
     ec2_kernel_info = { 'i386' : 'aki-6e709707', 'amd64' : 'aki-6f709706' }
     ec2_ramdisk_info = { 'i386' : 'ari-6c709705', 'amd64' : 'ari-61709708' }
 
+    ec2_packages = ['ec2-init',
+                    'openssh-server',
+                    'ec2-modules',
+                    'standard^',
+                    'ec2-ami-tools',
+                    'update-motd']
+
     def apply_ec2_settings(self):
-        self.context.addpkg += ['ec2-init',
-                          'openssh-server',
-                          'ec2-modules',
-                          'standard^',
-                          'ec2-ami-tools',
-                          'update-motd']
+        self.context.add_packages(*self.ec2_packages)
+        if self.context.get_setting('arch') == 'i386':
+            self.context.add_packages('libc6-xen')
+            self.context.remove_packages('libc6-i686')
 
         if not self.context.ppa:
             self.context.ppa = []
@@ -39,9 +43,7 @@ class Hardy(Gutsy):
 
     def install_ec2(self):
 
-        if self.context.arch == 'i386':
-            self.run_in_target('apt-get' ,'--force-yes', '-y', 'install', 'libc6-xen')
-            self.run_in_target('apt-get','--purge','--force-yes', '-y', 'remove', 'libc6-i686')
+        if self.context.get_setting('arch') == 'i386':
             self.install_from_template('/etc/ld.so.conf.d/libc6-xen.conf', 'xen-ld-so-conf')
         self.install_from_template('/etc/event.d/xvc0', 'upstart', { 'console' : 'xvc0' })
         self.run_in_target('update-rc.d', '-f', 'hwclockfirst.sh', 'remove')
@@ -57,9 +59,3 @@ class Hardy(Gutsy):
 
     def has_256_bit_inode_ext3_support(self):
         return True
-
-    def unmount_dev(self):
-        # no idea why, but something keep /dev busy briefly during the
-        # bootstrap
-        time.sleep(1)
-        super(Hardy, self).unmount_dev()
@@ -29,10 +29,10 @@ class Intrepid(Hardy):
     ec2_kernel_info = { 'i386' : 'aki-714daa18', 'amd64' : 'aki-4f4daa26' }
     ec2_ramdisk_info = { 'i386': 'ari-7e4daa17', 'amd64' : 'ari-4c4daa25' }
 
+    # policykit is a workaround for policy bug on ubuntu-server. (see bug #275432)
+    ec2_packages = Hardy.ec2_packages + ['policykit', 'server^']
+
     def install_ec2(self):
-# workaround for policy bug on ubuntu-server. (see bug #275432)
-        self.run_in_target('apt-get', '--force-yes', '-y', 'install', 'policykit')
-        self.run_in_target('apt-get', '--force-yes', '-y', 'install', 'server^')
         self.install_from_template('/etc/update-motd.d/51_update-motd', '51_update-motd')
         self.run_in_target('chmod', '755', '/etc/update-motd.d/51_update-motd')
         self.install_from_template('/etc/ec2-init/is-compat-env', 'is-compat-env')
@@ -19,6 +19,7 @@
 import os
 import VMBuilder.disk as disk
 from   VMBuilder.util import run_cmd
+from   VMBuilder.plugins.ubuntu.hardy import Hardy
 from   VMBuilder.plugins.ubuntu.intrepid import Intrepid
 
 class Jaunty(Intrepid):
@@ -30,8 +31,9 @@ class Jaunty(Intrepid):
     ec2_ramdisk_info = { 'i386' : 'ari-c253b4ab', 'amd64' : 'ari-d753b4be' }
     chpasswd_cmd= [ 'chpasswd' ]
 
+    ec2_packages = Hardy.ec2_packages + ['server^']
+
     def install_ec2(self):
-        self.run_in_target('apt-get', '--force-yes', '-y', 'install', 'server^')
         self.install_from_template('/etc/update-motd.d/51_update-motd', '51_update-motd')
         # lucid and later wont have an /etc/ec2-init, so only write
         # that file if the dir exists
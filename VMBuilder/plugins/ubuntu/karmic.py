@@ -25,9 +25,10 @@ class Karmic(Jaunty):
 
     preferred_filesystem = 'ext4'
 
+    ec2_packages = ['standard^', 'uec^']
+
     def apply_ec2_settings(self):
-        self.context.addpkg += ['standard^',
-                          'uec^']
+        self.context.add_packages(*self.ec2_packages)
 
     def pre_install(self):
         self.context.install_file('/etc/hosts', contents='')
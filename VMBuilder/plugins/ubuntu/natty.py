@@ -19,4 +19,4 @@
 from   VMBuilder.plugins.ubuntu.maverick import Maverick
 
 class Natty(Maverick):
-    pass
+    dpkg_unsafe_io = True
@@ -28,6 +28,7 @@ import VMBuilder.hypervisor
 class VirtualBox(Hypervisor):
     preferred_storage = VMBuilder.hypervisor.STORAGE_DISK_IMAGE
     needs_bootloader = True
+    resume_attrs = ['imgs']
     name = 'VirtualBox'
     arg = 'vbox'
 
@@ -38,10 +39,7 @@ class VirtualBox(Hypervisor):
         group.add_setting('vbox-disk-format', metavar='FORMAT', default='vdi', help='Desired disk format. Valid options are: vdi vmdk. [default: %default]')
 
     def convert(self, disks, destdir):
-        self.imgs = []
-        for disk in disks:
-            img_path = disk.convert(destdir, self.context.get_setting('vbox-disk-format'))
-            self.imgs.append(img_path)
+        self.imgs = self.context.convert_disk_images(disks, destdir, self.context.get_setting('vbox-disk-format'))
 
     def deploy(self,destdir):
         hostname = self.context.distro.get_setting('hostname')
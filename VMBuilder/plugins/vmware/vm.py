@@ -19,6 +19,7 @@
 from   VMBuilder import register_hypervisor, Hypervisor
 import VMBuilder
 import VMBuilder.hypervisor
+import multiprocessing
 import os
 import os.path
 import stat
@@ -30,16 +31,24 @@ class VMWare(Hypervisor):
     preferred_storage = VMBuilder.hypervisor.STORAGE_DISK_IMAGE
     needs_bootloader = True
     vmxtemplate = 'vmware'
+    resume_attrs = ['imgs']
 
     def register_options(self):
         group = self.setting_group('VM settings')
         group.add_setting('mem', extra_args=['-m'], default='128', help='Assign MEM megabytes of memory to the guest vm. [default: %default]')
         group.add_setting('cpus', type='int', default=1, help='Assign NUM cpus to the guest vm. [default: %default]')
+        group.add_setting('compress', type='bool', default=False, help='Write a compressed streamOptimized vmdk image, for importing through OVF tools. [default: %default]')
+        group.add_setting('compress-level', type='int', default=6, metavar='LEVEL', help='zlib compression LEVEL (1-9) for --compress. [default: %default]')
+        group.add_setting('compress-jobs', type='int', default=multiprocessing.cpu_count(), metavar='N', help='Compress in N processes. The image comes out the same however many are used. [default: %default]')
 
     def convert(self, disks, destdir):
         self.imgs = []
-        for disk in self.get_disks():
-            img_path = disk.convert(destdir, self.filetype)
+        compress_level = None
+        if self.context.get_setting('compress'):
+            compress_level = self.context.get_setting('compress-level')
+        for img_path in self.context.convert_disk_images(self.get_disks(), destdir, self.filetype,
+                                                         compress_level,
+                                                         self.context.get_setting('compress-jobs')):
             self.imgs.append(img_path)
             self.call_hooks('fix_ownership', img_path)
 
@@ -89,6 +98,7 @@ class VMWareEsxi(VMWare):
     vmxtemplate = 'esxi.vmx'
 
     vmdks = [] # vmdk filenames used when deploying vmx file
+    resume_attrs = ['imgs', 'vmdks']
 
     def convert(self, disks, destdir):
         self.imgs = []
@@ -0,0 +1,286 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    qcow2 image writer
+
+import logging
+import os
+import struct
+from   VMBuilder.sparse import compress_clusters, read_clusters
+
+QCOW_MAGIC = 'QFI\xfb'
+QCOW_VERSION = 2
+QCOW_OFLAG_COPIED = 1 << 63
+QCOW_OFLAG_COMPRESSED = 1 << 62
+HEADER = '>4sIQIIQIIQQIIQ'
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+# qemu inflates compressed clusters with a 4KB window
+DEFLATE_WBITS = -12
+
+class Qcow2Writer(object):
+    """
+    Writes a qcow2 (version 2) image cluster by cluster.
+
+    Data clusters are appended to the image in the order they are
+    handed to L{write_cluster} or L{write_compressed}, and all-zero
+    clusters are left out altogether. Compressed clusters are packed
+    back to back, so several of them can share a host cluster. The L2
+    tables, the L1 table and the refcounts are only worked out and
+    written behind the data when the image is closed, so producers can
+    stream clusters into the image as they generate them, without
+    knowing up front how many there will be.
+
+    An image with a backing file is an overlay: clusters left out of it
+    are read from the backing file, so all-zero clusters are written
+    like any other.
+
+    @type  filename: string
+    @param filename: The image to write
+    @type  size: number
+    @param size: Virtual size of the image in bytes
+    @type  cluster_bits: number
+    @param cluster_bits: log2 of the cluster size (16, i.e. 64KB, is
+        what qemu-img uses as well)
+    @type  backing_file: string
+    @param backing_file: The raw image this one is an overlay of
+    """
+
+    def __init__(self, filename, size, cluster_bits=16, backing_file=None):
+        self.filename = filename
+        self.size = size
+        self.backing_file = backing_file
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.l2_entries = self.cluster_size / 8
+        self.mapping = {}
+        "Guest cluster index -> L2 entry of each cluster written so far"
+        self.refcounts = {}
+        "Host cluster index -> number of guest clusters stored in it"
+        self._zero = '\0' * self.cluster_size
+        self._fp = open(filename, 'wb')
+        # Cluster 0 is reserved for the header
+        self._pos = self.cluster_size
+
+    def write_cluster(self, index, data):
+        """
+        Write one guest cluster.
+
+        @type  index: number
+        @param index: The guest cluster (offset / cluster size)
+        @type  data: string
+        @param data: The cluster's contents. Shorter data is zero padded.
+        """
+        if len(data) < self.cluster_size:
+            data = data.ljust(self.cluster_size, '\0')
+        if index in self.mapping:
+            if self.mapping[index] & QCOW_OFLAG_COMPRESSED:
+                raise ValueError('Cluster %d is compressed and cannot be rewritten' % index)
+            offset = self.mapping[index] & ~QCOW_OFLAG_COPIED
+        elif data == self._zero and not self.backing_file:
+            return
+        else:
+            offset = self._pos + (self.cluster_size - self._pos % self.cluster_size) % self.cluster_size
+            self._pos = offset + self.cluster_size
+            self.refcounts[offset >> self.cluster_bits] = 1
+            self.mapping[index] = offset | QCOW_OFLAG_COPIED
+        self._fp.seek(offset)
+        self._fp.write(data)
+
+    def write_compressed(self, index, compressed):
+        """
+        Write one compressed guest cluster.
+
+        @type  index: number
+        @param index: The guest cluster (offset / cluster size)
+        @type  compressed: string
+        @param compressed: The cluster's contents as a raw deflate stream
+            (see L{DEFLATE_WBITS}), shorter than a cluster
+        """
+        if index in self.mapping:
+            raise ValueError('Cluster %d has been written already' % index)
+        offset = self._pos
+        end = offset + len(compressed)
+        # The entry holds the number of 512 byte sectors the data
+        # reaches into beyond the first one
+        sectors = ((end - 1) >> 9) - (offset >> 9)
+        self.mapping[index] = (QCOW_OFLAG_COMPRESSED |
+                               (sectors << (62 - (self.cluster_bits - 8))) |
+                               offset)
+        for cluster in range(offset >> self.cluster_bits, ((end - 1) >> self.cluster_bits) + 1):
+            self.refcounts[cluster] = self.refcounts.get(cluster, 0) + 1
+        self._pos = end
+        self._fp.seek(offset)
+        self._fp.write(compressed)
+
+    def close(self):
+        """Write out the metadata and close the image."""
+        cs = self.cluster_size
+        clusters = (self.size + cs - 1) / cs
+        l1_size = (clusters + self.l2_entries - 1) / self.l2_entries
+        l1_clusters = (l1_size * 8 + cs - 1) / cs
+        data_clusters = (self._pos + cs - 1) / cs
+
+        l2_tables = {}
+        for (index, entry) in self.mapping.iteritems():
+            table = l2_tables.setdefault(index / self.l2_entries, [0] * self.l2_entries)
+            table[index % self.l2_entries] = entry
+
+        # The refcounts have to cover themselves, too
+        rb_entries = cs / 2
+        base = data_clusters + len(l2_tables) + l1_clusters
+        (rb_clusters, rt_clusters) = (0, 0)
+        while True:
+            total = base + rb_clusters + rt_clusters
+            needed = ((total + rb_entries - 1) / rb_entries,)
+            needed += ((needed[0] * 8 + cs - 1) / cs,)
+            if needed == (rb_clusters, rt_clusters):
+                break
+            (rb_clusters, rt_clusters) = needed
+
+        cluster = data_clusters
+        l1 = [0] * l1_size
+        for l2_index in sorted(l2_tables):
+            l1[l2_index] = (cluster << self.cluster_bits) | QCOW_OFLAG_COPIED
+            self._fp.seek(cluster << self.cluster_bits)
+            self._fp.write(struct.pack('>%dQ' % self.l2_entries, *l2_tables[l2_index]))
+            cluster += 1
+
+        l1_offset = cluster << self.cluster_bits
+        self._fp.seek(l1_offset)
+        self._fp.write(struct.pack('>%dQ' % l1_size, *l1))
+        cluster += l1_clusters
+
+        # The header and all metadata clusters are used once, data
+        # clusters by as many guest clusters as they hold
+        refcounts = [1] + [self.refcounts.get(i, 0) for i in range(1, data_clusters)]
+        refcounts += [1] * (total - data_clusters)
+        rb_offset = cluster << self.cluster_bits
+        self._fp.seek(rb_offset)
+        self._fp.write(struct.pack('>%dH' % total, *refcounts))
+        cluster += rb_clusters
+
+        rt_offset = cluster << self.cluster_bits
+        self._fp.seek(rt_offset)
+        self._fp.write(struct.pack('>%dQ' % rb_clusters,
+                                   *[rb_offset + i * cs for i in range(rb_clusters)]))
+
+        # The backing file's name goes behind the header extensions in
+        # cluster 0. Stating its format keeps qemu from probing it.
+        (backing_offset, backing_size, extensions) = (0, 0, '')
+        if self.backing_file:
+            extensions = struct.pack('>II8s', EXT_BACKING_FORMAT, 3, 'raw')
+            extensions += struct.pack('>II', 0, 0)
+            backing_offset = struct.calcsize(HEADER) + len(extensions)
+            backing_size = len(self.backing_file)
+        self._fp.seek(0)
+        self._fp.write(struct.pack(HEADER, QCOW_MAGIC, QCOW_VERSION,
+                                   backing_offset, backing_size,
+                                   self.cluster_bits, self.size, 0,
+                                   l1_size, l1_offset,
+                                   rt_offset, rt_clusters,
+                                   0, 0))
+        self._fp.write(extensions)
+        self._fp.write(self.backing_file or '')
+        self._fp.truncate(total * cs)
+        self._fp.close()
+
+def convert(raw, dest, cluster_bits=16, compress_level=None, jobs=1):
+    """
+    Convert a raw image to qcow2.
+
+    Only the allocated parts of L{raw} are read, so the time this takes
+    depends on how much of the image is used rather than on its size.
+
+    @type  raw: string
+    @param raw: The raw image
+    @type  dest: string
+    @param dest: The qcow2 image to write
+    @type  compress_level: number
+    @param compress_level: zlib compression level (1-9) for compressed
+        clusters, or None to write them uncompressed
+    @type  jobs: number
+    @param jobs: Number of processes to compress clusters in. The image
+        comes out the same no matter how many there are.
+    """
+    fd = os.open(raw, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        writer = Qcow2Writer(dest, size, cluster_bits)
+        _write_clusters(writer, read_clusters(fd, size, writer.cluster_size), compress_level, jobs)
+    finally:
+        os.close(fd)
+
+def write_overlay(raw, base, dest, cluster_bits=16, compress_level=None, jobs=1):
+    """
+    Write the difference between two raw images of the same size as a
+    qcow2 overlay of the first.
+
+    @type  raw: string
+    @param raw: The raw image to convert
+    @type  base: string
+    @param base: The raw image to use as the backing file
+    @type  dest: string
+    @param dest: The qcow2 image to write
+
+    See L{convert} for the rest.
+    """
+    fd = os.open(raw, os.O_RDONLY)
+    base_fd = os.open(base, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if os.fstat(base_fd).st_size != size:
+            raise ValueError('%s and %s differ in size' % (raw, base))
+        writer = Qcow2Writer(dest, size, cluster_bits, backing_file=os.path.abspath(base))
+        cs = writer.cluster_size
+
+        def pread(fd, index):
+            os.lseek(fd, index * cs, os.SEEK_SET)
+            return os.read(fd, cs).ljust(cs, '\0')
+
+        def changed():
+            written = set()
+            for (index, data) in read_clusters(fd, size, cs):
+                if pread(base_fd, index) != data:
+                    written.add(index)
+                    yield (index, data)
+            # What was cleared since has to be cleared in the overlay, too
+            for (index, data) in read_clusters(base_fd, size, cs):
+                if index not in written and pread(fd, index) != data:
+                    yield (index, '\0' * cs)
+
+        _write_clusters(writer, changed(), compress_level, jobs)
+    finally:
+        os.close(base_fd)
+        os.close(fd)
+
+def _write_clusters(writer, clusters, compress_level, jobs):
+    cs = writer.cluster_size
+    if compress_level is None:
+        for (index, data) in clusters:
+            writer.write_cluster(index, data)
+    else:
+        for (index, data, compressed) in compress_clusters(clusters, compress_level,
+                                                           DEFLATE_WBITS, jobs):
+            if len(compressed) < cs:
+                writer.write_compressed(index, compressed)
+            else:
+                # Not worth it
+                writer.write_cluster(index, data)
+    writer.close()
+    logging.debug('Wrote %d of %d clusters to %s' % (len(writer.mapping), (writer.size + cs - 1) / cs, writer.filename))
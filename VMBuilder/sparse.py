@@ -0,0 +1,167 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Reading and compressing sparse images
+
+import errno
+import fcntl
+import itertools
+import multiprocessing
+import os
+import zlib
+
+# From <unistd.h>. Python 2's os module doesn't have them.
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# From <linux/fs.h>
+FICLONE = 0x40049409
+
+def data_extents(fd, size):
+    """
+    Find the parts of a file that hold data.
+
+    @rtype:  list
+    @return: (offset, length) for each extent. The whole file if the
+             filesystem can't tell holes from data.
+    """
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # No data beyond offset
+                break
+            if e.errno == errno.EINVAL and offset == 0:
+                return [(0, size)]
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        extents.append((start, min(end, size) - start))
+        offset = end
+    return extents
+
+def read_clusters(fd, size, cluster_size):
+    """
+    Read the clusters of a file that hold data.
+
+    Only the allocated parts of the file are read, so the time this
+    takes depends on how much of the file is used rather than on its
+    size. All-zero clusters are skipped.
+
+    @rtype:  generator
+    @return: (index, data) for each cluster, in order. A short cluster
+             at the end of the file is padded with zeros.
+    """
+    cs = cluster_size
+    zero = '\0' * cs
+    done = 0
+    for (offset, length) in data_extents(fd, size):
+        # Extents need not be cluster aligned, so neighbouring
+        # extents can share a cluster that has been read already
+        pos = max(offset - offset % cs, done)
+        end = offset + length
+        end += (cs - end % cs) % cs
+        while pos < end:
+            os.lseek(fd, pos, os.SEEK_SET)
+            data = os.read(fd, min(16 * cs, end - pos))
+            if not data:
+                break
+            for i in range(0, len(data), cs):
+                cluster = data[i:i+cs].ljust(cs, '\0')
+                if cluster != zero:
+                    yield ((pos + i) / cs, cluster)
+            pos += len(data)
+        done = pos
+
+def deflate(args):
+    """
+    @type  args: tuple
+    @param args: (data, level, wbits), packed up for L{multiprocessing.Pool.map}
+    @rtype:  string
+    @return: L{data} compressed at L{level}. L{wbits} is passed on to
+             zlib: negative for a raw deflate stream, 15 for zlib format.
+    """
+    (data, level, wbits) = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_clusters(clusters, level, wbits, jobs=1, batch=64):
+    """
+    Compress L{clusters} across L{jobs} worker processes.
+
+    The clusters are handed to the workers L{batch} per worker at a
+    time, and the next batch is compressed while the previous one is
+    being consumed. Each cluster is compressed on its own, so the output
+    doesn't depend on the number of workers.
+
+    @type  clusters: iterable
+    @param clusters: (index, data) pairs as from L{read_clusters}
+    @rtype:  generator
+    @return: (index, data, compressed) for each cluster, in order
+    """
+    clusters = iter(clusters)
+    if jobs <= 1:
+        for (index, data) in clusters:
+            yield (index, data, deflate((data, level, wbits)))
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = None
+        while True:
+            chunk = list(itertools.islice(clusters, jobs * batch))
+            job = chunk and (chunk, pool.map_async(deflate, [(data, level, wbits) for (index, data) in chunk]))
+            if pending:
+                (previous, result) = pending
+                for ((index, data), compressed) in zip(previous, result.get()):
+                    yield (index, data, compressed)
+            if not job:
+                break
+            pending = job
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def copy(src, dest):
+    """
+    Copy L{src} to L{dest}, leaving holes where L{src} has holes or
+    all-zero clusters. On filesystems that can share extents between
+    files, the copy is a clone that takes no time at all.
+    """
+    cs = 64 * 1024
+    fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        fp = open(dest, 'wb')
+        try:
+            try:
+                fcntl.ioctl(fp.fileno(), FICLONE, fd)
+                return
+            except IOError:
+                pass
+            for (index, data) in read_clusters(fd, size, cs):
+                fp.seek(index * cs)
+                fp.write(data)
+            fp.truncate(size)
+        finally:
+            fp.close()
+    finally:
+        os.close(fd)
@@ -0,0 +1,127 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Mounting installed disk images
+
+import logging
+import os
+import os.path
+import VMBuilder.parttable as parttable
+from   VMBuilder.exception import VMBuilderUserError
+from   VMBuilder.loop      import LoopDevice
+from   VMBuilder.util      import run_cmd, umount
+
+# Filesystems in fstab that don't live on any of the disks
+VIRTUAL_FSTYPES = ['proc', 'sysfs', 'tmpfs', 'devpts', 'swap', 'none']
+
+class InstalledSystem(object):
+    """
+    The filesystems on the disk images of an installed system, mounted
+    the way the system's own /etc/fstab says.
+
+    @type  filenames: list
+    @param filenames: The disk images, partitioned or not
+    """
+
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.loops = []
+        self.mounts = []
+
+    def mount(self, mntdir):
+        """
+        Mount the root filesystem at L{mntdir} and everything else its
+        fstab lists below it.
+        """
+        for filename in self.filenames:
+            for (offset, length, type) in parttable.read(filename) or [(0, 0, None)]:
+                loop = LoopDevice(filename, offset, length)
+                loop.attach()
+                self.loops.append(loop)
+        devices = [(loop.device, blkid(loop.device)) for loop in self.loops]
+
+        for (device, attrs) in devices:
+            if attrs.get('TYPE') in [None, 'swap']:
+                continue
+            self._mount(device, mntdir)
+            if os.path.exists('%s/etc/fstab' % mntdir):
+                break
+            umount(self.mounts.pop())
+        else:
+            raise VMBuilderUserError('Could not find an installed system on %s' % ', '.join(self.filenames))
+
+        entries = parse_fstab('%s/etc/fstab' % mntdir)
+        for (spec, mntpnt, fstype) in sorted(entries, key=lambda entry: entry[1].count('/')):
+            if mntpnt == '/' or not mntpnt.startswith('/') or fstype in VIRTUAL_FSTYPES:
+                continue
+            matches = [device for (device, attrs) in devices if matches_spec(spec, attrs)]
+            if not matches:
+                logging.warning('Not mounting %s: %s is not on any of the disks' % (mntpnt, spec))
+                continue
+            self._mount(matches[0], '%s%s' % (mntdir, mntpnt))
+
+    def umount(self):
+        """Unmount everything and let go of the loop devices."""
+        while self.mounts:
+            umount(self.mounts.pop())
+        while self.loops:
+            self.loops.pop().detach()
+
+    def _mount(self, device, mntpnt):
+        if not os.path.isdir(mntpnt):
+            os.makedirs(mntpnt)
+        run_cmd('mount', device, mntpnt)
+        self.mounts.append(mntpnt)
+
+def blkid(device):
+    """
+    @rtype:  dict
+    @return: what blkid knows about L{device} (TYPE, UUID, LABEL, ...)
+    """
+    attrs = {}
+    for line in run_cmd('blkid', '-o', 'export', device, ignore_fail=True).splitlines():
+        if '=' in line:
+            (key, value) = line.split('=', 1)
+            attrs[key] = value
+    return attrs
+
+def parse_fstab(filename):
+    """
+    @rtype:  list
+    @return: (spec, mount point, type) for each entry in L{filename}
+    """
+    entries = []
+    for line in open(filename):
+        fields = line.split()
+        if len(fields) < 3 or fields[0].startswith('#'):
+            continue
+        entries.append(tuple([field.replace('\\040', ' ') for field in fields[:3]]))
+    return entries
+
+def matches_spec(spec, attrs):
+    """
+    @rtype:  boolean
+    @return: whether the device L{attrs} describes is the one fstab
+             means by L{spec}
+    """
+    for (prefix, key) in [('UUID=', 'UUID'), ('LABEL=', 'LABEL'),
+                          ('/dev/disk/by-uuid/', 'UUID'),
+                          ('/dev/disk/by-label/', 'LABEL')]:
+        if spec.startswith(prefix):
+            return attrs.get(key) == spec[len(prefix):]
+    return False
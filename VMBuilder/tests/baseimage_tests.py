@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import VMBuilder.baseimage as baseimage
+from VMBuilder.baseimage import BaseImageCache, base_image_key
+
+class Distro(object):
+    def __init__(self, suite, packages):
+        self.settings = { 'suite' : suite, 'arch' : 'amd64' }
+        self.packages = packages
+
+    def get_setting(self, name):
+        return self.settings[name]
+
+    def applied_packages(self):
+        return self.packages
+
+class Partition(object):
+    def __init__(self, begin, end, mntpnt):
+        (self.begin, self.end, self.type, self.mntpnt) = (begin, end, 'ext4', mntpnt)
+
+class Disk(object):
+    def __init__(self, size, partitions):
+        (self.size, self.partitions) = (size, partitions)
+
+class Hypervisor(object):
+    def __init__(self, suite='precise', packages=['openssh-server'], root_end=4000, uuid_seed='seed'):
+        self.distro = Distro(suite, packages)
+        self.uuid_seed = uuid_seed
+        self.disks = [Disk(5000, [Partition(0, root_end, '/'), Partition(root_end + 1, 4999, '/var')])]
+
+class TestBaseImage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = BaseImageCache(os.path.join(self.tmpdir, 'bases'))
+        self.image = os.path.join(self.tmpdir, 'disk0.raw')
+        self.write(self.image, 'first')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, contents):
+        fp = open(filename, 'w')
+        fp.write(contents)
+        fp.close()
+
+    def test_base_image_key(self):
+        key = base_image_key(Hypervisor())
+        self.assertEqual(key, base_image_key(Hypervisor()))
+        self.assertNotEqual(key, base_image_key(Hypervisor(suite='trusty')))
+        self.assertNotEqual(key, base_image_key(Hypervisor(packages=['openssh-server', 'vim'])))
+        self.assertNotEqual(key, base_image_key(Hypervisor(root_end=3000)))
+        self.assertNotEqual(key, base_image_key(Hypervisor(uuid_seed='other')))
+
+    def strip(self, filenames):
+        self.stripped = filenames
+        for filename in filenames:
+            self.write(filename, 'stripped ' + open(filename).read())
+
+    def test_bases_for(self):
+        bases = self.cache.bases_for('key', [self.image], self.strip)
+        self.assertEqual(bases, [self.cache.path('key', 0)])
+        self.assertEqual(open(bases[0]).read(), 'stripped first')
+        self.assertEqual(self.stripped, ['%s.%d.new' % (bases[0], os.getpid())])
+
+        # Later builds use the stored base as it is
+        self.write(self.image, 'second')
+        self.stripped = None
+        self.assertEqual(self.cache.bases_for('key', [self.image], self.strip), bases)
+        self.assertEqual(self.stripped, None)
+        self.assertEqual(open(bases[0]).read(), 'stripped first')
+        self.assertEqual(os.listdir(self.cache.directory), [os.path.basename(bases[0])])
+
+    def test_bases_for_race(self):
+        # Another build publishes the base while we are copying ours
+        base = self.cache.path('key', 0)
+        copy = baseimage.sparse.copy
+        def racing_copy(src, dest):
+            copy(src, dest)
+            self.write(base, 'other build')
+        baseimage.sparse.copy = racing_copy
+        try:
+            self.assertEqual(self.cache.bases_for('key', [self.image]), [base])
+        finally:
+            baseimage.sparse.copy = copy
+        self.assertEqual(open(base).read(), 'other build')
+        self.assertEqual(os.listdir(self.cache.directory), [os.path.basename(base)])
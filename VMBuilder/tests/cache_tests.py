@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import VMBuilder.cache
+from VMBuilder.cache import Cache, Overlay
+from VMBuilder.exception import VMBuilderException
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = Cache(self.root, max_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def fill(self, size):
+        def populate(dest):
+            fp = open(os.path.join(dest, 'data'), 'w')
+            # Leave room for the directory itself, du rounds up
+            fp.write('x' * (size * 1024 - 16) * 1024)
+            fp.close()
+        return populate
+
+    def test_lookup_miss(self):
+        self.assertEqual(self.cache.lookup('foo'), None)
+
+    def test_store_and_lookup(self):
+        path = self.cache.store('foo', self.fill(1))
+        self.assertEqual(self.cache.lookup('foo'), path)
+        self.assertTrue(os.path.exists(os.path.join(path, 'data')))
+
+    def test_lru_eviction(self):
+        self.cache.store('a', self.fill(1))
+        self.cache.store('b', self.fill(1))
+        self.cache.lookup('a')
+        self.cache.store('c', self.fill(1))
+        self.assertNotEqual(self.cache.lookup('a'), None)
+        self.assertEqual(self.cache.lookup('b'), None)
+        self.assertNotEqual(self.cache.lookup('c'), None)
+
+    def test_stale_entry_is_dropped(self):
+        path = self.cache.store('foo', self.fill(1))
+        shutil.rmtree(path)
+        self.assertEqual(self.cache.lookup('foo'), None)
+        self.assertFalse('foo' in self.cache.read_index())
+
+    def test_eviction_removes_pin_files(self):
+        self.cache.pin('a').close()
+        self.cache.store('a', self.fill(1))
+        self.cache.store('b', self.fill(1))
+        self.cache.store('c', self.fill(1))
+        self.assertEqual(self.cache.lookup('a'), None)
+        self.assertFalse([f for f in os.listdir(self.root) if f.endswith('.pin')])
+
+    def test_pinned_entry_is_kept(self):
+        self.cache.store('a', self.fill(1))
+        pin = self.cache.pin('a')
+        try:
+            self.cache.store('b', self.fill(1))
+            self.cache.store('c', self.fill(1))
+            self.assertNotEqual(self.cache.lookup('a'), None)
+            self.assertEqual(self.cache.lookup('b'), None)
+        finally:
+            pin.close()
+
+    def test_overlay_cleans_up_failed_mount(self):
+        self.cache.store('a', self.fill(1))
+        overlay = Overlay(self.cache, 'a', os.path.join(self.root, 'mnt'), tmp_root=self.root)
+        calls = []
+        run_cmd = VMBuilder.cache.run_cmd
+        def failing_mount(*args, **kwargs):
+            calls.append(args[0])
+            if args[0] == 'mount':
+                raise VMBuilderException('mount failed')
+            return run_cmd(*args, **kwargs)
+        VMBuilder.cache.run_cmd = failing_mount
+        try:
+            self.assertRaises(VMBuilderException, overlay.mount, self.fill(1))
+            overlay.unmount()
+        finally:
+            VMBuilder.cache.run_cmd = run_cmd
+        self.assertFalse('umount' in calls)
+        self.assertEqual(overlay.scratch, None)
+        self.assertFalse([f for f in os.listdir(self.root) if f.startswith('vmbuilder-')])
@@ -0,0 +1,29 @@
+import os
+import unittest
+
+from VMBuilder.chrootexec import ChrootExecutor
+from VMBuilder.exception import VMBuilderException, VMBuilderUserError
+from VMBuilder.util import CAPTURE_NONE
+
+class TestChrootExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = ChrootExecutor()
+
+    def tearDown(self):
+        self.executor.stop()
+
+    @unittest.skipIf(os.geteuid() != 0, 'needs root')
+    def test_run(self):
+        self.assertEqual(self.executor.run('/', 'echo', 'foo'), 'foo\n')
+        pid = self.executor.pid
+        self.assertEqual(self.executor.run('/', 'cat', stdin='bar'), 'bar')
+        self.assertEqual(self.executor.run('/', 'sh', '-c', 'echo $foobarbaztest', env={ 'foobarbaztest' : 'baz' }), 'baz\n')
+        self.assertEqual(self.executor.run('/', 'seq', 100000, capture=CAPTURE_NONE), '')
+        self.assertEqual(self.executor.pid, pid)
+
+    @unittest.skipIf(os.geteuid() != 0, 'needs root')
+    def test_run_fails(self):
+        self.assertRaises(VMBuilderException, self.executor.run, '/', 'false')
+        self.assertEqual(self.executor.run('/', 'false', ignore_fail=True), '')
+        self.assertRaises(VMBuilderUserError, self.executor.run, '/', 'no-such-program-here')
+        self.assertEqual(self.executor.run('/', 'true'), '')
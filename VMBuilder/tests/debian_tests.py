@@ -0,0 +1,32 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2009 Canonical Ltd.
+#    
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Tests, tests, tests, and more tests
+
+import unittest
+
+from VMBuilder.plugins.debian.distro import Debian
+
+class TestDebianPlugin(unittest.TestCase):
+    def test_suites_load(self):
+        'Every suite module imports and provides its suite class'
+
+        debian = Debian()
+        for suite in debian.suites:
+            mod = __import__('VMBuilder.plugins.debian.%s' % suite, fromlist=[suite])
+            getattr(mod, suite.capitalize())(debian)
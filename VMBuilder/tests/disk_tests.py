@@ -16,13 +16,17 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import shutil
 import stat
+import struct
 import tempfile
 import unittest
+import uuid
 import testtools
 
 import VMBuilder
-from VMBuilder.disk import detect_size, parse_size, index_to_devname, devname_to_index, Disk
+from VMBuilder.disk import allocate, ALLOC_SPARSE, ALLOC_FULL, detect_size, discard_unused, new_uuid, parse_size, index_to_devname, devname_to_index, Disk
+import VMBuilder.parttable as parttable
 from VMBuilder.exception import VMBuilderException, VMBuilderUserError
 from VMBuilder.util import run_cmd
 
@@ -42,6 +46,9 @@ class MockHypervisor(object):
     def __init__(self):
         self.disks = []
         self.distro = MockDistro()
+        self.image_allocation = 'sparse'
+        self.mkfs_jobs = 2
+        self.uuid_seed = None
 
     def add_clean_cb(self, *args, **kwargs):
         pass
@@ -126,6 +133,63 @@ class TestDetectSize(TestCase):
             run_cmd('losetup', '-d', self.imgdev)
         os.unlink(self.tmpfile)
 
+class TestNewUUID(TestCase):
+    def test_random(self):
+        self.assertNotEqual(new_uuid(), new_uuid())
+
+    def test_seeded(self):
+        self.assertEqual(new_uuid('seed', 'fs0'), new_uuid('seed', 'fs0'))
+        self.assertNotEqual(new_uuid('seed', 'fs0'), new_uuid('seed', 'fs1'))
+        self.assertNotEqual(new_uuid('seed', 'fs0'), new_uuid('other', 'fs0'))
+
+class TestAllocate(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tmpfile = get_temp_filename()
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        os.unlink(self.tmpfile)
+
+    def test_sparse(self):
+        allocate(self.tmpfile, 10*1024*1024, ALLOC_SPARSE)
+        self.assertEqual(os.stat(self.tmpfile).st_size, 10*1024*1024)
+        self.assertEqual(os.stat(self.tmpfile).st_blocks, 0)
+
+    def test_full(self):
+        allocate(self.tmpfile, 10*1024*1024, ALLOC_FULL)
+        self.assertEqual(os.stat(self.tmpfile).st_size, 10*1024*1024)
+        self.assertTrue(os.stat(self.tmpfile).st_blocks * 512 >= 10*1024*1024)
+
+class TestDiscardUnused(TestCase):
+    def test_unsupported(self):
+        self.assertEqual(discard_unused('/proc'), None)
+
+    @testtools.skipIf(os.geteuid() != 0, 'Needs root to run')
+    def test_punches_holes(self):
+        tmpdir = tempfile.mkdtemp()
+        image = '%s/fs.img' % tmpdir
+        mntpnt = '%s/mnt' % tmpdir
+        os.mkdir(mntpnt)
+        fp = open(image, 'w')
+        fp.truncate(64*1024*1024)
+        fp.close()
+        run_cmd('mkfs.ext4', '-q', '-F', image)
+        run_cmd('mount', '-o', 'loop', image, mntpnt)
+        try:
+            fp = open('%s/junk' % mntpnt, 'w')
+            fp.write(os.urandom(1024*1024) * 16)
+            fp.close()
+            run_cmd('sync')
+            allocated = os.stat(image).st_blocks
+            os.unlink('%s/junk' % mntpnt)
+            run_cmd('sync')
+            self.assertTrue(discard_unused(mntpnt) >= 16*1024*1024)
+        finally:
+            run_cmd('umount', mntpnt)
+        self.assertTrue(os.stat(image).st_blocks <= allocated - 16*1024*2)
+        shutil.rmtree(tmpdir)
+
 class TestDiskPlugin(TestCase):
     def test_disk_filename(self):
         tmpfile = get_temp_filename()
@@ -220,30 +284,20 @@ class TestDiskPartitioningPlugin(TestCase):
         file_output = run_cmd('file', self.tmpfile)
         self.assertEqual('%s: data' % self.tmpfile, file_output.strip())
         self.disk.partition()
-        file_output = run_cmd('file', self.tmpfile)
-        self.assertEqual('%s: x86 boot sector, code offset 0xb8' % self.tmpfile, file_output.strip())
-
-        file_output = run_cmd('parted', '--script', self.tmpfile, 'print')
-        self.assertEqual('''Model:  (file)
-Disk %s: 1074MB
-Sector size (logical/physical): 512B/512B
-Partition Table: msdos
-
-Number  Start  End  Size  Type  File system  Flags''' % self.tmpfile, file_output.strip())
+        mbr = open(self.tmpfile, 'r').read(512)
+        self.assertEqual(mbr[510:], '\x55\xaa')
+        self.assertEqual(mbr[446:510], '\0' * 64)
 
     def test_partition_table_nonempty(self):
-        from VMBuilder.util import run_cmd
-
         self.disk.add_part(1, 1023, 'ext3', '/')
         self.disk.partition()
-        file_output = run_cmd('parted', '--script', self.tmpfile, 'print')
-        self.assertEqual('''Model:  (file)
-Disk %s: 1074MB
-Sector size (logical/physical): 512B/512B
-Partition Table: msdos
-
-Number  Start   End     Size    Type     File system  Flags
- 1      1049kB  1023MB  1022MB  primary''' % self.tmpfile, file_output.strip())
+        self.assertEqual(self.disk.partitions[0].offset, 1024*1024)
+        self.assertEqual(self.disk.partitions[0].length, 1023*1024*1024)
+        mbr = open(self.tmpfile, 'r').read(512)
+        (type, start, count) = struct.unpack('<4xB3xII', mbr[446:462])
+        self.assertEqual(type, 0x83)
+        self.assertEqual(start, 2048)
+        self.assertEqual(count, 1023*2048)
 
     @testtools.skipIf(os.geteuid() != 0, 'Needs root to run')
     def test_map_partitions(self):
@@ -252,7 +306,7 @@ Number  Start   End     Size    Type     File system  Flags
         self.disk.map_partitions()
         try:
             from VMBuilder.disk import detect_size
-            self.assertEqual(detect_size(self.disk.partitions[0].filename), 1023000576)
+            self.assertEqual(detect_size(self.disk.partitions[0].filename), 1023*1024*1024)
         except:
             raise
         finally:
@@ -265,6 +319,8 @@ Number  Start   End     Size    Type     File system  Flags
         self.disk.map_partitions()
         try:
             self.disk.mkfs()
+            fs = self.disk.partitions[0].fs
+            self.assertEqual(run_cmd('blkid', '-c', '/dev/null', '-sUUID', '-ovalue', fs.filename).strip(), fs.uuid)
         except:
             raise
         finally:
@@ -287,3 +343,135 @@ Number  Start   End     Size    Type     File system  Flags
         disk2 = self.vm.add_disk(tmpfile2, '1G')
         self.assertEqual(self.disk.get_index(), 0)
         self.assertEqual(disk2.get_index(), 1)
+
+class TestPartitionTable(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tmpfile = get_temp_filename()
+        fp = open(self.tmpfile, 'w')
+        fp.truncate(64*1024*1024)
+        fp.close()
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        os.unlink(self.tmpfile)
+
+    def test_layout_reserves_room_for_the_table(self):
+        self.assertEqual(parttable.layout([(0, 9), (10, 19)]),
+                         [(1024*1024, 9*1024*1024), (10*1024*1024, 10*1024*1024)])
+
+    def test_layout_checks_the_disk_size(self):
+        parttable.layout([(0, 63)], 64*1024*1024)
+        self.assertRaises(VMBuilderUserError, parttable.layout, [(0, 64)], 64*1024*1024)
+        self.assertRaises(VMBuilderUserError, parttable.layout, [(0, 63)], 64*1024*1024,
+                          parttable.GPT_BACKUP_SIZE)
+
+    def test_ids_from_seed(self):
+        new_id = lambda name: new_uuid('seed', name)
+        partitions = [(1024*1024, 9*1024*1024, parttable.GPT_LINUX)]
+        images = []
+        for i in range(2):
+            parttable.write_gpt(self.tmpfile, partitions, new_id)
+            images.append(open(self.tmpfile, 'r').read(34*512))
+            parttable.write_msdos(self.tmpfile, [(1024*1024, 9*1024*1024, parttable.MSDOS_LINUX)], new_id)
+            images.append(open(self.tmpfile, 'r').read(512))
+        self.assertEqual(images[0], images[2])
+        self.assertEqual(images[1], images[3])
+        self.assertEqual(images[1][440:444], uuid.UUID(new_id('disk')).bytes[:4])
+
+    def test_msdos(self):
+        parttable.write_msdos(self.tmpfile, [(1024*1024, 9*1024*1024, parttable.MSDOS_LINUX),
+                                             (10*1024*1024, 54*1024*1024, parttable.MSDOS_SWAP)])
+        mbr = open(self.tmpfile, 'r').read(512)
+        self.assertEqual(struct.unpack('<4xB3xII', mbr[446:462]), (0x83, 2048, 9*2048))
+        self.assertEqual(struct.unpack('<4xB3xII', mbr[462:478]), (0x82, 10*2048, 54*2048))
+        self.assertEqual(mbr[510:], '\x55\xaa')
+
+    def test_msdos_too_many_partitions(self):
+        self.assertRaises(VMBuilderUserError, parttable.write_msdos, self.tmpfile,
+                          [(i*1024*1024, 1024*1024, parttable.MSDOS_LINUX) for i in range(1, 6)])
+
+    def test_gpt(self):
+        import zlib
+        parttable.write_gpt(self.tmpfile, [(1024*1024, 9*1024*1024, parttable.GPT_LINUX)])
+        fp = open(self.tmpfile, 'r')
+        data = fp.read(34*512)
+        fp.seek(-33*512, os.SEEK_END)
+        backup = fp.read()
+        fp.close()
+
+        self.assertEqual(struct.unpack('<4xB', data[446:451])[0], 0xee)
+        for (hdr, entries) in [(data[512:604], data[1024:]), (backup[-512:-420], backup[:-512])]:
+            self.assertEqual(hdr[:8], 'EFI PART')
+            crc = struct.unpack('<I', hdr[16:20])[0]
+            self.assertEqual(zlib.crc32(hdr[:16] + '\0\0\0\0' + hdr[20:]) & 0xffffffff, crc)
+            self.assertEqual(struct.unpack('<I', hdr[88:92])[0], zlib.crc32(entries) & 0xffffffff)
+            (first, last) = struct.unpack('<QQ', entries[32:48])
+            self.assertEqual((first, last), (2048, 10*2048 - 1))
+
+    def test_read(self):
+        self.assertEqual(parttable.read(self.tmpfile), [])
+        partitions = [(1024*1024, 9*1024*1024, parttable.MSDOS_LINUX),
+                      (10*1024*1024, 54*1024*1024, parttable.MSDOS_SWAP)]
+        parttable.write_msdos(self.tmpfile, partitions)
+        self.assertEqual(parttable.read(self.tmpfile), partitions)
+        partitions = [(1024*1024, 9*1024*1024, parttable.GPT_LINUX),
+                      (10*1024*1024, 50*1024*1024, parttable.GPT_SWAP)]
+        parttable.write_gpt(self.tmpfile, partitions)
+        self.assertEqual(parttable.read(self.tmpfile), partitions)
+
+class TestPopulate(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.bindir = tempfile.mkdtemp()
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (self.bindir, self.path)
+        VMBuilder.disk._mke2fs_can_populate = None
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        VMBuilder.disk._mke2fs_can_populate = None
+        shutil.rmtree(self.bindir)
+        TestCase.tearDown(self)
+
+    def fake_mke2fs(self, usage):
+        fp = open('%s/mke2fs' % self.bindir, 'w')
+        fp.write('#!/bin/sh\ncat >&2 <<EOF\n%sEOF\nexit 1\n' % usage)
+        fp.close()
+        os.chmod('%s/mke2fs' % self.bindir, 0755)
+
+    def test_mke2fs_can_populate(self):
+        self.fake_mke2fs('Usage: mke2fs [-c|-l filename] [-b block-size] ...\n'
+                         '\t[-d root-directory] [-e errors-behavior] device [blocks-count]\n')
+        self.assertTrue(VMBuilder.disk.mke2fs_can_populate())
+
+    def test_mke2fs_cannot_populate(self):
+        self.fake_mke2fs('Usage: mke2fs [-c|-l filename] [-b block-size] ...\n'
+                         '\t[-E extended-option[,...]] [-T fs-type] device [blocks-count]\n')
+        self.assertFalse(VMBuilder.disk.mke2fs_can_populate())
+
+    def test_can_populate_filesystems(self):
+        from VMBuilder.hypervisor import Hypervisor, STORAGE_FS_IMAGE
+        from VMBuilder.plugins.ubuntu.distro import Ubuntu
+        VMBuilder.disk._mke2fs_can_populate = True
+
+        def hypervisor(*filesystems):
+            vm = Hypervisor(Ubuntu())
+            vm.preferred_storage = STORAGE_FS_IMAGE
+            vm.owns_chroot = True
+            for (mntpnt, type) in filesystems:
+                vm.add_filesystem(size=10, type=type, mntpnt=mntpnt)
+            return vm
+
+        self.assertTrue(hypervisor(('/', 'ext4'), (None, 'swap')).can_populate_filesystems())
+        # The whole tree has to go into the one ext filesystem
+        self.assertFalse(hypervisor(('/', 'ext4'), ('/var', 'ext4')).can_populate_filesystems())
+        self.assertFalse(hypervisor(('/', 'xfs')).can_populate_filesystems())
+        self.assertFalse(hypervisor(('/srv', 'ext4')).can_populate_filesystems())
+        # A chroot we were handed or are resuming from is not ours to change
+        vm = hypervisor(('/', 'ext4'))
+        vm.owns_chroot = False
+        self.assertFalse(vm.can_populate_filesystems())
+        vm = hypervisor(('/', 'ext4'))
+        vm.preferred_storage = 0
+        self.assertFalse(vm.can_populate_filesystems())
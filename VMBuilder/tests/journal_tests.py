@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from VMBuilder.journal import Journal, get_settings, set_settings
+from VMBuilder.plugins.ubuntu.distro import Ubuntu
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+    def test_record_and_load(self):
+        journal = Journal(self.filename)
+        journal.record('configure_os', chroot_dir='/tmp/foo', settings={ 'distro' : { 'suite' : 'lucid' } })
+        journal.record('install_os', images={ 'disks' : [('/tmp/bar', None)] })
+
+        resumed = Journal(self.filename)
+        resumed.load()
+        self.assertTrue(resumed.done('configure_os'))
+        self.assertTrue(resumed.done('install_os'))
+        self.assertFalse(resumed.done('convert'))
+        self.assertEqual(resumed.state['settings']['distro']['suite'], 'lucid')
+        self.assertEqual(type(resumed.state['chroot_dir']), str)
+
+    def test_remove(self):
+        journal = Journal(self.filename)
+        journal.record('configure_os')
+        journal.remove()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_resume(self):
+        'A resumed build sees the same settings as the one it resumes'
+        distro = Ubuntu()
+        distro.set_setting('suite', 'precise')
+        # What build_chroot does to the settings
+        distro.call_hooks('set_defaults')
+        journal = Journal(self.filename)
+        journal.record('configure_os', settings={ 'distro' : get_settings(distro) })
+
+        resumed = Journal(self.filename)
+        resumed.load()
+        distro2 = Ubuntu()
+        set_settings(distro2, resumed.state['settings']['distro'])
+        distro2.resume()
+        for name in ['suite', 'mirror', 'security-mirror', 'components']:
+            self.assertEqual(distro2.get_setting(name), distro.get_setting(name))
+        self.assertTrue(distro2.get_setting('mirror'))
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import VMBuilder.mirrors as mirrors
+
+class TestMirrorRanking(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'mirrors.json')
+        self.probed = []
+        self.results = { 'http://slow/ubuntu' : (0.5, 10000),
+                         'http://fast/ubuntu' : (0.05, 1000000),
+                         'http://down/ubuntu' : None }
+        def probe(mirror, suite, proxy=None):
+            self.probed.append(mirror)
+            return self.results[mirror]
+        self.orig_probe = mirrors.probe
+        mirrors.probe = probe
+
+    def tearDown(self):
+        mirrors.probe = self.orig_probe
+        shutil.rmtree(self.tmpdir)
+
+    def test_ranking(self):
+        ranking = mirrors.rank_mirrors(self.results.keys(), 'lucid', cache_file=self.cache_file)
+        self.assertEqual(ranking, ['http://fast/ubuntu', 'http://slow/ubuntu'])
+
+    def test_cached_ranking_is_reused(self):
+        mirrors.rank_mirrors(self.results.keys(), 'lucid', cache_file=self.cache_file)
+        self.probed = []
+        mirrors.rank_mirrors(self.results.keys(), 'lucid', cache_file=self.cache_file)
+        self.assertEqual(self.probed, [])
+
+    def test_expired_ranking_is_not_reused(self):
+        mirrors.rank_mirrors(self.results.keys(), 'lucid', cache_file=self.cache_file)
+        self.probed = []
+        mirrors.rank_mirrors(self.results.keys(), 'lucid', cache_file=self.cache_file, ttl=0)
+        self.assertEqual(len(self.probed), 3)
@@ -0,0 +1,133 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from VMBuilder.qcow2 import convert, write_overlay, HEADER
+
+def read_qcow2(filename):
+    """Minimal qcow2 reader: returns the guest contents as a string."""
+    fp = open(filename, 'rb')
+    header = struct.unpack(HEADER, fp.read(struct.calcsize(HEADER)))
+    (magic, version, backing_offset, backing_size, cluster_bits, size, _,
+     l1_size, l1_offset, rt_offset, rt_clusters, _, _) = header
+    assert magic == 'QFI\xfb'
+    backing = None
+    if backing_offset:
+        fp.seek(backing_offset)
+        backing = open(fp.read(backing_size), 'rb')
+    cs = 1 << cluster_bits
+    mask = (1 << 62) - 1
+    fp.seek(l1_offset)
+    l1 = struct.unpack('>%dQ' % l1_size, fp.read(l1_size * 8))
+    data = ''
+    for cluster in range((size + cs - 1) / cs):
+        l2_offset = l1[cluster / (cs / 8)] & mask
+        host = 0
+        if l2_offset:
+            fp.seek(l2_offset + (cluster % (cs / 8)) * 8)
+            host = struct.unpack('>Q', fp.read(8))[0] & ~(1 << 63)
+        if host & (1 << 62):
+            shift = 62 - (cluster_bits - 8)
+            sectors = ((host >> shift) & ((1 << (cluster_bits - 8)) - 1)) + 1
+            offset = host & ((1 << shift) - 1)
+            fp.seek(offset)
+            compressed = fp.read(sectors * 512 - offset % 512)
+            data += zlib.decompressobj(-12).decompress(compressed)[:cs]
+        elif host:
+            fp.seek(host & mask)
+            data += fp.read(cs)
+        elif backing:
+            backing.seek(cluster * cs)
+            data += backing.read(cs).ljust(cs, '\0')
+        else:
+            data += '\0' * cs
+    fp.close()
+    return data[:size]
+
+class TestQcow2(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.raw = os.path.join(self.tmpdir, 'disk.raw')
+        self.qcow2 = os.path.join(self.tmpdir, 'disk.qcow2')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        fp = open(self.raw, 'wb')
+        fp.truncate(64 * 1024 * 1024 + 512)
+        for (offset, data) in [(0, 'boot'), (1000, 'x' * 70000),
+                               (5 * 1024 * 1024 + 3, 'y' * 10),
+                               (64 * 1024 * 1024, 'tail')]:
+            fp.seek(offset)
+            fp.write(data)
+        fp.close()
+
+        convert(self.raw, self.qcow2)
+        self.assertEqual(read_qcow2(self.qcow2), open(self.raw, 'rb').read())
+        # Only the clusters holding data end up in the image
+        self.assertTrue(os.path.getsize(self.qcow2) < 1024 * 1024)
+
+    def write_raw(self):
+        fp = open(self.raw, 'wb')
+        fp.truncate(16 * 1024 * 1024 + 512)
+        for (offset, data) in [(0, 'boot' * 1000), (70000, os.urandom(100000)),
+                               (5 * 1024 * 1024 + 3, 'y' * 300000),
+                               (16 * 1024 * 1024, 'tail')]:
+            fp.seek(offset)
+            fp.write(data)
+        fp.close()
+
+    def test_compressed_round_trip(self):
+        self.write_raw()
+        convert(self.raw, self.qcow2)
+        uncompressed = os.path.getsize(self.qcow2)
+        convert(self.raw, self.qcow2, compress_level=6)
+        self.assertEqual(read_qcow2(self.qcow2), open(self.raw, 'rb').read())
+        self.assertTrue(os.path.getsize(self.qcow2) < uncompressed)
+
+    def test_compressed_independent_of_jobs(self):
+        self.write_raw()
+        convert(self.raw, self.qcow2, compress_level=6, jobs=1)
+        single = open(self.qcow2, 'rb').read()
+        convert(self.raw, self.qcow2, compress_level=6, jobs=3)
+        self.assertEqual(open(self.qcow2, 'rb').read(), single)
+
+    def test_overlay(self):
+        self.write_raw()
+        base = os.path.join(self.tmpdir, 'base.raw')
+        shutil.copy(self.raw, base)
+        fp = open(self.raw, 'r+b')
+        for (offset, data) in [(2, 'changed'), (70000, '\0' * 100000),
+                               (9 * 1024 * 1024, 'new')]:
+            fp.seek(offset)
+            fp.write(data)
+        fp.close()
+
+        write_overlay(self.raw, base, self.qcow2)
+        self.assertEqual(read_qcow2(self.qcow2), open(self.raw, 'rb').read())
+        # The header, the four changed clusters, one L2 table, the L1
+        # table, a refcount block and the refcount table
+        self.assertEqual(os.path.getsize(self.qcow2), 9 * 65536)
+
+    def test_refcounts(self):
+        fp = open(self.raw, 'wb')
+        fp.truncate(8 * 1024 * 1024)
+        fp.seek(4 * 1024 * 1024)
+        fp.write('z' * 200000)
+        fp.close()
+
+        convert(self.raw, self.qcow2)
+        fp = open(self.qcow2, 'rb')
+        header = struct.unpack(HEADER, fp.read(struct.calcsize(HEADER)))
+        rt_offset = header[9]
+        fp.seek(rt_offset)
+        rb_offset = struct.unpack('>Q', fp.read(8))[0]
+        fp.seek(rb_offset)
+        clusters = os.path.getsize(self.qcow2) / 65536
+        refcounts = struct.unpack('>%dH' % clusters, fp.read(clusters * 2))
+        fp.close()
+        self.assertEqual(refcounts, (1,) * clusters)
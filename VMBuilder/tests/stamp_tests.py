@@ -0,0 +1,106 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from VMBuilder.plugins.ubuntu.distro import Ubuntu
+from VMBuilder.plugins.ubuntu.dapper import Dapper
+from VMBuilder.stamp import parse_fstab, matches_spec
+
+class TestStamp(unittest.TestCase):
+    def test_parse_fstab(self):
+        (fd, fstab) = tempfile.mkstemp()
+        os.write(fd, '# <file system> <mount point> <type>\n'
+                     'proc /proc proc defaults 0 0\n'
+                     '\n'
+                     'UUID=1234 / ext4 defaults 0 0\n'
+                     'LABEL=my\\040data /srv/my\\040data ext4 defaults 0 0\n')
+        os.close(fd)
+        try:
+            self.assertEqual(parse_fstab(fstab),
+                             [('proc', '/proc', 'proc'),
+                              ('UUID=1234', '/', 'ext4'),
+                              ('LABEL=my data', '/srv/my data', 'ext4')])
+        finally:
+            os.unlink(fstab)
+
+    def test_matches_spec(self):
+        attrs = { 'UUID' : '1234', 'LABEL' : 'data', 'TYPE' : 'ext4' }
+        self.assertTrue(matches_spec('UUID=1234', attrs))
+        self.assertTrue(matches_spec('/dev/disk/by-label/data', attrs))
+        self.assertFalse(matches_spec('UUID=5678', attrs))
+        self.assertFalse(matches_spec('/dev/sda1', attrs))
+
+class TestStampHooks(unittest.TestCase):
+    'The stamp hooks work on a system that already has an identity'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ['etc/ssh', 'usr/sbin', 'root/.ssh', 'home/ubuntu/.ssh', 'home/donor']:
+            os.makedirs('%s/%s' % (self.root, path))
+        self.write('etc/passwd', 'root:x:0:0:root:/root:/bin/bash\n'
+                                 'ubuntu:x:1000:1000:Ubuntu:/home/ubuntu:/bin/bash\n'
+                                 'donor:x:1001:1001:Donor:/home/donor:/bin/bash\n'
+                                 'nobody:x:65534:65534:nobody:/nonexistent:/bin/sh\n')
+        for path in ['etc/ssh/ssh_host_rsa_key', 'etc/ssh/ssh_host_rsa_key.pub', 'usr/sbin/sshd',
+                     'root/.ssh/authorized_keys', 'home/ubuntu/.ssh/authorized_keys']:
+            self.write(path, 'old\n')
+        self.write('key.pub', 'new root key\n')
+        self.write('user_key.pub', 'new user key\n')
+
+        self.distro = Ubuntu()
+        self.distro.set_chroot_dir(self.root)
+        self.distro.set_setting('user', 'ubuntu')
+        self.distro.set_setting('ssh-key', '%s/key.pub' % self.root)
+        self.distro.set_setting('ssh-user-key', '%s/user_key.pub' % self.root)
+        self.calls = []
+        self.distro.run_in_target = self.run_in_target
+        self.suite = Dapper(self.distro)
+        self.suite.install_from_template = lambda *args, **kwargs: None
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path, contents):
+        fp = open('%s/%s' % (self.root, path), 'w')
+        fp.write(contents)
+        fp.close()
+
+    def read(self, path):
+        return open('%s/%s' % (self.root, path)).read()
+
+    def run_in_target(self, *args, **kwargs):
+        self.calls.append(args)
+        if args[:3] == ('getent', 'passwd', 'ubuntu'):
+            return 'ubuntu:x:1000:1000:Ubuntu:/home/ubuntu:/bin/bash\n'
+        if args[:3] == ('getent', 'group', 'admin'):
+            return 'admin:x:110:\n'
+        return ''
+
+    def test_stamp_existing_identity(self):
+        self.suite.reset_identity()
+        self.suite.create_initial_user()
+        self.suite.install_authorized_keys()
+
+        self.assertTrue(('deluser', 'donor') in self.calls)
+        self.assertFalse(os.path.exists('%s/home/donor' % self.root))
+        self.assertEqual([args[0] for args in self.calls if args[0] in ('adduser', 'addgroup', 'usermod')][:1], ['usermod'])
+        self.assertFalse([args for args in self.calls if args[:2] == ('adduser', '--disabled-password')])
+        self.assertFalse([args for args in self.calls if args[0] == 'addgroup'])
+
+        self.assertEqual(glob.glob('%s/etc/ssh/ssh_host_*' % self.root), [])
+        self.assertTrue(('dpkg-reconfigure', 'openssh-server') in self.calls)
+        self.assertEqual(self.read('root/.ssh/authorized_keys'), 'new root key\n')
+        self.assertEqual(self.read('home/ubuntu/.ssh/authorized_keys'), 'new user key\n')
+
+    def test_strip_identity(self):
+        self.assertTrue(self.suite.strip_identity())
+
+        self.assertTrue(('deluser', 'ubuntu') in self.calls)
+        self.assertTrue(('deluser', 'donor') in self.calls)
+        self.assertFalse(os.path.exists('%s/home/ubuntu' % self.root))
+        self.assertFalse(os.path.exists('%s/root/.ssh/authorized_keys' % self.root))
+        self.assertTrue(('usermod', '-p', '*', 'root') in self.calls)
+        self.assertEqual(glob.glob('%s/etc/ssh/ssh_host_*' % self.root), [])
+        self.assertFalse([args for args in self.calls if args[0] == 'dpkg-reconfigure'])
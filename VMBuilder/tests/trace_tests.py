@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+import unittest
+
+import VMBuilder.trace as trace
+from VMBuilder.util import run_cmd, call_hooks
+
+class Plugin(object):
+    def configure(self):
+        run_cmd('true')
+
+class Context(object):
+    def __init__(self):
+        self.plugins = [Plugin()]
+        self.hooks = {}
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        trace.enable()
+
+    def tearDown(self):
+        trace.tracer = None
+
+    def test_spans(self):
+        call_hooks(Context(), 'configure')
+        events = dict([((event['cat'], event['name']), event) for event in trace.tracer.events])
+        self.assertEqual(sorted(events), [('cmd', 'true'), ('hook', 'configure'), ('plugin', 'Plugin.configure')])
+        (hook, cmd) = (events[('hook', 'configure')], events[('cmd', 'true')])
+        self.assertTrue(hook['ts'] <= cmd['ts'] and cmd['ts'] + cmd['dur'] <= hook['ts'] + hook['dur'])
+        self.assertEqual(cmd['args']['argv'], ['true'])
+        self.assertEqual(cmd['ph'], 'X')
+
+    def test_finish(self):
+        run_cmd('true')
+        self.assertRaises(Exception, run_cmd, 'false')
+        (fd, filename) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            summary = trace.tracer.summary()
+            trace.finish(filename)
+            events = json.load(open(filename))['traceEvents']
+        finally:
+            os.unlink(filename)
+        self.assertEqual([event['name'] for event in events], ['true', 'false'])
+        self.assertTrue(events[1]['args']['failed'])
+        self.assertEqual(len(summary), 3)
+        self.assertTrue(trace.tracer is None)
+
+    def test_command_name(self):
+        self.assertEqual(trace.command_name(['chroot', '/tmp/x', 'apt-get', 'update']), 'apt-get (chroot)')
+        self.assertEqual(trace.command_name(['rsync', '-a']), 'rsync')
@@ -37,3 +37,26 @@ class TestUbuntuPlugin(unittest.TestCase):
         ubuntu = Ubuntu()
         ubuntu.set_setting('suite', 'foo')
         self.assertRaises(VMBuilderUserError, ubuntu.preflight_check)
+
+    def test_suites_load(self):
+        'Every suite module imports and provides its suite class'
+
+        ubuntu = Ubuntu()
+        for suite in ubuntu.suites:
+            mod = __import__('VMBuilder.plugins.ubuntu.%s' % suite, fromlist=[suite])
+            getattr(mod, suite.capitalize())(ubuntu)
+
+    def test_package_intents(self):
+        'Requested packages are applied only once'
+
+        ubuntu = Ubuntu()
+        ubuntu.add_packages('foo', 'bar')
+        ubuntu.remove_packages('baz')
+        ubuntu.add_packages('foo')
+        self.assertEqual(ubuntu.pending_packages(), (['bar', 'foo'], ['baz']))
+        self.assertTrue(ubuntu.is_package_pending('foo'))
+
+        ubuntu.mark_packages_applied(['foo', 'bar', 'baz'])
+        self.assertEqual(ubuntu.pending_packages(), ([], []))
+        self.assertFalse(ubuntu.is_package_pending('foo'))
+        self.assertFalse(ubuntu.is_package_pending('qux'))
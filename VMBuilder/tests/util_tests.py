@@ -1,10 +1,138 @@
+import logging
+import time
 import unittest
 
 import VMBuilder
-from VMBuilder.util import run_cmd
+import VMBuilder.distro
+import VMBuilder.plugins
+from VMBuilder.exception import VMBuilderException
+from VMBuilder.util import run_cmd, run_parallel, run_cmd_async, gather, CommandLimiter, wait_for, is_mounted, CAPTURE_NONE, CAPTURE_TAIL, TAIL_SIZE
 
 class TestUtils(unittest.TestCase):
     def test_run_cmd(self):
         self.assertTrue("foobarbaztest" in run_cmd("env", env={'foobarbaztest' : 'bar' }))
 
+    def test_run_cmd_capture(self):
+        script = 'for i in $(seq 20000); do echo line $i; done'
+        out = run_cmd('sh', '-c', script)
+        self.assertEqual(out.split('\n')[-2], 'line 20000')
+        self.assertEqual(len(out.split('\n')), 20001)
+        self.assertEqual(run_cmd('sh', '-c', script, capture=CAPTURE_NONE), '')
+        tail = run_cmd('sh', '-c', script, capture=CAPTURE_TAIL)
+        self.assertEqual(len(tail), TAIL_SIZE)
+        self.assertTrue(out.endswith(tail))
 
+    def test_run_cmd_logs_lines(self):
+        lines = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                lines.append(record.getMessage())
+        handler = Handler()
+        logger = logging.getLogger()
+        (level, logger.level) = (logger.level, logging.DEBUG)
+        logger.addHandler(handler)
+        try:
+            run_cmd('printf', 'a\\nb\\nc', capture=CAPTURE_NONE)
+        finally:
+            logger.removeHandler(handler)
+            logger.level = level
+        self.assertEqual(lines[-3:], ['a', 'b', 'c'])
+
+    def test_run_cmd_async(self):
+        futures = [run_cmd_async('echo', i) for i in range(5)]
+        self.assertEqual(gather(futures), ['%d\n' % i for i in range(5)])
+
+    def test_run_cmd_async_limiter(self):
+        start = time.time()
+        limiter = CommandLimiter(1)
+        futures = [run_cmd_async('sleep', '0.2', limiter=limiter) for i in range(3)]
+        self.assertFalse(futures[2].done())
+        gather(futures)
+        self.assertTrue(time.time() - start >= 0.6)
+
+    def test_run_cmd_async_errors(self):
+        ok = run_cmd_async('true')
+        failed = run_cmd_async('false')
+        self.assertRaises(VMBuilderException, failed.result)
+        self.assertEqual(ok.result(), '')
+        try:
+            gather([ok, failed, run_cmd_async('sh', '-c', 'exit 3')])
+        except VMBuilderException, e:
+            self.assertTrue(str(e).startswith('2 of 3 tasks failed'))
+        else:
+            self.fail('No exception raised')
+
+    def test_wait_for(self):
+        calls = []
+        def condition():
+            calls.append(1)
+            return len(calls) == 3
+        wait_for(condition)
+        self.assertEqual(len(calls), 3)
+
+    def test_wait_for_timeout(self):
+        self.assertRaises(VMBuilderException, wait_for, lambda: False, 0.1)
+
+    def test_is_mounted(self):
+        self.assertTrue(is_mounted('/'))
+        self.assertTrue(is_mounted('/proc'))
+        self.assertFalse(is_mounted('/proc/self'))
+
+    def test_run_parallel_keeps_order(self):
+        self.assertEqual(run_parallel(lambda x: x * 2, range(10), jobs=4), range(0, 20, 2))
+
+    def test_run_parallel_raises_first_error(self):
+        def func(x):
+            if x % 3 == 2:
+                raise VMBuilderException(str(x))
+            return x
+        try:
+            run_parallel(func, range(10), jobs=4)
+        except VMBuilderException, e:
+            self.assertEqual(str(e), '2')
+        else:
+            self.fail('No exception raised')
+
+    def test_run_parallel_collects_errors(self):
+        def func(x):
+            if x % 3 == 2:
+                raise VMBuilderException('failed %d' % x)
+            return x
+        try:
+            run_parallel(func, range(10), jobs=4, collect=True)
+        except VMBuilderException, e:
+            self.assertTrue(str(e).startswith('3 of 10 tasks failed'))
+            for x in (2, 5, 8):
+                self.assertTrue('%d: failed %d' % (x, x) in str(e))
+        else:
+            self.fail('No exception raised')
+
+class TestHooks(unittest.TestCase):
+    class Plugin(VMBuilder.plugins.Plugin):
+        def configure(self, calls):
+            calls.append('plugin')
+
+    class Context(VMBuilder.distro.Context):
+        def __init__(self):
+            self.plugin_classes = [TestHooks.Plugin]
+            super(TestHooks.Context, self).__init__()
+
+        def configure(self, calls):
+            calls.append('context')
+
+    def test_dispatch(self):
+        context = self.Context()
+        calls = []
+        context.call_hooks('configure', calls)
+        self.assertEqual(calls, ['plugin', 'context'])
+        self.assertEqual(context._hook_tables.keys(), ['configure'])
+
+        context.register_hook('configure', lambda calls: calls.append('registered'))
+        calls = []
+        context.call_hooks('configure', calls)
+        self.assertEqual(calls, ['plugin', 'registered', 'context'])
+
+        context.set_skipped_hooks(['configure'])
+        calls = []
+        context.call_hooks('configure', calls)
+        self.assertEqual(calls, [])
@@ -0,0 +1,67 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from VMBuilder.vmdk import convert, HEADER
+
+def read_vmdk(filename):
+    """Minimal streamOptimized reader: returns the guest contents as a string."""
+    fp = open(filename, 'rb')
+    fp.seek(-1024, os.SEEK_END)
+    footer = struct.unpack(HEADER, fp.read(512))
+    (magic, version, flags, capacity, grain_sectors, _, _, gtes, _, gd_offset) = footer[:10]
+    assert magic == 'KDMV'
+    grains = (capacity + grain_sectors - 1) / grain_sectors
+    fp.seek(gd_offset * 512)
+    gd = struct.unpack('<%dI' % ((grains + gtes - 1) / gtes), fp.read(((grains + gtes - 1) / gtes) * 4))
+    data = ''
+    for grain in range(grains):
+        sector = 0
+        if gd[grain / gtes]:
+            fp.seek(gd[grain / gtes] * 512 + (grain % gtes) * 4)
+            sector = struct.unpack('<I', fp.read(4))[0]
+        if sector:
+            fp.seek(sector * 512)
+            (lba, size) = struct.unpack('<QI', fp.read(12))
+            assert lba == grain * grain_sectors
+            data += zlib.decompress(fp.read(size))
+        else:
+            data += '\0' * grain_sectors * 512
+    fp.close()
+    return data[:capacity * 512]
+
+class TestVMDK(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.raw = os.path.join(self.tmpdir, 'disk.raw')
+        self.vmdk = os.path.join(self.tmpdir, 'disk.vmdk')
+        fp = open(self.raw, 'wb')
+        fp.truncate(40 * 1024 * 1024)
+        for (offset, data) in [(0, 'boot' * 1000), (70000, os.urandom(100000)),
+                               (33 * 1024 * 1024 + 3, 'y' * 300000)]:
+            fp.seek(offset)
+            fp.write(data)
+        fp.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        convert(self.raw, self.vmdk)
+        self.assertEqual(read_vmdk(self.vmdk), open(self.raw, 'rb').read())
+        fp = open(self.vmdk, 'rb')
+        header = struct.unpack(HEADER, fp.read(512))
+        descriptor = fp.read(header[6] * 512)
+        fp.close()
+        self.assertEqual(header[9], 0xffffffffffffffff)
+        self.assertTrue('createType="streamOptimized"' in descriptor)
+        self.assertTrue('RW 81920 SPARSE "disk.vmdk"' in descriptor)
+
+    def test_independent_of_jobs(self):
+        convert(self.raw, self.vmdk, jobs=1)
+        single = open(self.vmdk, 'rb').read()
+        convert(self.raw, self.vmdk, jobs=4)
+        self.assertEqual(open(self.vmdk, 'rb').read(), single)
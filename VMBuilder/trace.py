@@ -0,0 +1,177 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Build timing traces
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+class Span(object):
+    """
+    One timed piece of work: a hook, a plugin's part of one or a
+    command. Use it as a context manager.
+
+    Besides the wall time, it measures the CPU time of our process and
+    the CPU time of the child processes that finished while it ran.
+    Spans running at the same time on different threads are charged
+    each other's CPU time, so those two only add up in serial stretches
+    of the build.
+    """
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.children_cpu = None
+        "Overrides the measured child CPU time if set while the span runs"
+
+    def __enter__(self):
+        self._start = time.time()
+        self._cpu = _cpu(resource.RUSAGE_SELF)
+        self._children_cpu = _cpu(resource.RUSAGE_CHILDREN)
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.time() - self._start
+        cpu = _cpu(resource.RUSAGE_SELF) - self._cpu
+        if self.children_cpu is None:
+            self.children_cpu = _cpu(resource.RUSAGE_CHILDREN) - self._children_cpu
+        self.tracer.record(self, self._start, wall, cpu, self.children_cpu, exc_info[0] is not None)
+
+class NullSpan(object):
+    """Stands in for L{Span} while tracing is off"""
+
+    children_cpu = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_span = NullSpan()
+
+class Tracer(object):
+    """Collects L{Span}s as Chrome trace events."""
+
+    def __init__(self):
+        self.events = []
+        "The trace events recorded so far"
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, span, start, wall, cpu, children_cpu, failed):
+        args = dict(span.args)
+        args.update({ 'cpu_ms' : round(cpu * 1000, 3),
+                      'children_cpu_ms' : round(children_cpu * 1000, 3) })
+        if failed:
+            args['failed'] = True
+        event = { 'name' : span.name,
+                  'cat' : span.category,
+                  'ph' : 'X',
+                  'ts' : int((start - self.start) * 1000000),
+                  'dur' : int(wall * 1000000),
+                  'pid' : os.getpid(),
+                  'tid' : threading.current_thread().ident,
+                  'args' : args }
+        self._lock.acquire()
+        try:
+            self.events.append(event)
+        finally:
+            self._lock.release()
+
+    def write(self, filename):
+        """
+        Write the trace as a Chrome trace-event file (for
+        chrome://tracing, Perfetto and the like).
+        """
+        fp = open(filename, 'w')
+        try:
+            json.dump({ 'traceEvents' : self.events, 'displayTimeUnit' : 'ms' }, fp)
+        finally:
+            fp.close()
+
+    def summary(self, limit=25):
+        """
+        @rtype:  list
+        @return: lines of a table of where the time went: one row per
+                 hook, plugin hook and command, costliest first
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault((event['cat'], event['name']), [0, 0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += event['dur']
+            total[2] += event['args']['cpu_ms']
+            total[3] += event['args']['children_cpu_ms']
+        rows = sorted(totals.iteritems(), key=lambda (key, total): total[1], reverse=True)
+        lines = ['%-6s %-44s %6s %10s %10s %10s' % ('kind', 'name', 'calls', 'wall s', 'cpu s', 'child s')]
+        for ((category, name), (calls, wall, cpu, children_cpu)) in rows[:limit]:
+            lines.append('%-6s %-44s %6d %10.2f %10.2f %10.2f' %
+                         (category, name[:44], calls, wall / 1000000.0, cpu / 1000.0, children_cpu / 1000.0))
+        return lines
+
+tracer = None
+"The active L{Tracer}, if tracing is on"
+
+def enable():
+    """Start tracing."""
+    global tracer
+    tracer = Tracer()
+
+def span(name, category, **args):
+    """
+    @type  category: string
+    @param category: 'hook', 'plugin' or 'cmd'
+    @rtype:  L{Span}
+    @return: a span to time a piece of work with, or a L{NullSpan} if
+             tracing is off
+    """
+    if tracer is None:
+        return _null_span
+    return Span(tracer, name, category, args)
+
+def command_name(args):
+    """
+    @rtype:  string
+    @return: what to call the command L{args} in a trace. Commands run
+             in a chroot go by the name of the command, not of chroot.
+    """
+    if len(args) > 2 and args[0] == 'chroot':
+        return '%s (chroot)' % args[2]
+    return args[0]
+
+def finish(filename):
+    """Write the trace to L{filename}, log a summary of it and stop tracing."""
+    global tracer
+    if tracer is None:
+        return
+    tracer.write(filename)
+    logging.info('Timing trace written to %s. Where the time went:' % filename)
+    for line in tracer.summary():
+        logging.info(line)
+    tracer = None
+
+def _cpu(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
@@ -17,23 +17,118 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 #    Various utility functions
+import collections
 import ConfigParser
 import errno
 import fcntl
 import logging
+import multiprocessing
 import os.path
+import re
 import select
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 from   exception        import VMBuilderException, VMBuilderUserError
+from   VMBuilder        import trace
 
-class NonBlockingFile(object):
-    def __init__(self, fp, logfunc):
+CAPTURE_ALL = 'all'
+"Keep all of a command's output"
+CAPTURE_NONE = 'none'
+"Only log a command's output"
+CAPTURE_TAIL = 'tail'
+"Keep the last L{TAIL_SIZE} bytes of a command's output"
+
+TAIL_SIZE = 64 * 1024
+"How much output to keep with L{CAPTURE_TAIL}, and to quote in errors"
+
+READ_SIZE = 64 * 1024
+MAX_LINE = 64 * 1024
+"Longer lines (progress bars, say) are logged in pieces of this size"
+
+class OutputBuffer(object):
+    """
+    Collects the output of a command as it comes in, logging it line by
+    line and keeping as much of it as L{capture} says.
+
+    The output is kept as a list of the chunks fed in, which are only
+    joined when L{buf} is asked for, so collecting takes time in
+    proportion to the size of the output.
+    """
+
+    def __init__(self, logfunc, capture=CAPTURE_ALL):
+        self.chunks = collections.deque()
+        "The output kept so far"
+        self.size = 0
+        "The size of L{chunks}"
+        self.line = []
+        "The pieces of the line being read"
+        self.line_size = 0
+        self.logfunc = logfunc
+        self.capture = capture
+
+    @property
+    def buf(self):
+        """The output kept, as a string"""
+        buf = ''.join(self.chunks)
+        if self.capture == CAPTURE_TAIL:
+            return buf[-TAIL_SIZE:]
+        return buf
+
+    def tail(self):
+        """The end of the output kept, to quote in error messages"""
+        if self.capture == CAPTURE_ALL:
+            # Don't join everything just to throw most of it away
+            (chunks, size) = ([], 0)
+            for chunk in reversed(self.chunks):
+                if size >= TAIL_SIZE:
+                    break
+                chunks.insert(0, chunk)
+                size += len(chunk)
+            return ''.join(chunks)[-TAIL_SIZE:]
+        return self.buf
+
+    def feed(self, data):
+        """
+        @type  data: string
+        @param data: More output, or '' at the end of it
+        """
+        if data == '':
+            if self.line:
+                self.logfunc(''.join(self.line))
+                (self.line, self.line_size) = ([], 0)
+            return
+
+        if self.capture != CAPTURE_NONE:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.capture == CAPTURE_TAIL:
+                while self.size - len(self.chunks[0]) >= TAIL_SIZE:
+                    self.size -= len(self.chunks.popleft())
+
+        lines = data.split('\n')
+        if len(lines) > 1:
+            self.line.append(lines[0])
+            self.logfunc(''.join(self.line))
+            for line in lines[1:-1]:
+                self.logfunc(line)
+            (self.line, self.line_size) = ([], 0)
+        if lines[-1]:
+            self.line.append(lines[-1])
+            self.line_size += len(lines[-1])
+            if self.line_size >= MAX_LINE:
+                self.logfunc(''.join(self.line))
+                (self.line, self.line_size) = ([], 0)
+
+class NonBlockingFile(OutputBuffer):
+    """L{OutputBuffer} reading from a pipe"""
+
+    def __init__(self, fp, logfunc, capture=CAPTURE_ALL):
+        super(NonBlockingFile, self).__init__(logfunc, capture)
         self.file = fp
         self.set_non_blocking()
-        self.buf = ''
-        self.logbuf = ''
-        self.logfunc = logfunc
 
     def set_non_blocking(self):
         flags = fcntl.fcntl(self.file, fcntl.F_GETFL)
@@ -47,17 +142,38 @@ class NonBlockingFile(object):
             raise AttributeError()
 
     def process_input(self):
-        data = self.file.read()
+        data = os.read(self.file.fileno(), READ_SIZE)
         if data == '':
             self.file.close()
-            if self.logbuf:
-                self.logfunc(self.logbuf)
-        else:
-            self.buf += data
-            self.logbuf += data
-            while '\n' in self.logbuf:
-                line, self.logbuf = self.logbuf.split('\n', 1)
-                self.logfunc(line)
+        self.feed(data)
+
+def command_env(env):
+    """
+    @type  env: dict
+    @param env: Extra environment variables
+    @rtype:  dict
+    @return: the environment to run a command in: ours, with the locale
+             reset to C (to make parsing error messages possible) and
+             L{env} on top
+    """
+    proc_env = dict(os.environ)
+    proc_env['LANG'] = 'C'
+    proc_env['LC_ALL'] = 'C'
+    proc_env.update(env)
+    return proc_env
+
+def check_status(args, status, stdout, stderr, ignore_fail=False):
+    """
+    Raise L{VMBuilderException} if a command failed, unless told to
+    L{ignore_fail}.
+
+    @type  stdout: L{OutputBuffer}
+    @param stdout: The command's output
+    @type  stderr: L{OutputBuffer}
+    @param stderr: The command's error output
+    """
+    if not ignore_fail and status != 0:
+        raise VMBuilderException, "Process (%s) returned %d. stdout: %s, stderr: %s" % (args.__repr__(), status, stdout.tail(), stderr.tail())
 
 def run_cmd(*argv, **kwargs):
     """
@@ -73,40 +189,50 @@ def run_cmd(*argv, **kwargs):
                         cause an exception to be raised.
     @type  env: dict
     @param env: Dictionary of extra environment variables to set in the new process
+    @type  capture: string
+    @param capture: How much of the process' stdout to keep and return:
+                    all of it (L{CAPTURE_ALL}, the default), none of it
+                    (L{CAPTURE_NONE}) or its end (L{CAPTURE_TAIL}). It is
+                    logged either way. Of stderr, only the end is kept,
+                    for the error message.
 
     @rtype:  string
     @return: string containing the stdout of the process
     """
 
+    args = [str(arg) for arg in argv]
+    with trace.span(trace.command_name(args), 'cmd', argv=args):
+        return _run_cmd(args, **kwargs)
+
+def _run_cmd(args, **kwargs):
     env = kwargs.get('env', {})
     stdin = kwargs.get('stdin', None)
     ignore_fail = kwargs.get('ignore_fail', False)
-    args = [str(arg) for arg in argv]
+    capture = kwargs.get('capture', CAPTURE_ALL)
     logging.debug(args.__repr__())
     if stdin:
         logging.debug('stdin was set and it was a string: %s' % (stdin,))
         stdin_arg = subprocess.PIPE
     else:
         stdin_arg = file('/dev/null', 'r')
-    proc_env = dict(os.environ)
-    proc_env['LANG'] = 'C'
-    proc_env['LC_ALL'] = 'C'
-    proc_env.update(env)
+    proc_env = command_env(env)
 
     try:
-        proc = subprocess.Popen(args, stdin=stdin_arg, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=proc_env)
+        # close_fds keeps commands run from different threads from
+        # holding on to each other's pipes
+        proc = subprocess.Popen(args, stdin=stdin_arg, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=proc_env, close_fds=True)
     except OSError, error:
         if error.errno == errno.ENOENT:
-            raise VMBuilderUserError, "Couldn't find the program '%s' on your system" % (argv[0])
+            raise VMBuilderUserError, "Couldn't find the program '%s' on your system" % (args[0])
         else:
-            raise VMBuilderUserError, "Couldn't launch the program '%s': %s" % (argv[0], error)
+            raise VMBuilderUserError, "Couldn't launch the program '%s': %s" % (args[0], error)
 
     if stdin:
         proc.stdin.write(stdin)
         proc.stdin.close()
 
-    mystdout = NonBlockingFile(proc.stdout, logfunc=logging.debug)
-    mystderr = NonBlockingFile(proc.stderr, logfunc=(ignore_fail and logging.debug or logging.info))
+    mystdout = NonBlockingFile(proc.stdout, logfunc=logging.debug, capture=capture)
+    mystderr = NonBlockingFile(proc.stderr, logfunc=(ignore_fail and logging.debug or logging.info), capture=CAPTURE_TAIL)
 
     while not (mystdout.closed and mystderr.closed):
         # Block until either of them has something to offer
@@ -115,9 +241,7 @@ def run_cmd(*argv, **kwargs):
             if fp.file in fds:
                 fp.process_input()
 
-    status = proc.wait()
-    if not ignore_fail and status != 0:
-        raise VMBuilderException, "Process (%s) returned %d. stdout: %s, stderr: %s" % (args.__repr__(), status, mystdout.buf, mystderr.buf)
+    check_status(args, proc.wait(), mystdout, mystderr, ignore_fail)
     return mystdout.buf
 
 def checkroot():
@@ -152,32 +276,44 @@ def render_template(plugin, context, tmplname, extra_context=None):
 
 def call_hooks(context, func, *args, **kwargs):
     if kwargs.pop('skipped_hock', False) is True:
-        logging.info('Skipping hook: %s' % func)
+        logging.info('Skipping hook: %s', func)
         return
-    logging.info('Calling hook: %s' % func)
-    logging.debug('(args=%r, kwargs=%r)' % (args, kwargs))
-    for plugin in context.plugins:
-        logging.debug('Calling %s method in %s plugin.' % (func, plugin.__module__))
-        try:
-            hook = getattr(plugin, func)
-        except AttributeError as e:
-            logging.debug('No such method ({}) in context plugin ({})'.format(
-                func, plugin.__module__))
-        else:
-            hook(*args, **kwargs)
+    logging.info('Calling hook: %s', func)
+    logging.debug('(args=%r, kwargs=%r)', args, kwargs)
+    with trace.span(func, 'hook'):
+        for (name, hook) in hook_table(context, func):
+            logging.debug('Calling %s.', name)
+            with trace.span(name, 'plugin'):
+                hook(*args, **kwargs)
+
+def hook_table(context, func):
+    """
+    @rtype:  list
+    @return: (name, callable) for everything that implements L{func}
+             for L{context}, in the order to call them in: the methods
+             of its plugins, the hooks registered with it and its own
+             method. Kept in the context's C{_hook_tables}, if it has
+             one, so that this is only worked out once per hook.
+    """
+    tables = getattr(context, '_hook_tables', None)
+    if tables is not None and func in tables:
+        return tables[func]
 
+    table = []
+    for plugin in context.plugins:
+        hook = getattr(plugin, func, None)
+        if hook is not None:
+            table.append(('%s.%s' % (plugin.__class__.__name__, func), hook))
     for f in context.hooks.get(func, []):
-        logging.debug('Calling %r.' % (f,))
-        f(*args, **kwargs)
+        table.append(('%s (registered)' % getattr(f, '__name__', func), f))
+    hook = getattr(context, func, None)
+    if hook is not None:
+        table.append(('%s.%s' % (context.__class__.__name__, func), hook))
+    logging.debug('Implementations of %s: %s', func, ', '.join([name for (name, hook) in table]))
 
-    logging.debug('Calling %s method in context plugin %s.' % (func, context.__module__))
-    try:
-        hook = getattr(context, func)
-    except AttributeError as e:
-        logging.debug('No such method ({}) in context plugin ({})'.format(
-            func, plugin.__module__))
-    else:
-        hook(*args, **kwargs)
+    if tables is not None:
+        tables[func] = table
+    return table
 
 def tmp_filename(suffix='', tmp_root=None):
     # There is a risk in using tempfile.mktemp(): it's not recommended
@@ -210,6 +346,228 @@ def clean_up_tmpfs(mount_point):
     run_cmd(*umount_cmd)
 
 
+def run_parallel(func, items, jobs=1, collect=False):
+    """
+    Call L{func} on each of L{items}, on up to L{jobs} threads at once.
+
+    All calls are allowed to finish even if some of them fail. The
+    first failure (in the order of L{items}) is then re-raised, or with
+    L{collect}, if more than one call failed, a L{VMBuilderException}
+    listing all of the failures is raised.
+
+    @rtype:  list
+    @return: the return values, in the order of L{items}
+    """
+    if len(items) <= 1 or (jobs <= 1 and not collect):
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    pending = range(len(items))
+    lock = threading.Lock()
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                i = pending.pop(0)
+            finally:
+                lock.release()
+            try:
+                results[i] = func(items[i])
+            except:
+                errors[i] = sys.exc_info()
+                logging.error('%r failed: %s' % (items[i], errors[i][1]))
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(jobs, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    _raise_failures(items, errors, collect)
+    return results
+
+def _raise_failures(items, errors, collect):
+    # errors holds sys.exc_info() (or None) for each of items
+    failed = [(item, error) for (item, error) in zip(items, errors) if error]
+    if collect and len(failed) > 1:
+        raise VMBuilderException('%d of %d tasks failed:\n%s' %
+                                 (len(failed), len(items),
+                                  '\n'.join(['%r: %s' % (item, error[1]) for (item, error) in failed])))
+    for (item, error) in failed:
+        raise error[0], error[1], error[2]
+
+class CommandLimiter(object):
+    """
+    Caps the number of commands started by L{run_cmd_async} that run
+    at the same time. The others wait for a slot.
+
+    @type  jobs: number
+    @param jobs: How many commands may run at once
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._slots = threading.BoundedSemaphore(jobs)
+
+    def __enter__(self):
+        self._slots.acquire()
+
+    def __exit__(self, *exc_info):
+        self._slots.release()
+
+default_limiter = CommandLimiter(multiprocessing.cpu_count())
+"The limiter L{run_cmd_async} uses unless told otherwise"
+
+class CommandFuture(object):
+    """
+    A command started by L{run_cmd_async}. It runs on a thread of its
+    own, once its limiter lets it.
+    """
+
+    def __init__(self, argv, kwargs, limiter):
+        self.args = [str(arg) for arg in argv]
+        "The command line"
+        self._kwargs = kwargs
+        self._limiter = limiter
+        self._result = None
+        self._error = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def __repr__(self):
+        return '<CommandFuture %r>' % (self.args,)
+
+    def _run(self):
+        try:
+            with self._limiter:
+                self._result = run_cmd(*self.args, **self._kwargs)
+        except:
+            self._error = sys.exc_info()
+        self._done.set()
+
+    def done(self):
+        """
+        @rtype:  boolean
+        @return: whether the command has finished (or failed to start)
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the command to finish.
+
+        @rtype:  boolean
+        @return: whether it has
+        """
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self):
+        """
+        Wait for the command to finish.
+
+        @rtype:  string
+        @return: what L{run_cmd} returned. Whatever it raised is raised
+                 here instead.
+        """
+        self.wait()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+def run_cmd_async(*argv, **kwargs):
+    """
+    Start a command without waiting for it.
+
+    Takes the same arguments as L{run_cmd}, plus L{limiter}: the
+    L{CommandLimiter} to run the command under (L{default_limiter}
+    unless given). The command is logged, its environment is set up
+    and its failure is reported just like with L{run_cmd}, only the
+    exception is raised by L{CommandFuture.result}.
+
+    @rtype:  L{CommandFuture}
+    @return: the command's future
+    """
+    limiter = kwargs.pop('limiter', default_limiter)
+    return CommandFuture(argv, kwargs, limiter)
+
+def gather(futures, collect=True):
+    """
+    Wait for all of L{futures} to finish.
+
+    If any of them failed, the first failure is raised, or with
+    L{collect}, if more than one failed, a L{VMBuilderException}
+    listing all of the failures.
+
+    @type  futures: list
+    @param futures: L{CommandFuture}s, as returned by L{run_cmd_async}
+    @rtype:  list
+    @return: the results, in the order of L{futures}
+    """
+    for future in futures:
+        future.wait()
+    _raise_failures(futures, [future._error for future in futures], collect)
+    return [future._result for future in futures]
+
+def wait_for(condition, timeout=10, what='condition'):
+    """
+    Wait until L{condition} holds.
+
+    L{condition} is checked right away and then again after increasingly
+    long pauses (up to half a second), so this returns almost as soon as
+    the condition holds without spinning.
+
+    @type  condition: callable
+    @param condition: Returns True once the wait is over
+    @type  timeout: number
+    @param timeout: Give up after this many seconds
+    @type  what: string
+    @param what: Description of what we're waiting for, for the error message
+    """
+    deadline = time.time() + timeout
+    delay = 0.01
+    while not condition():
+        if time.time() >= deadline:
+            raise VMBuilderException('Timed out after %ds waiting for %s' % (timeout, what))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+def mountpoints():
+    """
+    @rtype:  list
+    @return: everything currently mounted, according to /proc/self/mountinfo
+    """
+    fp = open('/proc/self/mountinfo', 'r')
+    try:
+        # Field 5 is the mount point, with whitespace and backslashes escaped in octal
+        return [re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), line.split(' ')[4])
+                for line in fp]
+    finally:
+        fp.close()
+
+def is_mounted(path):
+    return os.path.realpath(path) in mountpoints()
+
+def umount(mntpnt, timeout=10):
+    """
+    Unmount L{mntpnt}.
+
+    Mount points in the chroot often stay busy for a moment after the
+    last process in there has exited, so retry until the mount is gone
+    from /proc/self/mountinfo or L{timeout} seconds have passed.
+    """
+    def try_umount():
+        run_cmd('umount', mntpnt, ignore_fail=True)
+        return not is_mounted(mntpnt)
+    try:
+        wait_for(try_umount, timeout, 'umount %s' % mntpnt)
+    except VMBuilderException:
+        # Fail with umount's own complaint
+        run_cmd('umount', mntpnt)
+
 def get_conf_value(context, confparser, key):
     confvalue = None
     try:
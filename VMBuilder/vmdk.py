@@ -0,0 +1,184 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    streamOptimized VMDK writer
+
+import logging
+import os
+import struct
+import zlib
+from   VMBuilder.sparse import compress_clusters, read_clusters
+
+SECTOR_SIZE = 512
+GRAIN_SECTORS = 128
+GT_ENTRIES = 512
+DESCRIPTOR_SECTORS = 20
+GD_AT_END = 0xffffffffffffffff
+
+HEADER = '<4sIIQQQQIQQQBccccH433x'
+FLAG_NL_DETECT = 1 << 0
+FLAG_COMPRESSED = 1 << 16
+FLAG_MARKERS = 1 << 17
+COMPRESSION_DEFLATE = 1
+
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+# Grains are zlib streams, not raw deflate
+DEFLATE_WBITS = 15
+
+DESCRIPTOR = """# Disk DescriptorFile
+version=1
+CID=%(cid)08x
+parentCID=ffffffff
+createType="streamOptimized"
+
+# Extent description
+RW %(sectors)d SPARSE "%(extent)s"
+
+# The Disk Data Base
+#DDB
+
+ddb.virtualHWVersion = "4"
+ddb.geometry.cylinders = "%(cylinders)d"
+ddb.geometry.heads = "16"
+ddb.geometry.sectors = "63"
+ddb.adapterType = "ide"
+"""
+
+class StreamOptimizedWriter(object):
+    """
+    Writes a streamOptimized VMDK grain by grain.
+
+    This is the compressed format VMware uses in OVF packages: every
+    grain is deflated on its own and preceded by a marker saying where
+    it goes, and the grain tables and the grain directory follow the
+    data, each behind a marker of their own. The header points to the
+    footer for the grain directory, so the image is written front to
+    back in one go.
+
+    @type  filename: string
+    @param filename: The image to write
+    @type  size: number
+    @param size: Virtual size of the image in bytes
+    """
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.sectors = (size + SECTOR_SIZE - 1) / SECTOR_SIZE
+        self.grain_size = GRAIN_SECTORS * SECTOR_SIZE
+        self.grains = {}
+        "Grain index -> sector of its marker, for each grain written so far"
+        self._fp = open(filename, 'wb')
+        self._sector = GRAIN_SECTORS
+
+    def write_grain(self, index, compressed):
+        """
+        Write one compressed grain.
+
+        @type  index: number
+        @param index: The grain (offset / grain size)
+        @type  compressed: string
+        @param compressed: The grain's contents as a zlib stream
+            (see L{DEFLATE_WBITS})
+        """
+        if index in self.grains:
+            raise ValueError('Grain %d has been written already' % index)
+        self.grains[index] = self._sector
+        self._write(struct.pack('<QI', index * GRAIN_SECTORS, len(compressed)) + compressed)
+
+    def close(self):
+        """Write out the grain tables, the grain directory and the footer and close the image."""
+        gd_entries = (self.sectors + GRAIN_SECTORS * GT_ENTRIES - 1) / (GRAIN_SECTORS * GT_ENTRIES)
+        tables = {}
+        for (index, sector) in self.grains.iteritems():
+            table = tables.setdefault(index / GT_ENTRIES, [0] * GT_ENTRIES)
+            table[index % GT_ENTRIES] = sector
+
+        # Grain tables without any grains in them are left out
+        gt_sectors = GT_ENTRIES * 4 / SECTOR_SIZE
+        gd = [0] * gd_entries
+        for gt_index in sorted(tables):
+            self._write(self._marker(gt_sectors, MARKER_GT))
+            gd[gt_index] = self._sector
+            self._write(struct.pack('<%dI' % GT_ENTRIES, *tables[gt_index]))
+
+        gd_data = struct.pack('<%dI' % gd_entries, *gd)
+        self._write(self._marker((len(gd_data) + SECTOR_SIZE - 1) / SECTOR_SIZE, MARKER_GD))
+        gd_offset = self._sector
+        self._write(gd_data)
+
+        self._write(self._marker(1, MARKER_FOOTER))
+        self._write(self._header(gd_offset))
+        self._write(self._marker(0, MARKER_EOS))
+
+        self._fp.seek(0)
+        self._fp.write(self._header(GD_AT_END))
+        # Derive the content id from the metadata rather than making one
+        # up, so that the same disk always gives the same image
+        descriptor = DESCRIPTOR % { 'cid' : zlib.crc32(repr(sorted(self.grains.items()))) & 0xffffffff,
+                                    'sectors' : self.sectors,
+                                    'extent' : os.path.basename(self.filename),
+                                    'cylinders' : min(self.sectors / (16 * 63), 16383) }
+        self._fp.write(descriptor.ljust(DESCRIPTOR_SECTORS * SECTOR_SIZE, '\0'))
+        self._fp.close()
+
+    def _header(self, gd_offset):
+        return struct.pack(HEADER, 'KDMV', 3,
+                           FLAG_NL_DETECT | FLAG_COMPRESSED | FLAG_MARKERS,
+                           self.sectors, GRAIN_SECTORS, 1, DESCRIPTOR_SECTORS,
+                           GT_ENTRIES, 0, gd_offset, GRAIN_SECTORS, 0,
+                           '\n', ' ', '\r', '\n', COMPRESSION_DEFLATE)
+
+    def _marker(self, sectors, type):
+        return struct.pack('<QII', sectors, 0, type).ljust(SECTOR_SIZE, '\0')
+
+    def _write(self, data):
+        # Everything starts on a sector boundary
+        self._fp.seek(self._sector * SECTOR_SIZE)
+        self._fp.write(data)
+        self._sector += (len(data) + SECTOR_SIZE - 1) / SECTOR_SIZE
+
+def convert(raw, dest, compress_level=6, jobs=1):
+    """
+    Convert a raw image to a streamOptimized VMDK.
+
+    @type  raw: string
+    @param raw: The raw image
+    @type  dest: string
+    @param dest: The VMDK to write
+    @type  compress_level: number
+    @param compress_level: zlib compression level (1-9)
+    @type  jobs: number
+    @param jobs: Number of processes to compress grains in. The image
+        comes out the same no matter how many there are.
+    """
+    fd = os.open(raw, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        writer = StreamOptimizedWriter(dest, size)
+        clusters = read_clusters(fd, size, writer.grain_size)
+        for (index, data, compressed) in compress_clusters(clusters, compress_level,
+                                                           DEFLATE_WBITS, jobs):
+            writer.write_grain(index, compressed)
+        writer.close()
+        logging.debug('Wrote %d of %d grains to %s' % (len(writer.grains), (writer.sectors + GRAIN_SECTORS - 1) / GRAIN_SECTORS, dest))
+    finally:
+        os.close(fd)